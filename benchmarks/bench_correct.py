@@ -0,0 +1,65 @@
+"""Benchmarks of the detector image corrections"""
+
+from csxtools.fastccd import correct_images, correct_common_mode
+from csxtools.axis1 import correct_images_axis
+
+from .data import (
+    SHAPES,
+    THREADS,
+    NFRAMES,
+    fastccd_images,
+    fastccd_dark,
+    axis_images,
+    flatfield,
+    corrected_images,
+)
+
+
+class FastCCDCorrect:
+    params = (SHAPES, THREADS)
+    param_names = ["shape", "nthreads"]
+
+    def setup(self, shape, nthreads):
+        self.images = fastccd_images(shape)
+        self.dark = fastccd_dark(shape)
+        self.flat = flatfield(shape)
+
+    def time_correct_images(self, shape, nthreads):
+        correct_images(self.images, self.dark, self.flat, nthreads=nthreads)
+
+    def track_frames_per_second(self, shape, nthreads):
+        import timeit
+
+        t = timeit.timeit(
+            lambda: correct_images(
+                self.images, self.dark, self.flat, nthreads=nthreads
+            ),
+            number=3,
+        )
+        return 3 * NFRAMES / t
+
+    track_frames_per_second.unit = "frames/s"
+
+
+class FastCCDCommonMode:
+    params = (SHAPES, THREADS)
+    param_names = ["shape", "nthreads"]
+
+    def setup(self, shape, nthreads):
+        self.images = corrected_images(shape)
+
+    def time_correct_common_mode(self, shape, nthreads):
+        correct_common_mode(self.images, nchannels=16, nthreads=nthreads)
+
+
+class AxisCorrect:
+    params = (SHAPES, THREADS)
+    param_names = ["shape", "nthreads"]
+
+    def setup(self, shape, nthreads):
+        self.images = axis_images(shape)
+        self.dark = fastccd_dark(shape)[0]
+        self.flat = flatfield(shape)
+
+    def time_correct_images_axis(self, shape, nthreads):
+        correct_images_axis(self.images, self.dark, self.flat, nthreads=nthreads)
@@ -0,0 +1,63 @@
+"""Benchmarks of the image stack routines"""
+
+from csxtools.image import (
+    rotate90,
+    stacksum,
+    stackmean,
+    stackvar,
+    stackstd,
+    stackstderr,
+    stackmedian,
+    stackclipmean,
+    bin_stack,
+)
+
+from .data import SHAPES, THREADS, corrected_images
+
+
+class Rotate:
+    params = (SHAPES, ["cw", "ccw"], THREADS)
+    param_names = ["shape", "sense", "nthreads"]
+
+    def setup(self, shape, sense, nthreads):
+        self.images = corrected_images(shape)
+
+    def time_rotate90(self, shape, sense, nthreads):
+        rotate90(self.images, sense, nthreads=nthreads)
+
+
+class StackProcess:
+    # Each reduction is a separate mode of the stackprocess kernel
+    params = (
+        SHAPES,
+        ["sum", "mean", "var", "std", "stderr", "median", "clipmean"],
+        THREADS,
+    )
+    param_names = ["shape", "mode", "nthreads"]
+
+    funcs = {
+        "sum": stacksum,
+        "mean": stackmean,
+        "var": stackvar,
+        "std": stackstd,
+        "stderr": stackstderr,
+        "median": stackmedian,
+        "clipmean": stackclipmean,
+    }
+
+    def setup(self, shape, mode, nthreads):
+        self.images = corrected_images(shape)
+
+    def time_stackprocess(self, shape, mode, nthreads):
+        self.funcs[mode](self.images, nthreads=nthreads)
+
+
+class BinStack:
+    params = (SHAPES, [2, 4], THREADS)
+    param_names = ["shape", "pixel_bin", "nthreads"]
+
+    def setup(self, shape, pixel_bin, nthreads):
+        self.images = corrected_images(shape)
+
+    def time_bin_stack(self, shape, pixel_bin, nthreads):
+        bin_stack(self.images, pixel_bin, 2, nthreads=nthreads)
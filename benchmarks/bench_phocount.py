@@ -0,0 +1,23 @@
+"""Benchmarks of single photon counting"""
+
+from csxtools.fastccd import photon_count
+
+from .data import SHAPES, THREADS, photon_images
+
+
+class PhotonCount:
+    params = (SHAPES, [1, 3, 9], THREADS)
+    param_names = ["shape", "nsum", "nthreads"]
+
+    def setup(self, shape, nsum, nthreads):
+        self.images = photon_images(shape)
+
+    def time_photon_count(self, shape, nsum, nthreads):
+        photon_count(
+            self.images,
+            (20, 200),
+            (0, 300),
+            (0, 300),
+            nsum=nsum,
+            nthreads=nthreads,
+        )
@@ -0,0 +1,75 @@
+"""Synthetic detector data for the benchmarks"""
+
+import numpy as np
+
+# Image shapes (y, x) of the detectors and a large 2k x 2k sensor
+SHAPES = [(960, 960), (1152, 960), (2048, 2048)]
+
+# Thread counts to run with, None uses all available threads
+THREADS = [1, None]
+
+# Number of frames in each benchmark stack
+NFRAMES = 20
+
+
+def shape_name(shape):
+    return "{}x{}".format(*shape)
+
+
+def fastccd_images(shape, nframes=NFRAMES, seed=0):
+    """Raw FastCCD frames with the gain bits set
+
+    The top two bits of each 16 bit value hold the gain setting
+    (0x0000 for x8, 0x8000 for x2 and 0xC000 for x1) and the lower 13
+    bits the ADU value.
+    """
+    rng = np.random.RandomState(seed)
+    values = rng.normal(1200, 50, size=(nframes,) + shape).astype(np.uint16)
+    gain = rng.choice(
+        np.array([0x0000, 0x8000, 0xC000], dtype=np.uint16),
+        size=(nframes,) + shape,
+        p=[0.9, 0.07, 0.03],
+    )
+    return values | gain
+
+
+def fastccd_dark(shape, seed=1):
+    """Dark images for the three FastCCD gain settings"""
+    rng = np.random.RandomState(seed)
+    return rng.normal(1100, 10, size=(3,) + shape).astype(np.float32)
+
+
+def axis_images(shape, nframes=NFRAMES, seed=2):
+    """Raw 16 bit frames for the AXIS detectors"""
+    rng = np.random.RandomState(seed)
+    return rng.normal(1000, 50, size=(nframes,) + shape).astype(np.uint16)
+
+
+def flatfield(shape, seed=3):
+    """Flatfield close to unity"""
+    rng = np.random.RandomState(seed)
+    return rng.normal(1.0, 0.02, size=shape).astype(np.float32)
+
+
+def corrected_images(shape, nframes=NFRAMES, nan_fraction=0.01, seed=4):
+    """Corrected float frames with a few NaN (bad) pixels"""
+    rng = np.random.RandomState(seed)
+    images = rng.normal(0, 5, size=(nframes,) + shape).astype(np.float32)
+    images[rng.random_sample(images.shape) < nan_fraction] = np.nan
+    return images
+
+
+def photon_images(shape, nframes=NFRAMES, rate=0.001, adu=100.0, seed=5):
+    """Sparse single photon hits on a noisy background
+
+    Each photon deposits ``adu`` split between a pixel and its right
+    neighbour so the cluster code has work to do.
+    """
+    rng = np.random.RandomState(seed)
+    images = rng.normal(0, 3, size=(nframes,) + shape).astype(np.float32)
+    hits = rng.random_sample(images.shape) < rate
+    hits[..., -1] = False
+    split = rng.random_sample(images.shape).astype(np.float32)
+    images += hits * split * adu
+    images[..., 1:] += (hits * (1 - split) * adu)[..., :-1]
+    return images
@@ -10,6 +10,10 @@ from .utils import get_axis_timestamps  # noqa: F401
 
 from .plotting import make_panel_plot  # noqa F401
 
+from .threads import set_num_threads  # noqa: F401
+from .threads import get_num_threads  # noqa: F401
+from .threads import num_threads  # noqa: F401
+
 # set version string using versioneer
 from ._version import get_versions
 
@@ -1,13 +1,14 @@
 import numpy as np
 from ..ext import axis1
-import time as ttime
+from ..threads import resolve_nthreads
+from ..profiling import stage
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def correct_images_axis(images, dark=None, flat=None):
+def correct_images_axis(images, dark=None, flat=None, nthreads=None):
     """Subtract background and correct images
 
     This routine subtracts the background and corrects the images
@@ -23,6 +24,9 @@ def correct_images_axis(images, dark=None, flat=None):
     flat : array_like, optional
         Input array for the flatfield correction. This should be of shape
         (y, x)
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -31,22 +35,23 @@ def correct_images_axis(images, dark=None, flat=None):
 
     """
 
-    t = ttime.time()
+    with stage("correct_images_axis", images) as s:
+        logger.info("Correcting image stack of shape %s", images.shape)
 
-    logger.info("Correcting image stack of shape %s", images.shape)
+        if dark is None:
+            dark = np.zeros(images.shape[-2:], dtype=np.float32)
+            logger.info("Not correcting for darkfield. No input.")
+        if flat is None:
+            flat = np.ones(images.shape[-2:], dtype=np.float32)
+            logger.info("Not correcting for flatfield. No input.")
+        else:
+            flat = np.asarray(flat, dtype=np.float32)
 
-    if dark is None:
-        dark = np.zeros(images.shape[-2:], dtype=np.float32)
-        logger.info("Not correcting for darkfield. No input.")
-    if flat is None:
-        flat = np.ones(images.shape[-2:], dtype=np.float32)
-        logger.info("Not correcting for flatfield. No input.")
-    else:
-        flat = np.asarray(flat, dtype=np.float32)
+        data = axis1.correct_images_axis(
+            images.astype(np.uint16), dark, flat, resolve_nthreads(nthreads)
+        )
+        s.set_output(data)
 
-    data = axis1.correct_images_axis(images.astype(np.uint16), dark, flat)
-    t = ttime.time() - t
-
-    logger.info("Corrected image stack in %.3f seconds", t)
+    logger.info("Corrected image stack in %.3f seconds", s.wall_time)
 
     return data
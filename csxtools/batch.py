@@ -0,0 +1,574 @@
+"""Reprocess many scans with a pool of processes
+
+This module provides the ``csxtools-batch`` command which corrects the
+images of a list of scans and writes them to compressed HDF5 files (see
+:func:`csxtools.io.write_corrected`)::
+
+    csxtools-batch 1000-1050 1100 --catalog csx --output /data/corrected \\
+        --workers 8 --darks auto --flat auto
+
+The scans are distributed over a pool of processes, each using a share of
+the cores for the OpenMP routines. Each finished scan is recorded in a
+JSON lines manifest in the output directory with the options it was
+processed with. A rerun of the command skips the scans which are already
+done with the same options, so an interrupted reprocessing can be resumed.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time as ttime
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.jsonl"
+
+# Catalog of the worker process and queue of the scans it starts (see
+# _init_worker)
+_db = None
+_started = None
+
+
+def parse_scan_ids(specs):
+    """Parse scan ids and inclusive ranges of scan ids
+
+    Parameters
+    ----------
+    specs : str or list of str
+        Scan ids (``"1000"``), inclusive ranges (``"1000-1050"``) or comma
+        separated lists of them (``"1000-1010,1020"``).
+
+    Returns
+    -------
+    list of int
+        The scan ids in the order given without duplicates.
+    """
+    if isinstance(specs, str):
+        specs = [specs]
+
+    scan_ids = []
+    for spec in specs:
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            # A leading "-" is the sign of a (relative) scan id
+            first, sep, last = part[1:].partition("-")
+            try:
+                if sep:
+                    first, last = int(part[0] + first), int(last)
+                    if last < first:
+                        raise ValueError
+                    scan_ids.extend(range(first, last + 1))
+                else:
+                    scan_ids.append(int(part))
+            except ValueError:
+                raise ValueError("Invalid scan id or range {!r}".format(part))
+
+    return list(dict.fromkeys(scan_ids))
+
+
+def read_manifest(path):
+    """Return the last manifest record of each scan id"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interruption
+                logger.warning("Skipping invalid manifest line %r", line)
+                continue
+            records[record["scan_id"]] = record
+    return records
+
+
+def _append_manifest(path, record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with open(path, "a+b") as f:
+        # Start a new line after a record cut short by an interruption
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+        f.write(line.encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _open_catalog(name):
+    """Open a databroker catalog by name or with a "module:function" factory"""
+    if ":" in name:
+        import importlib
+
+        module, func = name.split(":", 1)
+        return getattr(importlib.import_module(module), func)()
+
+    from databroker import Broker
+
+    return Broker.named(name)
+
+
+@contextmanager
+def _thread_environment(nthreads):
+    """Cap the threads of the processes started in this context
+
+    The thread libraries (OpenMP, BLAS) read these variables when they are
+    loaded, which is before any code of a worker runs, so they must be in
+    the environment the workers are spawned with. The workers of a pool are
+    spawned as they are needed so the variables are set for the life of the
+    pool and restored afterwards; the libraries of this process are already
+    loaded and are not affected.
+    """
+    names = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+    names += ("CSXTOOLS_NUM_THREADS",)
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update({name: str(nthreads) for name in names})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _init_worker(catalog, started=None):
+    """Open the catalog in a worker process"""
+    global _db, _started
+
+    _db = _open_catalog(catalog)
+    _started = started
+
+
+def _start_pool(workers, catalog, started=None):
+    # Spawn the workers as forking after OpenMP has started is not safe
+    return ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(catalog, started),
+    )
+
+
+def _resolve_darks(db, header, detector, darks):
+    if darks is None or darks == "none":
+        return None
+    if darks == "auto":
+        if detector != "fccd":
+            raise ValueError("Automatic darks are only available for the fccd")
+        from .helpers.fastccd import get_dark_near_all
+
+        headers = get_dark_near_all(header, db=db)
+        if headers[0] is None:
+            raise ValueError("No dark images found near the scan")
+        return headers
+    headers = tuple(db[s] if s is not None else None for s in darks)
+    return headers if len(headers) > 1 else headers[0]
+
+
+def _resolve_flat(header, detector, flat):
+    if flat is None or flat == "none":
+        return None
+    if flat == "auto":
+        from .flatfield import FlatfieldStore
+
+        return FlatfieldStore().load(detector, header.start["time"])
+    return np.load(flat)
+
+
+def process_scan(
+    db,
+    scan_id,
+    output,
+    detector="fccd",
+    darks="auto",
+    flat=None,
+    roi=None,
+    compression="gzip",
+    level=4,
+    direct=False,
+    chunk_size=100,
+):
+    """Correct the images of a scan and write them to a file
+
+    Parameters
+    ----------
+    db : databroker catalog
+        Catalog to get the scans from.
+    scan_id : int
+        Scan to process.
+    output : str
+        Directory of the output files.
+    detector : str
+        Name of the detector (see :mod:`csxtools.pipeline`).
+    darks : str or tuple
+        ``"auto"`` to find the darks near the scan, ``"none"`` or a tuple
+        of dark scan ids.
+    flat : str, optional
+        ``"auto"`` to use the flatfield store, ``"none"`` or the name of a
+        ``.npy`` file.
+    roi : tuple, optional
+        ROI (x, y, w, h) to correct.
+    compression : str
+        Compression of the output (see :func:`csxtools.io.write_corrected`).
+    level : int
+        Compression level.
+    direct : bool
+        Read the AreaDetector files directly.
+    chunk_size : int
+        Number of events corrected and written at once when the images are
+        not read as a dask array.
+
+    Returns
+    -------
+    dict
+        The manifest record of the scan.
+    """
+    from .pipeline import Pipeline, convert_roi, _iter_chunks
+    from .io import write_corrected
+    from .threads import get_num_threads
+
+    t = ttime.time()
+    header = db[scan_id]
+    dark_headers = _resolve_darks(db, header, detector, darks)
+    flat = _resolve_flat(header, detector, flat)
+
+    pipe = Pipeline(detector, direct=direct)
+    roi = convert_roi(roi)
+    events, bgnd, flat = pipe.prepare(header, dark_headers, flat, roi)
+    if hasattr(events, "map_blocks"):
+        images = pipe.correct_lazy(events, bgnd, flat)
+    else:
+        images = (
+            pipe.correct(block, bgnd, flat)
+            for block in _iter_chunks(events, chunk_size)
+        )
+
+    if dark_headers is None:
+        dark_uids = []
+    else:
+        if not isinstance(dark_headers, tuple):
+            dark_headers = (dark_headers,)
+        dark_uids = [d.start["uid"] if d is not None else None for d in dark_headers]
+
+    path = os.path.join(output, "scan_{}.h5".format(scan_id))
+    tmp = path + ".part"
+    write_corrected(
+        tmp,
+        images,
+        dark=bgnd,
+        flat=flat,
+        compression=compression,
+        level=level,
+        metadata={
+            "scan_id": scan_id,
+            "uid": header.start["uid"],
+            "detector": detector,
+            "dark_uids": dark_uids,
+            "roi": list(roi) if roi is not None else [],
+        },
+    )
+    os.replace(tmp, path)
+
+    return {
+        "scan_id": scan_id,
+        "uid": header.start["uid"],
+        "status": "done",
+        "output": path,
+        "shape": list(pipe.detector.output_shape(events.shape)),
+        "dark_uids": dark_uids,
+        "threads": get_num_threads(),
+        "wall_time": ttime.time() - t,
+    }
+
+
+def _failed(scan_id, error, tb=None):
+    return {"scan_id": scan_id, "status": "failed", "error": error, "traceback": tb}
+
+
+def _run(scan_id, options, db=None):
+    """Process a scan (in a worker) and return its manifest record"""
+    if _started is not None:
+        _started.put(scan_id)
+    try:
+        return process_scan(_db if db is None else db, scan_id, **options)
+    except Exception as e:
+        return _failed(
+            scan_id, "{}: {}".format(type(e).__name__, e), traceback.format_exc()
+        )
+
+
+def _run_pool(scan_ids, options, workers, catalog, nthreads, finished):
+    """Process scans in a pool
+
+    Returns the scans left when the pool broke and, of those, the scans
+    which were running. The others were still queued.
+    """
+    started = multiprocessing.get_context("spawn").SimpleQueue()
+    with _thread_environment(nthreads), _start_pool(workers, catalog, started) as pool:
+        unfinished = _collect(pool, scan_ids, options, finished)
+    running = set()
+    while not started.empty():
+        running.add(started.get())
+    return unfinished, [s for s in unfinished if s in running]
+
+
+def _collect(pool, scan_ids, options, finished):
+    futures = {pool.submit(_run, s, options): s for s in scan_ids}
+    unfinished = []
+    try:
+        for future in as_completed(futures):
+            scan_id = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for lack of memory), all the
+                # scans which were not done are lost with the pool
+                unfinished.append(scan_id)
+                continue
+            except Exception as e:
+                record = _failed(scan_id, "{}: {}".format(type(e).__name__, e))
+            finished(record)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted, rerun the command to resume")
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    return [s for s in scan_ids if s in unfinished]
+
+
+def _manifest_options(options):
+    """Return the options which change the output as stored in the manifest"""
+    keys = ("detector", "darks", "flat", "roi", "compression", "level")
+    return json.loads(json.dumps({k: options.get(k) for k in keys}))
+
+
+def run_batch(
+    scan_ids, catalog, output, workers=1, threads=None, resume=True, **options
+):
+    """Process scans with a pool of processes
+
+    If a worker dies (e.g. it is killed for lack of memory) the pool is
+    restarted for the scans which were not done. Scans which were running
+    when a pool broke twice are then processed one at a time, so a scan
+    which kills its worker is recorded as failed without failing the
+    others.
+
+    Parameters
+    ----------
+    scan_ids : list of int
+        Scans to process.
+    catalog : str
+        Name of the databroker catalog or ``"module:function"`` of a
+        function returning the catalog.
+    output : str
+        Directory of the output files and the manifest.
+    workers : int
+        Number of worker processes. With one worker the scans are
+        processed in this process.
+    threads : int, optional
+        Number of OpenMP threads of each worker. If `None`, the cores are
+        shared between the workers.
+    resume : bool
+        If true, skip the scans recorded as done in the manifest with the
+        same options.
+    options
+        Passed to :func:`process_scan`.
+
+    Returns
+    -------
+    dict
+        The manifest records of the processed scans by scan id.
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest = os.path.join(output, MANIFEST)
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // max(workers, 1))
+    options = dict(options, output=output)
+    manifest_options = _manifest_options(options)
+
+    todo = list(scan_ids)
+    if resume:
+        done = read_manifest(manifest)
+        todo = [
+            s
+            for s in scan_ids
+            if not (
+                s in done
+                and done[s]["status"] == "done"
+                and done[s].get("options") == manifest_options
+                and os.path.exists(done[s]["output"])
+            )
+        ]
+        if len(todo) < len(scan_ids):
+            logger.info("Skipping %d scans already done", len(scan_ids) - len(todo))
+
+    results = {}
+
+    def finished(record):
+        record["options"] = manifest_options
+        _append_manifest(manifest, record)
+        results[record["scan_id"]] = record
+        if record["status"] == "done":
+            logger.info(
+                "Scan %s done in %.1f seconds", record["scan_id"], record["wall_time"]
+            )
+        else:
+            logger.error("Scan %s failed: %s", record["scan_id"], record["error"])
+
+    if workers <= 1:
+        from .threads import num_threads
+
+        db = _open_catalog(catalog)
+        with num_threads(threads):
+            for scan_id in todo:
+                finished(_run(scan_id, options, db))
+        return results
+
+    lost = Counter()
+    while todo:
+        todo, running = _run_pool(todo, options, workers, catalog, threads, finished)
+        # The queued scans are not counted as they did not break the pool
+        lost.update(running)
+        alone = [s for s in todo if lost[s] > 1]
+        todo = [s for s in todo if lost[s] <= 1]
+        if alone:
+            logger.warning("Worker died, processing %d scans one at a time", len(alone))
+        for scan_id in alone:
+            if _run_pool([scan_id], options, 1, catalog, threads, finished)[0]:
+                finished(_failed(scan_id, "The worker process died"))
+
+    return results
+
+
+def _parse_roi(value):
+    roi = tuple(int(v) for v in value.split(","))
+    if len(roi) != 4:
+        raise argparse.ArgumentTypeError("The ROI must be x,y,w,h")
+    return roi
+
+
+def _parse_darks(value):
+    if value in ("auto", "none"):
+        return value
+    return tuple(int(v) if v else None for v in value.split(","))
+
+
+def main(argv=None):
+    """Entry point of the ``csxtools-batch`` command"""
+    parser = argparse.ArgumentParser(
+        prog="csxtools-batch",
+        description="Correct the detector images of many scans in parallel.",
+    )
+    parser.add_argument(
+        "scans", nargs="+", help="scan ids or inclusive ranges, e.g. 1000-1050 1100"
+    )
+    parser.add_argument(
+        "--catalog",
+        default="csx",
+        help="databroker catalog name or module:function returning a catalog",
+    )
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("--detector", default="fccd", help="detector name")
+    parser.add_argument(
+        "--darks",
+        type=_parse_darks,
+        default="auto",
+        help="'auto', 'none' or comma separated dark scan ids (gain 8,2,1)",
+    )
+    parser.add_argument(
+        "--flat", default="none", help="'auto', 'none' or a .npy flatfield file"
+    )
+    parser.add_argument("--roi", type=_parse_roi, help="ROI as x,y,w,h")
+    parser.add_argument(
+        "--compression",
+        default="gzip",
+        choices=["gzip", "lz4", "blosc", "none"],
+        help="compression of the output files",
+    )
+    parser.add_argument("--level", type=int, default=4, help="compression level")
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        help="read the AreaDetector files directly",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="OpenMP threads per worker (default: cores / workers)",
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="reprocess the scans already in the manifest",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(processName)s %(levelname)s %(message)s",
+    )
+    logger.setLevel(logging.INFO)
+
+    try:
+        scan_ids = parse_scan_ids(args.scans)
+    except ValueError as e:
+        parser.error(str(e))
+
+    t = ttime.time()
+    results = run_batch(
+        scan_ids,
+        args.catalog,
+        args.output,
+        workers=args.workers,
+        threads=args.threads,
+        resume=args.resume,
+        detector=args.detector,
+        darks=args.darks,
+        flat=args.flat,
+        roi=args.roi,
+        compression=None if args.compression == "none" else args.compression,
+        level=args.level,
+        direct=args.direct,
+    )
+
+    failed = sorted(s for s, r in results.items() if r["status"] != "done")
+    print(
+        "Processed {} scans in {:.1f} seconds: {} done, {} failed, {} skipped".format(
+            len(results),
+            ttime.time() - t,
+            len(results) - len(failed),
+            len(failed),
+            len(scan_ids) - len(results),
+        )
+    )
+    if failed:
+        print("Failed scans: {}".format(", ".join(str(s) for s in failed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""Run the corrections as dask graphs on a (distributed) cluster
+
+The functions of this module return dask arrays which correct, reduce and
+photon count the images of a run block by block when they are computed,
+with the local schedulers or on a ``dask.distributed`` cluster::
+
+    from dask.distributed import Client
+    from csxtools.distributed import correct_images, stack_mean
+
+    client = Client("scheduler:8786")
+    images = correct_images("fccd", light, (dark8, dark2, dark1))
+    mean = stack_mean(images).compute()
+
+The dark images, the flatfield and the gain map are the same for all the
+blocks. They are added to the graph once with :func:`broadcast` and, when
+a client is active, scattered to every worker so each worker receives
+them once instead of with every task.
+
+Each task calls the OpenMP routines with ``nthreads`` threads (one by
+default) as dask already runs a task per core; raise it for workers with
+fewer threads than cores.
+
+The ``distributed`` package is only needed to run on a cluster.
+"""
+
+from functools import partial
+
+import numpy as np
+
+from .pipeline import Pipeline, _crop, _raw_region
+from .io import read_images
+from .image import stacksum
+from .fastccd import adu_to_photons
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _default_client():
+    """Return the active dask.distributed client or `None`"""
+    try:
+        from distributed import get_client
+    except ImportError:
+        return None
+    try:
+        return get_client()
+    except ValueError:
+        return None
+
+
+def broadcast(data, client=None):
+    """Make an array a payload shared by all the tasks of a graph
+
+    Parameters
+    ----------
+    data : array_like or None
+        The payload (e.g. the dark images or the flatfield).
+    client : dask.distributed.Client, optional
+        Client to scatter the payload to all the workers with. If `None`,
+        use the active client if there is one.
+
+    Returns
+    -------
+    dask.delayed.Delayed
+        A single task holding the payload which can be passed to
+        ``map_blocks`` (`None` if ``data`` is `None`).
+    """
+    import dask
+
+    if data is None:
+        return None
+    if client is None:
+        client = _default_client()
+    if client is not None:
+        data = client.scatter(data, broadcast=True, hash=True)
+    return dask.delayed(data, traverse=False)
+
+
+def _as_frames(images):
+    """Rechunk a dask array of images so each block holds whole frames"""
+    return images.rechunk({images.ndim - 2: -1, images.ndim - 1: -1})
+
+
+def correct_images(
+    detector,
+    light_header,
+    dark_headers=None,
+    flat=None,
+    roi=None,
+    chunk_size=100,
+    client=None,
+    tag=None,
+    dark_reducer=None,
+    direct=False,
+    nthreads=1,
+    **options
+):
+    """Return a dask array of the corrected images of a run
+
+    The dark images are reduced (and cached) when this function is called,
+    the light images are read and corrected by the workers when the array
+    is computed. With ``direct`` the graph has a task reading each block
+    of frames from the AreaDetector files (see
+    :func:`csxtools.io.read_images`), so the workers need access to the
+    files but no images go through the client.
+
+    Parameters
+    ----------
+    detector : str or DetectorDescriptor
+        The detector (see :mod:`csxtools.pipeline`).
+    light_header : databroker header
+        The run to correct.
+    dark_headers : databroker header or tuple of headers, optional
+        The dark runs (see :meth:`csxtools.pipeline.Pipeline.darks`).
+    flat : array_like, optional
+        The flatfield.
+    roi : list, optional
+        ROI as (x0, y0, x1, y1).
+    chunk_size : int
+        Number of events read by each task with ``direct``, otherwise the
+        chunks of the images are kept.
+    client : dask.distributed.Client, optional
+        Client to scatter the dark images and flatfield with. If `None`,
+        use the active client if there is one.
+    tag : str, optional
+        Data key of the images. If `None`, use the tag of the detector.
+    dark_reducer : callable, optional
+        Function used to reduce the dark images.
+    direct : bool
+        If true, read the AreaDetector HDF5 files directly.
+    nthreads : int
+        Number of threads of each correction task.
+    options
+        Passed to the correction kernel of the detector.
+
+    Returns
+    -------
+    dask.array.Array
+        The corrected images.
+    """
+    pipe = Pipeline(
+        detector,
+        tag=tag,
+        dark_reducer=dark_reducer,
+        direct=direct,
+        nthreads=nthreads,
+    )
+    if direct:
+        # Each task reads its own frames from the files
+        bgnd = pipe.darks(dark_headers, roi)
+        region = partial(_raw_region, roi=roi) if roi is not None else None
+        events = read_images(
+            light_header,
+            pipe.tag,
+            nthreads=nthreads,
+            region=region,
+            lazy=True,
+            chunk_size=chunk_size,
+        )
+        if flat is not None and roi is not None:
+            flat = _crop(flat, roi)
+    else:
+        events, bgnd, flat = pipe.prepare(light_header, dark_headers, flat, roi)
+    events = _as_frames(events)
+    return pipe.correct_lazy(
+        events, broadcast(bgnd, client), broadcast(flat, client), **options
+    )
+
+
+def _partial_sum(block, nthreads):
+    block = np.ascontiguousarray(block, dtype=np.float32)
+    total, count = stacksum(block, norm=False, nthreads=nthreads)
+    return total.astype(np.float64), count.astype(np.int64)
+
+
+def _combine_sums(partials):
+    total = sum(p[0] for p in partials)
+    count = sum(p[1] for p in partials)
+    return total, count
+
+
+def _finish_mean(sums):
+    total, count = sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+    # As stackmean, pixels without values are zero
+    mean[count == 0] = 0
+    return mean.astype(np.float32)
+
+
+def stack_mean(images, split_every=8, nthreads=1):
+    """Return the mean image of a dask array of images ignoring NaNs
+
+    As :func:`csxtools.image.stackmean`, pixels which are NaN in all the
+    images are zero in the mean.
+
+    Each block is summed with :func:`csxtools.image.stacksum` where it is
+    computed and the partial sums and counts are added in a tree, so only
+    images of the size of a frame move between the workers.
+
+    Parameters
+    ----------
+    images : dask.array.Array
+        Images of shape (..., y, x).
+    split_every : int
+        Number of partial sums added by each task of the tree.
+    nthreads : int
+        Number of threads of each summing task.
+
+    Returns
+    -------
+    dask.array.Array
+        The mean image of shape (y, x).
+    """
+    import dask
+    import dask.array as da
+
+    if split_every < 2:
+        raise ValueError("split_every must be at least 2")
+
+    images = images.rechunk({images.ndim - 2: -1, images.ndim - 1: -1})
+    partials = [
+        dask.delayed(_partial_sum)(block, nthreads)
+        for block in images.to_delayed().ravel()
+    ]
+    while len(partials) > 1:
+        partials = [
+            dask.delayed(_combine_sums)(partials[i : i + split_every])
+            for i in range(0, len(partials), split_every)
+        ]
+    mean = dask.delayed(_finish_mean)(partials[0])
+    return da.from_delayed(mean, images.shape[-2:], dtype=np.float32)
+
+
+def count_photons(images, adu, gain=None, client=None, nthreads=1, **kwargs):
+    """Return a dask array of the number of photons of the images
+
+    Parameters
+    ----------
+    images : dask.array.Array
+        Corrected images of shape (..., y, x).
+    adu : float
+        Number of ADU per photon.
+    gain : array_like, optional
+        Relative gain of each pixel, broadcast to the workers once.
+    client : dask.distributed.Client, optional
+        Client to scatter the gain map with. If `None`, use the active
+        client if there is one.
+    nthreads : int
+        Number of threads of each conversion task.
+    kwargs
+        Passed to :func:`csxtools.fastccd.adu_to_photons`.
+
+    Returns
+    -------
+    dask.array.Array
+        The number of photons in each pixel.
+    """
+    if not hasattr(images, "map_blocks"):
+        raise ValueError("The images must be a dask array")
+    return adu_to_photons(
+        images, adu, gain=broadcast(gain, client), nthreads=nthreads, **kwargs
+    )
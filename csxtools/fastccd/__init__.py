@@ -1,7 +1,14 @@
-from .images import correct_images
-from .phocount import photon_count
+from .images import correct_images, correct_common_mode
+from .phocount import photon_count, adu_to_photons, fe55_gain_map, FE55_ENERGY
 
-__all__ = ["correct_images", "photon_count"]
+__all__ = [
+    "correct_images",
+    "correct_common_mode",
+    "photon_count",
+    "adu_to_photons",
+    "fe55_gain_map",
+    "FE55_ENERGY",
+]
 
 # set version string using versioneer
 from .._version import get_versions
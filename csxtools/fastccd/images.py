@@ -1,13 +1,14 @@
 import numpy as np
 from ..ext import fastccd
-import time as ttime
+from ..threads import resolve_nthreads
+from ..profiling import stage
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def correct_images(images, dark=None, flat=None, gain=(1, 4, 8)):
+def correct_images(images, dark=None, flat=None, gain=(1, 4, 8), nthreads=None):
     """Subtract backgrond and gain correct images
 
     This routine subtrtacts the backgrond and corrects the images
@@ -28,6 +29,9 @@ def correct_images(images, dark=None, flat=None, gain=(1, 4, 8)):
     gain : tuple, optional
         These are the gain multiplication factors for the three different
         gain settings
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -36,23 +40,78 @@ def correct_images(images, dark=None, flat=None, gain=(1, 4, 8)):
 
     """
 
-    t = ttime.time()
+    with stage("correct_images", images) as s:
+        logger.info("Correcting image stack of shape %s", images.shape)
 
-    logger.info("Correcting image stack of shape %s", images.shape)
+        if dark is None:
+            dark = np.zeros(images.shape[-2:], dtype=np.float32)
+            dark = np.array((dark, dark, dark))
+            logger.info("Not correcting for darkfield. No input.")
+        if flat is None:
+            flat = np.ones(images.shape[-2:], dtype=np.float32)
+            logger.info("Not correcting for flatfield. No input.")
+        else:
+            flat = np.asarray(flat, dtype=np.float32)
 
-    if dark is None:
-        dark = np.zeros(images.shape[-2:], dtype=np.float32)
-        dark = np.array((dark, dark, dark))
-        logger.info("Not correcting for darkfield. No input.")
-    if flat is None:
-        flat = np.ones(images.shape[-2:], dtype=np.float32)
-        logger.info("Not correcting for flatfield. No input.")
+        data = fastccd.correct_images(
+            images.astype(np.uint16), dark, flat, gain, resolve_nthreads(nthreads)
+        )
+        s.set_output(data)
+
+    logger.info("Corrected image stack in %.3f seconds", s.wall_time)
+
+    return data
+
+
+def correct_common_mode(images, mask=None, nchannels=1, axis="row", nthreads=None):
+    """Remove the common mode offset of the readout channels
+
+    This routine removes the per-row (or per-column) common mode noise of
+    the FastCCD. Each line of every image is split into ``nchannels``
+    equal segments (the readout channels) and the median of the pixels
+    selected by ``mask`` in each segment is subtracted from the segment.
+    Pixels which are ``np.nan`` are ignored.
+
+    Parameters
+    ----------
+    images : array_like
+        Input array of corrected images of shape (N, y, x) where N is the
+        number of images and x and y are the image size.
+    mask : array_like, optional
+        Boolean array of shape (y, x). Only pixels where the mask is true
+        (e.g. pixels without photons) are used to calculate the offset. If
+        `None` all pixels are used.
+    nchannels : int, optional
+        Number of readout channels along each line.
+    axis : string, optional
+        'row' to correct each row or 'column' to correct each column.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    array_like
+        Array of corrected images of shape (N, y, x)
+
+    """
+
+    if axis == "row":
+        axis = 0
+    elif axis == "column":
+        axis = 1
     else:
-        flat = np.asarray(flat, dtype=np.float32)
+        raise ValueError("axis must be 'row' or 'column'")
+
+    if mask is None:
+        mask = np.ones(images.shape[-2:], dtype=np.uint8)
 
-    data = fastccd.correct_images(images.astype(np.uint16), dark, flat, gain)
-    t = ttime.time() - t
+    with stage("correct_common_mode", images) as s:
+        data = fastccd.correct_common_mode(
+            images, mask, nchannels, axis, resolve_nthreads(nthreads)
+        )
+        s.set_output(data)
 
-    logger.info("Corrected image stack in %.3f seconds", t)
+    logger.info("Common mode correction took %.3f seconds", s.wall_time)
 
     return data
@@ -1,7 +1,15 @@
+from functools import partial
+
+import numpy as np
+
 from ..ext import phocount as ph
+from ..image import stacksum
+from ..threads import resolve_nthreads
 
 
-def photon_count(data, thresh, mean_filter, std_filter, nsum=3, nan=False):
+def photon_count(
+    data, thresh, mean_filter, std_filter, nsum=3, nan=False, nthreads=None
+):
     """Do single photon counting on CCD image
 
     This routine does single photon counting by cluster analysis. The image
@@ -27,6 +35,9 @@ def photon_count(data, thresh, mean_filter, std_filter, nsum=3, nan=False):
         photon. This should be 0 < nsum <= 9.
     nan : bool
         If true, replace empty pixels with ``np.nan``
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -36,4 +47,193 @@ def photon_count(data, thresh, mean_filter, std_filter, nsum=3, nan=False):
         photon hit. The second array is the standard deviation for the
         integrated intensity on each photon hit.
     """
-    return ph.count(data, thresh, mean_filter, std_filter, nsum, nan)
+    return ph.count(
+        data, thresh, mean_filter, std_filter, nsum, nan, resolve_nthreads(nthreads)
+    )
+
+
+_ROUNDING = {None: 0, "nearest": 1, "floor": 2, "ceil": 3, "trunc": 4}
+_PHOTON_DTYPES = (np.float32, np.int8, np.int16, np.int32)
+
+
+def adu_to_photons(
+    data,
+    adu,
+    rounding="nearest",
+    dtype=np.int16,
+    sentinel=None,
+    out=None,
+    nthreads=None,
+    gain=None,
+    frame_scale=None,
+):
+    """Convert CCD images from ADU to photons
+
+    The images are divided by the number of ADU per photon, rounded and
+    written to the output type in a single pass. Values outside the range
+    of an integer output type are clipped to the range.
+
+    The number of ADU per photon of each pixel of each image is
+    ``adu * frame_scale[frame] * gain[y, x]`` so the per pixel gain of the
+    detector (see :func:`fe55_gain_map`) and the photon energy of each
+    image (e.g. for an energy scan) are applied in the same pass.
+
+    Parameters
+    ----------
+    data : array_like
+        Stack of images of shape (..., y, x). If a dask array, the
+        conversion is made block by block when the array is computed.
+    adu : float
+        Number of ADU per photon.
+    rounding : str or None
+        How to round the number of photons, ``"nearest"`` (half to even
+        as :func:`numpy.round`), ``"floor"``, ``"ceil"``, ``"trunc"`` or
+        `None` (integer outputs are then truncated).
+    dtype : numpy dtype
+        Type of the output, one of float32, int8, int16 or int32.
+    sentinel : number, optional
+        Value of the pixels which are NaN in the input (or in the gain
+        map). If `None`, use -1 for integer outputs and NaN for float32.
+    out : array, optional
+        C-contiguous array of the shape of ``data`` and of type ``dtype``
+        to write the photons to.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+    gain : array_like, optional
+        Relative gain of each pixel of shape (y, x). Pixels with a gain
+        of NaN are set to ``sentinel``.
+    frame_scale : array_like, optional
+        Scale of the ADU per photon of each image, e.g. the photon energy
+        of each image divided by the energy ``adu`` is given for. The
+        array is broadcast against the leading (non image) axes of
+        ``data`` aligned on the first axis, so a value per event can be
+        given for a stack of shape (events, frames, y, x).
+
+    Returns
+    -------
+    array_like
+        The number of photons in each pixel.
+    """
+    if rounding not in _ROUNDING:
+        raise ValueError("Unknown rounding {!r}".format(rounding))
+    dtype = np.dtype(out.dtype if out is not None else dtype)
+    if dtype not in [np.dtype(t) for t in _PHOTON_DTYPES]:
+        raise ValueError("The output must be of type float32, int8, int16 or int32")
+    if sentinel is None:
+        sentinel = np.nan if dtype.kind == "f" else -1
+
+    kwargs = dict(
+        adu=adu, rounding=rounding, dtype=dtype, sentinel=sentinel, nthreads=nthreads
+    )
+
+    if hasattr(data, "map_blocks"):
+        if out is not None:
+            raise ValueError("Cannot write the photons of a dask array to out")
+        if gain is None and frame_scale is None:
+            return data.map_blocks(partial(adu_to_photons, **kwargs), dtype=dtype)
+        return _adu_to_photons_lazy(data, gain, frame_scale, kwargs)
+
+    if frame_scale is not None:
+        frame_scale = _frame_scale(frame_scale, np.shape(data)[:-2])
+    if out is None:
+        out = np.empty(np.shape(data), dtype=dtype)
+    return ph.convert(
+        data,
+        out,
+        adu,
+        _ROUNDING[rounding],
+        sentinel,
+        gain,
+        frame_scale,
+        resolve_nthreads(nthreads),
+    )
+
+
+def _frame_scale(scale, frame_shape):
+    """Broadcast a scale per frame aligned on the first axis to frame_shape"""
+    scale = np.asarray(scale, dtype=np.float32)
+    if scale.ndim > len(frame_shape):
+        raise ValueError("The frame scale has more dimensions than the stack")
+    scale = scale.reshape(scale.shape + (1,) * (len(frame_shape) - scale.ndim))
+    return np.ascontiguousarray(np.broadcast_to(scale, frame_shape))
+
+
+def _adu_to_photons_lazy(data, gain, frame_scale, kwargs):
+    """Convert a dask array of whole frames with a gain map or frame scale"""
+    import dask.array as da
+
+    # The gain is passed to map_blocks (not bound) so it can be a dask
+    # delayed payload shared by all the blocks (see csxtools.distributed)
+    data = data.rechunk({data.ndim - 2: -1, data.ndim - 1: -1})
+    if frame_scale is None:
+        return data.map_blocks(
+            _convert_block, None, gain=gain, dtype=kwargs["dtype"], kwargs=kwargs
+        )
+
+    scale = _frame_scale(frame_scale, data.shape[:-2])[..., np.newaxis, np.newaxis]
+    scale = da.from_array(scale, chunks=data.chunks[:-2] + ((1,), (1,)))
+    return da.map_blocks(
+        _convert_block, data, scale, gain=gain, dtype=kwargs["dtype"], kwargs=kwargs
+    )
+
+
+def _convert_block(block, scale, gain, kwargs):
+    if scale is not None:
+        scale = scale[..., 0, 0]
+    return adu_to_photons(block, gain=gain, frame_scale=scale, **kwargs)
+
+
+# Energy (eV) of the Mn K-alpha photons of an Fe55 source
+FE55_ENERGY = 5895.0
+
+
+def fe55_gain_map(
+    images,
+    thresh,
+    mean_filter,
+    std_filter=(0, np.inf),
+    nsum=3,
+    min_hits=10,
+    nthreads=None,
+):
+    """Calculate the gain map of a CCD from Fe55 calibration images
+
+    The photons in the images are found with :func:`photon_count` and the
+    ADU of the photons hitting each pixel are summed over the stack with
+    :func:`csxtools.image.stacksum`. The gain of a pixel is its mean ADU
+    per photon relative to the median over the detector.
+
+    Parameters
+    ----------
+    images : array_like
+        Stack of dark subtracted Fe55 images of shape (N, y, x).
+    thresh, mean_filter, std_filter, nsum :
+        Photon finding parameters (see :func:`photon_count`). The
+        ``mean_filter`` selects the K-alpha peak of the photon histogram.
+    min_hits : int
+        Minimum number of photons for the gain of a pixel. Pixels with
+        less are NaN in the gain map.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    tuple
+        The relative gain map of shape (y, x) and the median number of
+        ADU per Fe55 photon. The ADU per photon at an energy E is this
+        times ``E / FE55_ENERGY``.
+    """
+    hits, _ = photon_count(
+        images, thresh, mean_filter, std_filter, nsum, nan=True, nthreads=nthreads
+    )
+    total, count = stacksum(hits, norm=False, nthreads=nthreads)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+    mean[count < max(min_hits, 1)] = np.nan
+
+    if not np.any(np.isfinite(mean)):
+        raise ValueError("No pixels with at least {} photons".format(min_hits))
+    adu = float(np.nanmedian(mean))
+    return (mean / adu).astype(np.float32), adu
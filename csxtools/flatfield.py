@@ -0,0 +1,413 @@
+import os
+import json
+import datetime
+import tempfile
+import time as ttime
+from contextlib import contextmanager
+
+import numpy as np
+
+from .image import StackAccumulator
+from .pipeline import Pipeline
+from .settings import detectors
+from . import settings
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_INDEX = "index.json"
+
+
+def _to_timestamp(value):
+    """Convert a time (UNIX timestamp, datetime or ISO string) to a float"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on the store while updating the index"""
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover (not on posix)
+        yield
+        return
+
+    with open(os.path.join(path, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FlatfieldStore(object):
+    """Versioned flatfields stored on local disk
+
+    The flatfields are stored as ``.npz`` files in a single directory
+    together with an index (``index.json``) which records for each
+    detector the versions and the range of time ``[start, end)`` for which
+    each one is valid. Saving a flatfield never overwrites an existing
+    one; it adds a new version which takes precedence over the older ones
+    for the times it covers. The index is replaced atomically so many jobs
+    can read the store while it is updated.
+
+    Parameters
+    ----------
+    path : str, optional
+        Directory of the store. If `None`, use
+        ``csxtools.settings.flatfield_dir`` which is set from the
+        ``CSXTOOLS_FLATFIELD_DIR`` environment variable (defaults to
+        ``~/.csxtools/flatfields``).
+
+    Example
+    -------
+    >>> store = FlatfieldStore()
+    >>> store.save(flat, "fccd", start="2026-01-01")
+    >>> flat = store.load("fccd", header.start["time"])
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = settings.flatfield_dir
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def __repr__(self):
+        return "FlatfieldStore({!r})".format(self.path)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, _INDEX)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(tmp, os.path.join(self.path, _INDEX))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def entries(self, detector=None):
+        """Return the index entries (dicts) of the stored flatfields
+
+        Parameters
+        ----------
+        detector : str, optional
+            Only return the entries of this detector.
+
+        Returns
+        -------
+        list
+            The entries ordered by detector and version.
+        """
+        index = self._read_index()
+        if detector is not None:
+            return list(index.get(detector, []))
+        return [e for d in sorted(index) for e in index[d]]
+
+    def save(
+        self,
+        flat,
+        detector,
+        start,
+        end=None,
+        runs=None,
+        variance=None,
+        metadata=None,
+    ):
+        """Store a new version of the flatfield of a detector
+
+        Parameters
+        ----------
+        flat : array_like
+            The flatfield (2D array).
+        detector : str
+            Name of the detector (e.g. ``"fccd"``).
+        start : float, datetime or str
+            Start of the time range the flatfield is valid for as a UNIX
+            timestamp, a datetime or an ISO 8601 string.
+        end : float, datetime or str, optional
+            End of the time range (exclusive). If `None`, the flatfield is
+            valid for all times after ``start``.
+        runs : list of str, optional
+            Identifiers (e.g. uids) of the runs the flatfield was
+            calculated from.
+        variance : array_like, optional
+            Per pixel variance of the flatfield statistics, stored with
+            the flatfield.
+        metadata : dict, optional
+            Additional (JSON serialisable) metadata.
+
+        Returns
+        -------
+        int
+            The version number of the stored flatfield.
+        """
+        flat = np.asarray(flat)
+        if flat.ndim != 2:
+            raise ValueError("The flatfield must be a 2D array")
+        start = _to_timestamp(start)
+        end = _to_timestamp(end)
+        if end is not None and end <= start:
+            raise ValueError("The end time must be after the start time")
+
+        arrays = {"flat": flat}
+        if variance is not None:
+            variance = np.asarray(variance)
+            if variance.shape != flat.shape:
+                raise ValueError("The variance must be the shape of the flatfield")
+            arrays["variance"] = variance
+
+        os.makedirs(self.path, exist_ok=True)
+        with _locked(self.path):
+            index = self._read_index()
+            versions = index.setdefault(detector, [])
+            version = max([e["version"] for e in versions], default=0) + 1
+            filename = "{}_v{}.npz".format(detector, version)
+
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".npz")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, os.path.join(self.path, filename))
+
+            versions.append(
+                {
+                    "version": version,
+                    "file": filename,
+                    "start": start,
+                    "end": end,
+                    "runs": list(runs) if runs is not None else [],
+                    "shape": list(flat.shape),
+                    "created": ttime.time(),
+                    "metadata": metadata if metadata is not None else {},
+                }
+            )
+            self._write_index(index)
+
+        logger.info("Stored flatfield %s version %d", detector, version)
+        return version
+
+    def find(self, detector, time=None):
+        """Find the flatfield of a detector valid at a time
+
+        Parameters
+        ----------
+        detector : str
+            Name of the detector.
+        time : float, datetime or str, optional
+            Time the flatfield must be valid for. If `None`, return the
+            latest version.
+
+        Returns
+        -------
+        dict or None
+            The index entry of the latest version valid at ``time`` or
+            `None` if there is none.
+        """
+        versions = self.entries(detector)
+        if time is not None:
+            time = _to_timestamp(time)
+            versions = [
+                e
+                for e in versions
+                if e["start"] <= time and (e["end"] is None or time < e["end"])
+            ]
+        if not versions:
+            return None
+        return max(versions, key=lambda e: e["version"])
+
+    def load(self, detector, time=None, version=None, variance=False):
+        """Load a stored flatfield
+
+        Parameters
+        ----------
+        detector : str
+            Name of the detector.
+        time : float, datetime or str, optional
+            Load the latest version valid at this time.
+        version : int, optional
+            Load this version (``time`` is then ignored).
+        variance : bool
+            If true, also return the stored variance (or `None`).
+
+        Returns
+        -------
+        array_like
+            The flatfield (and the variance if ``variance`` is true).
+        """
+        if version is not None:
+            entry = [e for e in self.entries(detector) if e["version"] == version]
+            entry = entry[0] if entry else None
+        else:
+            entry = self.find(detector, time)
+
+        if entry is None:
+            raise ValueError(
+                "No flatfield for detector {!r} (time={}, version={}) in {}".format(
+                    detector, time, version, self.path
+                )
+            )
+
+        logger.info("Loading flatfield %s version %d", detector, entry["version"])
+        with np.load(os.path.join(self.path, entry["file"])) as data:
+            flat = data["flat"]
+            var = data["variance"] if "variance" in data.files else None
+        if variance:
+            return flat, var
+        return flat
+
+
+class FlatfieldAccumulator(object):
+    """Calculate a flatfield from several fluorescence runs
+
+    The corrected images of each run are streamed through a
+    :class:`csxtools.image.StackAccumulator` so the runs are never held in
+    memory. The runs are combined into a (weighted) mean and variance from
+    which the flatfield is calculated with
+    :func:`csxtools.utils.calculate_flatfield`.
+
+    Parameters
+    ----------
+    detector : str
+        Name of the detector, a key of ``csxtools.settings.detectors``.
+    limits : tuple
+        Lower and upper bound of the normalised flatfield (see
+        :func:`csxtools.utils.calculate_flatfield`).
+    half_interval : bool or tuple
+        Rows to exclude (see :func:`csxtools.utils.get_fastccd_flatfield`).
+    chunk_size : int
+        Number of events read and corrected at once.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Example
+    -------
+    >>> acc = FlatfieldAccumulator("fccd")
+    >>> for light, darks in runs:
+    ...     acc.add_run(light, darks)
+    >>> acc.save(FlatfieldStore(), start="2026-01-01")
+    """
+
+    def __init__(
+        self,
+        detector="fccd",
+        limits=(0.6, 1.4),
+        half_interval=False,
+        chunk_size=100,
+        nthreads=None,
+    ):
+        if detector not in detectors:
+            raise ValueError("Unknown detector {!r}".format(detector))
+        self.detector = detector
+        self.limits = limits
+        self.half_interval = half_interval
+        self.chunk_size = chunk_size
+        self.nthreads = nthreads
+        self.runs = []
+        self._acc = StackAccumulator(variance=True, nthreads=nthreads)
+
+    def add_run(self, light, dark=None, flat=None, weight=1.0):
+        """Add the images of a run
+
+        Parameters
+        ----------
+        light : databroker header
+            The header containing the light images.
+        dark : databroker header(s)
+            The header(s) of the dark images.
+        flat : array_like, optional
+            Initial flatfield to correct the images with.
+        weight : float
+            Weight of the frames of this run.
+        """
+        acc = StackAccumulator(variance=True, nthreads=self.nthreads)
+        Pipeline(self.detector, nthreads=self.nthreads).accumulate(
+            acc, light, dark, flat, chunk_size=self.chunk_size
+        )
+        self._acc.merge(acc, weight)
+        self.runs.append(light.start["uid"])
+
+    def add_images(self, images, weight=1.0, run=None):
+        """Add a stack of corrected images of shape (..., y, x)
+
+        Parameters
+        ----------
+        images : array_like
+            The corrected images.
+        weight : float
+            Weight of the frames.
+        run : str, optional
+            Identifier of the run the images are from.
+        """
+        acc = StackAccumulator(variance=True, nthreads=self.nthreads)
+        acc.update(images)
+        self._acc.merge(acc, weight)
+        if run is not None:
+            self.runs.append(run)
+
+    @property
+    def count(self):
+        """Number (sum of weights) of frames of each pixel"""
+        return self._acc.count
+
+    @property
+    def mean(self):
+        """Mean image"""
+        return self._acc.mean
+
+    @property
+    def var(self):
+        """Variance image"""
+        return self._acc.var
+
+    @property
+    def uncertainty(self):
+        """Standard error of the mean image"""
+        if self.count is None:
+            return None
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(self.var / self.count).astype(np.float32)
+
+    def flatfield(self):
+        """Calculate the flatfield from the accumulated images"""
+        from .utils import _finish_flatfield
+
+        if self.count is None:
+            raise ValueError("No images have been accumulated")
+        return _finish_flatfield(self.mean, self.limits, self.half_interval)
+
+    def save(self, store, start, end=None, metadata=None):
+        """Calculate the flatfield and store it in a :class:`FlatfieldStore`
+
+        The variance of the images is stored with the flatfield (rotated to
+        the orientation of the flatfield).
+
+        Returns
+        -------
+        int
+            The version number of the stored flatfield.
+        """
+        md = {"limits": list(self.limits)}
+        if metadata is not None:
+            md.update(metadata)
+        return store.save(
+            self.flatfield(),
+            self.detector,
+            start,
+            end,
+            runs=self.runs,
+            variance=np.rot90(self.var),
+            metadata=md,
+        )
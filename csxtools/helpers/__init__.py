@@ -7,6 +7,7 @@ from .fastccd import (
     convert_photons,
 )
 from .overscan import get_os_correction_images, get_os_dropped_images
+from .config import FastCCDConfig, get_fastccd_config, clear_config_cache
 
 __all__ = [
     "get_dark_near",
@@ -17,6 +18,9 @@ __all__ = [
     "convert_photons",
     "get_os_correction_images",
     "get_os_dropped_images",
+    "FastCCDConfig",
+    "get_fastccd_config",
+    "clear_config_cache",
 ]
 
 # set version string using versioneer
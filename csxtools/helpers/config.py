@@ -0,0 +1,115 @@
+from collections import OrderedDict
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Configurations are kept for the most recently used runs
+_config_cache = OrderedDict()
+_CONFIG_CACHE_SIZE = 256
+
+
+class FastCCDConfig(object):
+    """Cached FastCCD configuration of a run
+
+    The documents of the run are fetched from the catalog the first time
+    they are needed and kept, so the helper functions can query the
+    configuration of a run as often as they like. Use
+    :func:`get_fastccd_config` to share the configuration of a run between
+    calls.
+
+    Parameters
+    ----------
+    header : databroker header
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self._start = None
+        self._stop = None
+        self._configuration = None
+        self._table = None
+
+    @property
+    def start(self):
+        """Start document of the run"""
+        if self._start is None:
+            self._start = self.header.start
+        return self._start
+
+    @property
+    def stop(self):
+        """Stop document of the run (an empty dict if the run has none)
+
+        A missing stop document is not cached as the run may still be
+        running; it is fetched again the next time.
+        """
+        if self._stop is None:
+            stop = getattr(self.header, "stop", None)
+            if not stop:
+                return {}
+            self._stop = stop
+        return self._stop
+
+    @property
+    def uid(self):
+        return self.start["uid"]
+
+    @property
+    def configuration(self):
+        """FastCCD configuration of the first descriptor
+
+        This is empty for runs prior to mid 2017.
+        """
+        if self._configuration is None:
+            self._configuration = self.header.descriptors[0]["configuration"]["fccd"][
+                "data"
+            ]
+        return self._configuration
+
+    @property
+    def table(self):
+        """Table of the primary stream (fetched once)"""
+        if self._table is None:
+            self._table = self.header.table()
+        return self._table
+
+    def get(self, key, default=None):
+        """Return a value of the FastCCD configuration"""
+        return self.configuration.get(key, default)
+
+    @property
+    def acquire_time(self):
+        return self.configuration["fccd_cam_acquire_time"]
+
+
+def get_fastccd_config(header):
+    """Return the cached :class:`FastCCDConfig` of a run
+
+    The configurations are cached by the uid of the run, so different
+    header objects of the same run share it.
+
+    Parameters
+    ----------
+    header : databroker header
+
+    Returns
+    -------
+    FastCCDConfig
+    """
+    uid = header.start["uid"]
+    try:
+        config = _config_cache[uid]
+    except KeyError:
+        config = FastCCDConfig(header)
+        _config_cache[uid] = config
+        while len(_config_cache) > _CONFIG_CACHE_SIZE:
+            _config_cache.popitem(last=False)
+    else:
+        _config_cache.move_to_end(uid)
+    return config
+
+
+def clear_config_cache():
+    """Remove all the cached configurations"""
+    _config_cache.clear()
@@ -8,7 +8,9 @@ from ipywidgets import (
 )  # TODO move this and general utility to different module later
 
 from csxtools.utils import get_fastccd_images, get_images_to_4D
+from csxtools.fastccd import correct_common_mode, adu_to_photons
 from csxtools.helpers.overscan import get_os_correction_images, get_os_dropped_images
+from csxtools.helpers.config import get_fastccd_config
 
 logger = logging.getLogger(__name__)
 
@@ -39,15 +41,14 @@ def find_possible_darks(
     db=None,
 ):
     darks_possible = {"scan": [], "exp_time": [], "delta_time": []}
-    start_time = header.start["time"]
-    stop_time = header.stop["time"]
+    config = get_fastccd_config(header)
+    start_time = config.start["time"]
+    stop_time = config.stop["time"]
     if (
-        header.stop["exit_status"] != "abort"
+        config.stop["exit_status"] != "abort"
     ):  # because the key is missing from descriptors, was never recorded
         # try:
-        exp_time = header.descriptors[0]["configuration"]["fccd"]["data"][
-            "fccd_cam_acquire_time"
-        ]
+        exp_time = config.acquire_time
         # except:
         # print(header.start["scan_id"])
         # raise
@@ -59,13 +60,9 @@ def find_possible_darks(
         **{"fccd.gain": dark_gain},
     )
     data = [
-        [
-            h.start["scan_id"],
-            h.descriptors[0]["configuration"]["fccd"]["data"]["fccd_cam_acquire_time"],
-            start_time - h.start["time"],
-        ]
-        for h in hhs
-        if getattr(h, "stop", {}).get("exit_status", "not done") == "success"
+        [c.start["scan_id"], c.acquire_time, start_time - c.start["time"]]
+        for c in map(get_fastccd_config, hhs)
+        if c.stop.get("exit_status", "not done") == "success"
     ]
 
     hhs = db(
@@ -76,15 +73,9 @@ def find_possible_darks(
     )
     data.extend(
         [
-            [
-                h.start["scan_id"],
-                h.descriptors[0]["configuration"]["fccd"]["data"][
-                    "fccd_cam_acquire_time"
-                ],
-                h.stop["time"] - stop_time,
-            ]
-            for h in hhs
-            if getattr(h, "stop", {}).get("exit_status", "not done") == "success"
+            [c.start["scan_id"], c.acquire_time, c.stop["time"] - stop_time]
+            for c in map(get_fastccd_config, hhs)
+            if c.stop.get("exit_status", "not done") == "success"
         ]
     )
     data = np.array(data)
@@ -165,7 +156,7 @@ def get_fastccd_roi(header, roi_number):
       name    : string, name assigned by user in ROI (optional)
 
     """
-    config = header.descriptors[0]["configuration"]["fccd"]["data"]
+    config = get_fastccd_config(header).configuration
     if config == {}:  # prior to mid 2017
         x_start, x_size, y_start, y_size = None
         logger.warning("Meta data does not exist.")
@@ -196,13 +187,15 @@ def get_fastccd_exp(header):
       num_images  : int, number of images per "point".
 
     """
-    config = header.descriptors[0]["configuration"]["fccd"]["data"]
+    cached = get_fastccd_config(header)
+    config = cached.configuration
     if config == {}:  # prior to mid 2017
         # this is done because of deprecated gs.DETS and replaced by descriptors.  i don't know if db v2 and tiled even handle this okay.
         # when we delete data from 2017 we can just delete this part of the code
-        exp_t = header.table().get("fccd_acquire_time")[1]
-        exp_p = header.table().get("fccd_acquire_period")[1]
-        exp_im = header.table().get("fccd_num_images")[1]
+        table = cached.table  # fetched once for the three columns
+        exp_t = table.get("fccd_acquire_time")[1]
+        exp_p = table.get("fccd_acquire_period")[1]
+        exp_im = table.get("fccd_num_images")[1]
     else:  # After mid 2017
         exp_t = config["fccd_cam_acquire_time"]
         exp_p = config["fccd_cam_acquire_period"]
@@ -228,7 +221,7 @@ def get_fastccd_pixel_readout(header):
       row_offset    : int, unused virtual pixels to be removed, as instituted by FCCD plugin for EPICS AreaDectector
 
     """
-    config = header.descriptors[0]["configuration"]["fccd"]["data"]
+    config = get_fastccd_config(header).configuration
     try:
         overscan_cols = config["fccd_cam_overscan_cols"]  # this is hardware config
     except:  # noqa: E722
@@ -256,6 +249,7 @@ def get_fastccd_images_sized(
     auto_overscan=True,
     return_overscan_array=False,
     drop_overscan=True,
+    common_mode=None,
 ):
     """Normalazied images with proper concatenation and overscan data by calling get_fastccd_images
     Parameters
@@ -287,6 +281,12 @@ def get_fastccd_images_sized(
         If auto_overscan False, choose to keep or drop the overscan data from
         the returned data images
 
+    common_mode : dict or bool
+        If not `None` (or `False`) remove the per-line common mode offset
+        of the readout channels after the overscan correction using
+        csxtools.fastccd.correct_common_mode(). A dict is passed as keyword
+        arguments (e.g. ``mask``, ``nchannels``) and the mask must match
+        the shape of the returned images.
 
 
     Returns
@@ -406,6 +406,13 @@ def get_fastccd_images_sized(
         auto_os_drop_performed = False
         auto_os_correct_performed = False
 
+    if common_mode is True:
+        common_mode = {}
+    elif common_mode is False:
+        common_mode = None
+    if common_mode is not None:
+        images = correct_common_mode(images, **common_mode)
+
     if return_overscan_array:
         return (
             images,
@@ -430,38 +437,74 @@ def convert_photons(
     quantize_photons=True,
     make_int_strip_nan=True,
     round_to_tens=True,
+    dtype=np.int16,
+    sentinel=-1,
+    out=None,
+    nthreads=None,
+    gain_map=None,
+    per_frame_energy=False,
 ):
     """Convert ADU to photons based on incident beamline energy.  FCCD #2 found to be ~30 ADU fro 930eV (ideally 25 ADU).
     Quantized to photons may be problematic in the realm of 4 photon events per pixel. We should add some histogram information.
 
+    The conversion is made in one pass by csxtools.fastccd.adu_to_photons() and
+    works block by block on dask arrays.
+
     Parameters
     ----------
-    images_input : numpy array
-    energy       : float, incident photon energy
+    images_input : numpy array or dask array
+    energy       : float or array, incident photon energy
 
     quantize_photons   : rounds pixel values to one's place. returns float or int based on make_int_strip_nan
-    make_int_strip_nan : converts rounded pixel values to integers and then NaNs are very near zero
+    make_int_strip_nan : writes rounded pixel values as integers of type dtype with NaNs replaced by sentinel
+    dtype              : integer type (int8, int16 or int32) used if make_int_strip_nan
+    sentinel           : value of NaN pixels if make_int_strip_nan
+    out                : optional array of the shape of images_input to write the photons to
+    nthreads           : number of threads, if None use csxtools.set_num_threads()
+    gain_map           : optional relative gain of each pixel, e.g. from csxtools.fastccd.fe55_gain_map()
+    per_frame_energy   : if True, energy is the energy of each event (or frame) instead of
+                         being averaged over the scan, e.g. for energy scans. round_to_tens
+                         is then ignored so the ADU per photon follows the energy smoothly
 
     Returns
     -------
     images_output : numpy array converted to photons
+    ADUpPH        : ADU per photon (an array if per_frame_energy)
 
-    #TODO seems to retain nan's need to use a mask to prevent pixels with nan
     #TODO do more testing to make sure rounding is alway appropriate scheme (or at all)
     #TODO it seems that simple rounding creates +/- 4 photon error around "zero" photons
     """
-    if round_to_tens:
-        ADUpPH = round(
-            ADU_930 * np.nanmean(energy) / 930, -1
+    if not per_frame_energy:
+        energy_used = np.nanmean(energy)
+    else:
+        energy_used = np.asarray(energy, dtype=np.float64)
+    if round_to_tens and not per_frame_energy:
+        ADUpPH = np.round(
+            ADU_930 * energy_used / 930, -1
         )  # TODO should be ok and more consistent, but need to check with energyscans,
     else:
-        ADUpPH = round(ADU_930 * np.nanmean(energy) / 930, 2)
-    images_input = images_input / ADUpPH
-    if quantize_photons:
-        if make_int_strip_nan:
-            images_output = np.round(images_input).astype("int")
-        else:
-            images_output = np.round(images_input)
+        ADUpPH = np.round(ADU_930 * energy_used / 930, 2)
+
+    if per_frame_energy:
+        adu, frame_scale = 1.0, ADUpPH
     else:
-        images_output = images_input
+        ADUpPH = float(ADUpPH)
+        adu, frame_scale = ADUpPH, None
+
+    if quantize_photons and make_int_strip_nan:
+        rounding = "nearest"
+    else:
+        rounding = "nearest" if quantize_photons else None
+        dtype, sentinel = np.float32, None
+    images_output = adu_to_photons(
+        images_input,
+        adu,
+        rounding,
+        dtype,
+        sentinel,
+        out=out,
+        nthreads=nthreads,
+        gain=gain_map,
+        frame_scale=frame_scale,
+    )
     return images_output, energy, ADU_930, ADUpPH
@@ -1,23 +1,30 @@
-from .transform import rotate90
+from .transform import rotate90, bin_stack
 from .stack import (
     stackmean,
     stacksum,
     stackvar,
     stackstderr,
     stackstd,
+    stackmedian,
+    stackclipmean,
     images_mean,
     images_sum,
+    StackAccumulator,
 )
 
 __all__ = [
     "rotate90",
+    "bin_stack",
     "stackmean",
     "stacksum",
     "stackvar",
     "stackstderr",
     "stackstd",
+    "stackmedian",
+    "stackclipmean",
     "images_mean",
     "images_sum",
+    "StackAccumulator",
 ]
 
 # set version string using versioneer
@@ -1,40 +1,74 @@
 import numpy as np
 from ..ext import image as extimage
+from ..threads import resolve_nthreads
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def stackmean(array):
+def _stackprocess(array, mode, axis, nthreads):
+    """Call the C stack reduction over the requested leading axes"""
+    if axis is None:
+        return extimage.stackprocess(array, mode, resolve_nthreads(nthreads))
+
+    array = np.asanyarray(array)
+    ndim = array.ndim
+    if ndim < 3:
+        raise ValueError("Input array must have at least 3 dimensions")
+
+    if np.isscalar(axis):
+        axis = (axis,)
+    axes = sorted(a + ndim if a < 0 else a for a in axis)
+    if len(set(axes)) != len(axes):
+        raise ValueError("Repeated axis in {}".format(axis))
+    if not axes or axes[0] < 0 or axes[-1] >= (ndim - 2):
+        raise ValueError("axis must only contain the axes before the image axes")
+
+    # Move the reduced axes to just before the image. If they are already
+    # there this is a view and no copy is made.
+    naxes = len(axes)
+    array = np.moveaxis(array, axes, range(ndim - 2 - naxes, ndim - 2))
+
+    return extimage.stackprocess(array, mode, resolve_nthreads(nthreads), naxes)
+
+
+def stackmean(array, axis=None, nthreads=None):
     """Cacluate the mean of a stack
 
     This function calculates the mean of a stack of images (or any array).
     It ignores values that are np.NAN and does not include them in the mean
     calculation. It assumes an array of shape (.. i, j, x, y) where x and y
-    are the size of the returned array (x, y).
+    are the size of the returned array (.., x, y).
 
     Parameters
     ----------
     array : array_like
         Input array of at least 3 dimensions.
+    axis : int or tuple of ints, optional
+        Axes to reduce. These must be axes before the last two (image)
+        axes, the remaining leading axes are kept in the output. If `None`
+        all the leading axes are reduced.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
     array
-        2D Array of mean of stack.
+        Array of mean of stack. This is 2D unless ``axis`` is given.
     """
-    X, Y = extimage.stackprocess(array, 1)
+    X, Y = _stackprocess(array, 1, axis, nthreads)
     return X
 
 
-def stacksum(array, norm=True):
+def stacksum(array, norm=True, axis=None, nthreads=None):
     """Cacluate the sum of a stack
 
     This function calculates the sum of a stack of images (or any array).
     It ignores values that are np.NAN and does not include them in the sum
     calculation. It assumes an array of shape (.. i, j, x, y) where x and y
-    are the size of the returned array (x, y).
+    are the size of the returned array (.., x, y).
 
     The output sum is corrected for elements where NaNs are encountered if
     norm is set to True.  The values are renormalized to a sum which would
@@ -49,38 +83,52 @@ def stacksum(array, norm=True):
     ----------
     array : array_like
         Input array of at least 3 dimensions.
+    axis : int or tuple of ints, optional
+        Axes to reduce. These must be axes before the last two (image)
+        axes, the remaining leading axes are kept in the output. If `None`
+        all the leading axes are reduced.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
     tuple
         tuple of 2 arrays of the sum and number of points in the sum
     """
-    X, Y = extimage.stackprocess(array, 0)
+    X, Y = _stackprocess(array, 0, axis, nthreads)
 
     if norm:
         # Set zero values to NaN
         _Y = Y.astype(np.float32)
         _Y[Y == 0] = np.nan
 
-        total_elements = array.size / (array.shape[-1] * array.shape[-2])
+        total_elements = array.size / X.size
 
         X = X * (total_elements / _Y)
 
     return X, Y
 
 
-def stackstd(array):
+def stackstd(array, axis=None, nthreads=None):
     """Cacluate the standard deviation of a stack
 
     This function calculates the standard deviation of a stack of images
     It ignores values that are np.NAN and does not include them in the sum
     calculation. It assumes an array of shape (.. i, j, x, y) where x and y
-    are the size of the returned array (x, y).
+    are the size of the returned array (.., x, y).
 
     Parameters
     ----------
     array : array_like
         Input array of at least 3 dimensions.
+    axis : int or tuple of ints, optional
+        Axes to reduce. These must be axes before the last two (image)
+        axes, the remaining leading axes are kept in the output. If `None`
+        all the leading axes are reduced.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -88,22 +136,29 @@ def stackstd(array):
         tuple of 2 arrays of the standard deviation and number of points
         in the calculation
     """
-    X, Y = extimage.stackprocess(array, 3)
+    X, Y = _stackprocess(array, 3, axis, nthreads)
     return X, Y
 
 
-def stackvar(array):
+def stackvar(array, axis=None, nthreads=None):
     """Cacluate the varience of a stack
 
     This function calculates the variance of a stack of images (or any array).
     It ignores values that are np.NAN and does not include them in the
     calculation. It assumes an array of shape (.. i, j, x, y) where x and y
-    are the size of the returned array (x, y).
+    are the size of the returned array (.., x, y).
 
     Parameters
     ----------
     array : array_like
         Input array of at least 3 dimensions.
+    axis : int or tuple of ints, optional
+        Axes to reduce. These must be axes before the last two (image)
+        axes, the remaining leading axes are kept in the output. If `None`
+        all the leading axes are reduced.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -111,22 +166,29 @@ def stackvar(array):
         tuple of 2 arrays of the varience and number of points in the
         calculation
     """
-    X, Y = extimage.stackprocess(array, 2)
+    X, Y = _stackprocess(array, 2, axis, nthreads)
     return X, Y
 
 
-def stackstderr(array):
+def stackstderr(array, axis=None, nthreads=None):
     """Cacluate the standard error of a stack
 
     This function calculates the standard error of a stack of images
     (or any array).  It ignores values that are np.NAN and does not include
     them in the calculation. It assumes an array of shape (.. i, j, x, y)
-    where x and y are the size of the returned array (x, y).
+    where x and y are the size of the returned array (.., x, y).
 
     Parameters
     ----------
     array : array_like
         Input array of at least 3 dimensions.
+    axis : int or tuple of ints, optional
+        Axes to reduce. These must be axes before the last two (image)
+        axes, the remaining leading axes are kept in the output. If `None`
+        all the leading axes are reduced.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -134,10 +196,71 @@ def stackstderr(array):
         tuple of 2 arrays of the standard error and number of points in the
         calculation
     """
-    X, Y = extimage.stackprocess(array, 4)
+    X, Y = _stackprocess(array, 4, axis, nthreads)
     return X, Y
 
 
+def stackmedian(array, nthreads=None):
+    """Calculate the median of a stack
+
+    This function calculates the median of a stack of images (or any array).
+    It ignores values that are np.NAN and does not include them in the median
+    calculation. It assumes an array of shape (.. i, j, x, y) where x and y
+    are the size of the returned array (x, y).
+
+    The stack is processed in blocks of pixels so the memory used is
+    independent of the image size. Pixels with no values return 0.0 in the
+    same way as :func:`stackmean`.
+
+    Parameters
+    ----------
+    array : array_like
+        Input array of at least 3 dimensions.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    array
+        2D Array of median of stack.
+    """
+    X, Y = extimage.stackrobust(array, 0, 3.0, 5, resolve_nthreads(nthreads))
+    return X
+
+
+def stackclipmean(array, sigma=3.0, maxiters=5, nthreads=None):
+    """Calculate the sigma clipped mean of a stack
+
+    This function calculates the mean of a stack of images (or any array)
+    after rejecting outliers such as cosmic rays. For each pixel, values
+    further than ``sigma`` standard deviations from the median are removed
+    and the clipping is repeated until no more values are rejected (or
+    ``maxiters`` is reached). It ignores values that are np.NAN. It assumes
+    an array of shape (.. i, j, x, y) where x and y are the size of the
+    returned array (x, y).
+
+    Parameters
+    ----------
+    array : array_like
+        Input array of at least 3 dimensions.
+    sigma : float
+        Number of standard deviations used for the clipping limits.
+    maxiters : int
+        Maximum number of clipping iterations.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    array
+        2D Array of clipped mean of stack.
+    """
+    X, Y = extimage.stackrobust(array, 1, sigma, maxiters, resolve_nthreads(nthreads))
+    return X
+
+
 def images_mean(images):
     """Cacluate the mean ccd counts per event
 
@@ -153,6 +276,11 @@ def images_mean(images):
     -------
     array: 1D numpy array
     """
+    if getattr(images, "ndim", 0) >= 4:
+        # Reduce all events in a single call
+        means = stackmean(images, axis=tuple(range(1, images.ndim - 2)))
+        return np.nanmean(means.reshape(len(images), -1), axis=1)
+
     return np.array([np.nanmean(stackmean(image)) for image in images])
 
 
@@ -171,4 +299,123 @@ def images_sum(images):
     -------
     array: 1D numpy array
     """
+    if getattr(images, "ndim", 0) >= 4:
+        # Reduce all events in a single call
+        means = stackmean(images, axis=tuple(range(1, images.ndim - 2)))
+        return np.nansum(means.reshape(len(images), -1), axis=1)
+
     return np.array([np.nansum(stackmean(image)) for image in images])
+
+
+class StackAccumulator(object):
+    """Streaming mean (and variance) of a stack of images
+
+    This accumulates the NaN aware mean of a stack of images which is
+    added a block of frames at a time, so the whole stack is never held in
+    memory. The per-pixel sums of each block are calculated in C and the
+    blocks are combined in double precision. If ``variance`` is true the
+    sum of squared deviations is also accumulated (using the parallel
+    algorithm of Chan et al.) so the variance can be calculated.
+
+    Parameters
+    ----------
+    variance : bool
+        If true, also accumulate the variance.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Example
+    -------
+    >>> acc = StackAccumulator()
+    >>> for block in blocks:
+    ...     acc.update(block)
+    >>> image = acc.mean
+    """
+
+    def __init__(self, variance=False, nthreads=None):
+        self.variance = variance
+        self.nthreads = nthreads
+        self.count = None
+        self._mean = None
+        self._m2 = None
+
+    def update(self, array):
+        """Add a block of images of shape (..., y, x) to the accumulator"""
+        array = np.asarray(array)
+        if array.ndim == 2:
+            array = array[np.newaxis]
+
+        nthreads = resolve_nthreads(self.nthreads)
+        if self.variance:
+            mean, count = extimage.stackprocess(array, 1, nthreads)
+            var, _ = extimage.stackprocess(array, 2, nthreads)
+            m2 = np.where(count > 0, var.astype(np.float64) * count, 0.0)
+        else:
+            total, count = extimage.stackprocess(array, 0, nthreads)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = np.where(count > 0, total / count, 0.0)
+            m2 = None
+
+        self._merge(count.astype(np.int64), mean.astype(np.float64), m2)
+
+    def merge(self, other, weight=1.0):
+        """Combine the statistics of another accumulator into this one
+
+        Parameters
+        ----------
+        other : StackAccumulator
+            Accumulator to add.
+        weight : float
+            Weight of each frame of ``other`` relative to the frames
+            already accumulated. With a weight other than 1 the counts
+            become (floating point) sums of weights and the mean and
+            variance are the weighted ones.
+        """
+        if other.count is None:
+            return
+        if self.variance and other._m2 is None:
+            raise ValueError("Cannot merge an accumulator without variance")
+        if weight <= 0:
+            raise ValueError("The weight must be positive")
+
+        count, m2 = other.count, other._m2
+        if weight != 1:
+            count = count * float(weight)
+            if m2 is not None:
+                m2 = m2 * float(weight)
+        self._merge(count, other._mean, m2)
+
+    def _merge(self, count, mean, m2):
+        if self.count is None:
+            self.count = count.copy()
+            self._mean = mean.copy()
+            self._m2 = m2.copy() if self.variance else None
+            return
+
+        if count.shape != self.count.shape:
+            raise ValueError("Images must all be the same shape")
+
+        total = self.count + count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = np.where(total > 0, count / total, 0.0)
+        delta = mean - self._mean
+        self._mean += delta * weight
+        if self.variance:
+            self._m2 += m2 + delta**2 * self.count * weight
+        self.count = total
+
+    @property
+    def mean(self):
+        """Mean image (0 where there were no values as in :func:`stackmean`)"""
+        if self.count is None:
+            return None
+        return np.where(self.count > 0, self._mean, 0.0).astype(np.float32)
+
+    @property
+    def var(self):
+        """Variance image (NaN where there were no values)"""
+        if self.count is None or not self.variance:
+            return None
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self._m2 / self.count).astype(np.float32)
@@ -1,7 +1,8 @@
 from ..ext import image as extimage
+from ..threads import resolve_nthreads
 
 
-def rotate90(a, sense="ccw"):
+def rotate90(a, sense="ccw", nthreads=None):
     """Rotate a stack of images by 90 degrees
 
     This routine rotates a stack of images by 90. The rotation is performed
@@ -14,6 +15,9 @@ def rotate90(a, sense="ccw"):
             Input array to be rotated. This should be of shape (N, y, x).
         sense : string
             'cw' to rotate clockwise, 'ccw' to rotate anitclockwise
+        nthreads : int, optional
+            Number of threads to use. If `None`, use the value set by
+            :func:`csxtools.set_num_threads`.
 
     Returns
     -------
@@ -29,4 +33,99 @@ def rotate90(a, sense="ccw"):
     else:
         raise ValueError("sense must be 'cw' or 'ccw'")
 
-    return extimage.rotate90(a, sense)
+    return extimage.rotate90(a, sense, resolve_nthreads(nthreads))
+
+
+def bin_stack(stack, pixel_bin=1, frame_bin=1, nan_policy="omit", nthreads=None):
+    """Bin the pixels and frames of a stack of images
+
+    Each output pixel is the mean of a block of ``frame_bin`` frames and
+    ``pixel_bin`` pixels. Frames and pixels at the end of an axis which do
+    not fill a bin are dropped.
+
+    Parameters
+    ----------
+    stack : array_like
+        Input array of shape (..., N, y, x) or a single image of shape
+        (y, x). The frames (axis N) are binned, any axes before them are
+        kept. If this is a dask array the binning is done lazily on each
+        chunk.
+    pixel_bin : int or tuple
+        Number of pixels to bin. This can be a tuple of (y, x) to bin the
+        axes by a different amount.
+    frame_bin : int
+        Number of frames to bin.
+    nan_policy : string
+        'omit' to ignore ``np.nan`` values (as in :func:`stackmean`, a bin
+        with no values is set to zero) or 'propagate' to return ``np.nan``
+        for any bin containing one.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+        array
+            Binned stack of shape (..., N // frame_bin, y // pixel_bin,
+            x // pixel_bin)
+
+    """
+    if nan_policy == "omit":
+        omitnan = True
+    elif nan_policy == "propagate":
+        omitnan = False
+    else:
+        raise ValueError("nan_policy must be 'omit' or 'propagate'")
+
+    try:
+        ybin, xbin = pixel_bin
+    except TypeError:
+        ybin = xbin = pixel_bin
+
+    if hasattr(stack, "map_blocks"):
+        return _bin_stack_lazy(stack, frame_bin, ybin, xbin, omitnan, nthreads)
+
+    return extimage.binstack(
+        stack, frame_bin, ybin, xbin, omitnan, resolve_nthreads(nthreads)
+    )
+
+
+def _bin_stack_lazy(stack, frame_bin, ybin, xbin, omitnan, nthreads):
+    """Bin a dask array chunk by chunk
+
+    The array is trimmed to whole bins and rechunked so that every chunk
+    holds whole bins, then each chunk is binned independently.
+    """
+    if stack.ndim < 2:
+        raise ValueError("Array must have at least 2 dimensions")
+    if stack.ndim == 2 and frame_bin != 1:
+        raise ValueError("Frames can only be binned for a stack of images")
+
+    bins = (frame_bin, ybin, xbin)[3 - min(stack.ndim, 3) :]
+    trim = tuple(
+        slice(0, (n // b) * b) for n, b in zip(stack.shape[-len(bins) :], bins)
+    )
+    stack = stack[(Ellipsis,) + trim]
+
+    chunks = {}
+    outchunks = list(stack.chunks)
+    for i, b in enumerate(bins):
+        axis = stack.ndim - len(bins) + i
+        size = max(stack.chunks[axis][0] // b, 1) * b
+        chunks[axis] = size
+        n = stack.shape[axis]
+        outchunks[axis] = tuple(
+            min(size, n - start) // b for start in range(0, n, size)
+        ) or (0,)
+    stack = stack.rechunk(chunks)
+
+    return stack.map_blocks(
+        extimage.binstack,
+        frame_bin,
+        ybin,
+        xbin,
+        omitnan,
+        resolve_nthreads(nthreads),
+        chunks=tuple(outchunks),
+        dtype="float32",
+    )
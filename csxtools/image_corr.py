@@ -1,42 +1,158 @@
-from itertools import chain
+from itertools import chain, islice
 import uuid
 import time as ttime
-from metadatastore.commands import get_events_generator
-from databroker.databroker import fill_event
-from databroker.pivot import pivot_timeseries, zip_events, reset_time
 
+import numpy as np
 
-def correct_events(evs, data_key, dark_images, drop_raw=False):
+from .fastccd import correct_images
+
+
+def correct_events(
+    evs,
+    data_key,
+    dark_images,
+    drop_raw=False,
+    flat=None,
+    gain=(1, 4, 8),
+    page_size=100,
+):
+    """Correct the FastCCD images in a stream of events
+
+    The events are corrected in batches of ``page_size`` so the C
+    correction is called once per batch. Use a ``page_size`` of 1 to
+    yield each event as soon as it arrives.
+
+    Parameters
+    ----------
+    evs : iterable
+        Events (with the descriptor document in the ``descriptor`` field)
+        containing filled images.
+    data_key : str
+        Data key of the images to correct.
+    dark_images : array_like
+        Dark images of shape (3, y, x). See
+        :func:`csxtools.fastccd.correct_images`.
+    drop_raw : bool
+        If true, remove the raw images from the output events.
+    flat : array_like, optional
+        Flatfield of shape (y, x).
+    gain : tuple, optional
+        Gain multipliers of the FastCCD.
+    page_size : int
+        Number of events corrected at once.
+
+    Yields
+    ------
+    dict
+        Events with the corrected images under ``data_key + "_corrected"``.
+
+    See Also
+    --------
+    correct_event_pages : correction of event pages
+    csxtools.streaming.CorrectionRouter : correction of bluesky documents
+    """
+    evs = iter(evs)
     out_data_key = data_key + "_corrected"
     ev0 = next(evs)
     new_desc = dict(ev0["descriptor"])
+    new_desc["data_keys"] = dict(new_desc["data_keys"])
     new_desc["data_keys"][out_data_key] = dict(new_desc["data_keys"][data_key])
-    new_desc["data_keys"][out_data_key]["source"] = "subtract_background"
-    new_desc["uid"] = uuid.uuid4()
+    new_desc["data_keys"][out_data_key]["source"] = "correct_images"
+    new_desc["uid"] = str(uuid.uuid4())
     if drop_raw:
         new_desc["data_keys"].pop(data_key)
-    for ev in chain((ev0,), evs):
-        new_ev = {
-            "uid": str(uuid.uuid4()),
-            "time": ttime.time(),
-            "descriptor": new_desc,
-            "seq_no": ev["seq_no"],
-            "data": dict(ev["data"]),
-            "timestamps": dict(ev["timestamps"]),
-        }
-        # TODO (nisarnk): replace stub with actual subtract_background implementation
-        corr, gain_img = subtract_background(  # noqa F821
-            ev["data"][data_key], dark_images
+
+    evs = chain((ev0,), evs)
+    while True:
+        batch = list(islice(evs, page_size))
+        if not batch:
+            break
+
+        images = np.asarray([ev["data"][data_key] for ev in batch])
+        corr = correct_images(images, dark_images, flat, gain)
+        now = ttime.time()
+
+        for ev, image in zip(batch, corr):
+            data = dict(ev["data"])
+            timestamps = dict(ev["timestamps"])
+            data[out_data_key] = image
+            timestamps[out_data_key] = now
+            if drop_raw:
+                data.pop(data_key)
+                timestamps.pop(data_key)
+            yield {
+                "uid": str(uuid.uuid4()),
+                "time": now,
+                "descriptor": new_desc,
+                "seq_no": ev["seq_no"],
+                "data": data,
+                "timestamps": timestamps,
+            }
+
+
+def correct_event_pages(
+    pages, data_key, dark_images, drop_raw=False, flat=None, gain=(1, 4, 8)
+):
+    """Correct the FastCCD images in a stream of event pages
+
+    Each event page is corrected with a single call to
+    :func:`csxtools.fastccd.correct_images`.
+
+    Parameters
+    ----------
+    pages : iterable
+        Event pages containing filled images. The descriptor documents
+        are not modified and must be updated by the caller.
+    data_key : str
+        Data key of the images to correct.
+    dark_images : array_like
+        Dark images of shape (3, y, x). See
+        :func:`csxtools.fastccd.correct_images`.
+    drop_raw : bool
+        If true, remove the raw images from the output pages.
+    flat : array_like, optional
+        Flatfield of shape (y, x).
+    gain : tuple, optional
+        Gain multipliers of the FastCCD.
+
+    Yields
+    ------
+    dict
+        Event pages with the corrected images under
+        ``data_key + "_corrected"`` as an array of shape (N, y, x).
+    """
+    out_data_key = data_key + "_corrected"
+    for page in pages:
+        corr = correct_images(
+            np.asarray(page["data"][data_key]), dark_images, flat, gain
         )
-        new_ev["data"][out_data_key] = corr
-        new_ev["timestamps"][out_data_key] = ttime.time()
+        n = len(corr)
+        now = ttime.time()
+
+        new_page = dict(page)
+        new_page["uid"] = [str(uuid.uuid4()) for i in range(n)]
+        new_page["time"] = [now] * n
+        new_page["data"] = dict(page["data"])
+        new_page["timestamps"] = dict(page["timestamps"])
+        new_page["data"][out_data_key] = corr
+        new_page["timestamps"][out_data_key] = [now] * n
+        if "filled" in page:
+            new_page["filled"] = dict(page["filled"])
+            new_page["filled"][out_data_key] = [True] * n
         if drop_raw:
-            new_ev["data"].pop(data_key)
-            new_ev["timestamps"].pop(data_key)
-        yield new_ev
+            new_page["data"].pop(data_key)
+            new_page["timestamps"].pop(data_key)
+            if "filled" in new_page:
+                new_page["filled"].pop(data_key, None)
+        yield new_page
 
 
 def clean_images(header, pivot_key, timesource_key, dark_images=None, static_keys=None):
+    # These need the legacy metadatastore / databroker APIs
+    from metadatastore.commands import get_events_generator
+    from databroker.databroker import fill_event
+    from databroker.pivot import pivot_timeseries, zip_events, reset_time
+
     if static_keys is None:
         static_keys = ["sx", "sy", "temp_a", "temp_b", "sz"]
     # sort out which descriptor has the key we want to pivot on
@@ -50,7 +166,7 @@ def clean_images(header, pivot_key, timesource_key, dark_images=None, static_key
     pv_events = ((ev, fill_event(ev))[0] for ev in pv_events)
     pivoted_events = pivot_timeseries(pv_events, [pivot_key], static_keys)
 
-    if dark_images:
+    if dark_images is not None:
         pivoted_events = correct_events(pivoted_events, pivot_key, dark_images)
     merged_events = zip_events(pivoted_events, ts_events)
     out_ev = reset_time(merged_events, timesource_key)
@@ -58,6 +174,10 @@ def clean_images(header, pivot_key, timesource_key, dark_images=None, static_key
 
 
 def extract_darkfield(header, dark_key):
+    # These need the legacy metadatastore / databroker APIs
+    from metadatastore.commands import get_events_generator
+    from databroker.databroker import fill_event
+
     cam_desc = [d for d in header["descriptors"] if dark_key in d["data_keys"]][0]
     events = get_events_generator(cam_desc)
     events = list(((ev, fill_event(ev))[0] for ev in events))
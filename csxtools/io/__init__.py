@@ -0,0 +1,18 @@
+from .hdf5 import read_images, read_segment, read_timestamps, resolve_datums
+from .corrected import write_corrected, read_corrected, read_provenance
+
+__all__ = [
+    "read_images",
+    "read_segment",
+    "read_timestamps",
+    "resolve_datums",
+    "write_corrected",
+    "read_corrected",
+    "read_provenance",
+]
+
+# set version string using versioneer
+from .._version import get_versions
+
+__version__ = get_versions()["version"]
+del get_versions
@@ -0,0 +1,276 @@
+import json
+import os
+import time as ttime
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+from .._version import get_versions
+from ..threads import get_num_threads
+from ..profiling import stage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Path of the corrected images and their provenance in the file
+DATA_KEY = "entry/data/data"
+PROVENANCE_KEY = "entry/provenance"
+
+
+def _filter_kwargs(compression, level):
+    """Return the h5py dataset keywords for a compression name"""
+    if compression is None:
+        return {}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level}
+    if compression in ("lz4", "blosc"):
+        if hdf5plugin is None:
+            raise ValueError(
+                "The {} compression needs the hdf5plugin package".format(compression)
+            )
+        if compression == "lz4":
+            return dict(hdf5plugin.Bitshuffle(cname="lz4"))
+        return dict(
+            hdf5plugin.Blosc(
+                cname="lz4", clevel=level, shuffle=hdf5plugin.Blosc.BITSHUFFLE
+            )
+        )
+    raise ValueError("compression must be None, 'gzip', 'lz4' or 'blosc'")
+
+
+def _iter_blocks(stack):
+    """Yield the blocks of frames of an array, dask array or iterable"""
+    if hasattr(stack, "map_blocks"):
+        # Compute a dask array a chunk of frames at a time
+        start = 0
+        for size in stack.chunks[0]:
+            yield np.asarray(stack[start : start + size])
+            start += size
+    elif hasattr(stack, "ndim"):
+        yield np.asarray(stack)
+    else:
+        for block in stack:
+            yield np.asarray(block)
+
+
+def _write_gzip_chunks(dset, block, start, level, pool):
+    """Compress the chunks of a block in parallel and write them directly
+
+    The chunks must span whole frames so each is a contiguous part of the
+    block.
+    """
+    nchunk = dset.chunks[0]
+
+    def compress(i):
+        data = block[i : i + nchunk]
+        if len(data) < nchunk:
+            pad = np.zeros((nchunk - len(data),) + data.shape[1:], dtype=data.dtype)
+            data = np.concatenate([data, pad])
+        return zlib.compress(np.ascontiguousarray(data).data, level)
+
+    offsets = range(0, len(block), nchunk)
+    for i, data in zip(offsets, pool.map(compress, offsets)):
+        offset = (start + i,) + (0,) * (block.ndim - 1)
+        dset.id.write_direct_chunk(offset, data)
+
+
+def _write_blocks(f, stack, filters, compression, level, frames_per_chunk, pool, s):
+    """Append the blocks of stack to a new dataset of f"""
+    dset = None
+    n = 0
+    written = 0
+    pending = None
+
+    for block in _iter_blocks(stack):
+        if block.ndim < 3:
+            raise ValueError("Blocks must be of shape (N, ..., y, x)")
+
+        if dset is None:
+            dset = f.create_dataset(
+                DATA_KEY,
+                shape=(0,) + block.shape[1:],
+                maxshape=(None,) + block.shape[1:],
+                dtype=block.dtype,
+                chunks=(frames_per_chunk,) + block.shape[1:],
+                **filters
+            )
+        elif block.shape[1:] != dset.shape[1:]:
+            raise ValueError("All blocks must have the same frame shape")
+
+        block = block.astype(dset.dtype, copy=False)
+        dset.resize(n + len(block), axis=0)
+        if compression == "gzip":
+            # Only whole chunks are written, the rest waits for the next block
+            if pending is not None:
+                block = np.concatenate([pending, block])
+            nwhole = (len(block) // frames_per_chunk) * frames_per_chunk
+            _write_gzip_chunks(dset, block[:nwhole], written, level, pool)
+            written += nwhole
+            pending = block[nwhole:]
+            n = written + len(pending)
+        else:
+            dset[n : n + len(block)] = block
+            n += len(block)
+        s.nbytes_in += block.nbytes
+        s.nframes += int(np.prod(block.shape[:-2]))
+
+    if dset is None:
+        raise ValueError("No images to write")
+
+    if pending is not None and len(pending):
+        _write_gzip_chunks(dset, pending, written, level, pool)
+
+    return dset
+
+
+def write_corrected(
+    path,
+    stack,
+    dark=None,
+    flat=None,
+    gain=None,
+    compression="gzip",
+    level=4,
+    frames_per_chunk=1,
+    metadata=None,
+    nthreads=None,
+):
+    """Write corrected images to a compressed HDF5 file
+
+    The images are written to the dataset ``entry/data/data`` chunked by
+    frame. Blocks of frames are written as they are produced so the stack
+    can be a dask array or a generator of corrected chunks. With gzip
+    compression the chunks of each block are compressed in parallel and
+    written directly, the other filters compress inside HDF5.
+
+    The dark, flatfield and gain used for the correction are stored in
+    ``entry/provenance`` with the csxtools version and any metadata.
+
+    Parameters
+    ----------
+    path : str
+        Name of the file to create.
+    stack : array_like or iterable
+        Corrected images of shape (N, ..., y, x), a dask array or an
+        iterable of such blocks which are appended along the first axis.
+    dark : array_like, optional
+        Dark images used for the correction.
+    flat : array_like, optional
+        Flatfield used for the correction.
+    gain : tuple, optional
+        Gain multipliers used for the correction.
+    compression : string
+        'gzip', 'lz4' (bitshuffle with LZ4), 'blosc' (blosc LZ4 with
+        bitshuffle) or `None`. 'lz4' and 'blosc' need hdf5plugin.
+    level : int
+        Compression level for 'gzip' and 'blosc'.
+    frames_per_chunk : int
+        Number of frames in each chunk of the dataset.
+    metadata : dict, optional
+        Additional provenance (e.g. the scan ids) stored as attributes.
+        Values which are not numbers or strings are stored as JSON.
+    nthreads : int, optional
+        Number of threads used to compress. If `None`, use the value from
+        :func:`csxtools.get_num_threads`.
+
+    Returns
+    -------
+    str
+        The path of the file written.
+    """
+    filters = _filter_kwargs(compression, level)
+    if nthreads is None:
+        nthreads = get_num_threads()
+
+    with stage("write_corrected") as s:
+        with h5py.File(path, "w") as f:
+            with ThreadPoolExecutor(nthreads) as pool:
+                _write_blocks(
+                    f, stack, filters, compression, level, frames_per_chunk, pool, s
+                )
+
+            prov = f.require_group(PROVENANCE_KEY)
+            if dark is not None:
+                prov.create_dataset("dark", data=np.asarray(dark))
+            if flat is not None:
+                prov.create_dataset("flat", data=np.asarray(flat))
+            if gain is not None:
+                prov.attrs["gain"] = np.asarray(gain)
+            prov.attrs["csxtools_version"] = get_versions()["version"]
+            prov.attrs["created"] = ttime.time()
+            prov.attrs["compression"] = str(compression)
+            for key, value in (metadata or {}).items():
+                if not isinstance(value, (int, float, str, np.number)):
+                    value = json.dumps(value)
+                prov.attrs[key] = value
+
+            f.flush()
+
+        # The file is closed so the size includes everything written
+        s.nbytes_out = os.path.getsize(path)
+
+    logger.info(
+        "Wrote %d frames to %s in %.3f seconds (%.1f MB)",
+        s.nframes,
+        path,
+        s.wall_time,
+        s.nbytes_out / 1e6,
+    )
+    return path
+
+
+def read_corrected(path, lazy=True):
+    """Read corrected images written by :func:`write_corrected`
+
+    Parameters
+    ----------
+    path : str
+        Name of the file.
+    lazy : bool
+        If true, return a dask array which reads the chunks when they are
+        computed (the file stays open while the array is in use),
+        otherwise read all the images into memory.
+
+    Returns
+    -------
+    array
+        Corrected images.
+    """
+    if not lazy:
+        with h5py.File(path, "r") as f:
+            return f[DATA_KEY][()]
+
+    import dask.array as da
+
+    dset = h5py.File(path, "r")[DATA_KEY]
+    return da.from_array(dset, chunks=dset.chunks)
+
+
+def read_provenance(path):
+    """Read the provenance stored by :func:`write_corrected`
+
+    Parameters
+    ----------
+    path : str
+        Name of the file.
+
+    Returns
+    -------
+    dict
+        Dictionary of the attributes and the ``dark`` and ``flat`` arrays
+        (`None` if they were not stored).
+    """
+    with h5py.File(path, "r") as f:
+        prov = f[PROVENANCE_KEY]
+        d = dict(prov.attrs)
+        for key in ("dark", "flat"):
+            d[key] = prov[key][()] if key in prov else None
+    return d
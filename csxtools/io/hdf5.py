@@ -0,0 +1,535 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+from ..threads import get_num_threads
+from ..profiling import stage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Path of the image dataset in AreaDetector HDF5 files
+AD_HDF5_DATASET = "entry/data/data"
+
+# Paths of the EPICS timestamp (seconds and nanoseconds) of each frame
+AD_HDF5_TS_SEC = "entry/instrument/NDAttributes/NDArrayEpicsTSSec"
+AD_HDF5_TS_NSEC = "entry/instrument/NDAttributes/NDArrayEpicsTSnSec"
+AD_HDF5_TIMESTAMP = "entry/instrument/NDAttributes/NDArrayTimeStamp"
+
+# Resource specs of AreaDetector HDF5 files
+AD_HDF5_SPECS = ("AD_HDF5", "AD_HDF5_TS")
+
+# Size of each read of contiguous datasets
+_READ_BLOCK = 16 * 1024 * 1024
+
+DatumPlan = namedtuple("DatumPlan", ["segments", "frame_per_point", "nevents"])
+
+
+def resolve_datums(header, tag, root_map=None, stream_name="primary"):
+    """Find the AreaDetector HDF5 frames of a run
+
+    The resource and datum documents of the run are read once and the
+    datum of every event is resolved to a range of frames in a file.
+
+    Parameters
+    ----------
+    header : databroker header
+        Header of the run.
+    tag : str
+        Data key of the detector images, e.g. ``"fccd_image"``.
+    root_map : dict, optional
+        Mapping of resource roots to local paths, e.g. to read the files
+        on the storage node.
+    stream_name : str
+        Name of the event stream holding the images.
+
+    Returns
+    -------
+    DatumPlan
+        Named tuple of the ``segments``, a list of tuples of ``(filename,
+        start, stop)`` giving the frames of the events in order (events
+        in consecutive frames of a file are merged), the number of
+        frames per event ``frame_per_point`` and the number of events
+        ``nevents``.
+    """
+    if root_map is None:
+        root_map = {}
+
+    descriptors = set()
+    resources = {}
+    datums = {}
+    datum_ids = []
+
+    for name, doc in header.documents(fill=False):
+        if name == "descriptor":
+            if doc.get("name", "primary") == stream_name and tag in doc["data_keys"]:
+                descriptors.add(doc["uid"])
+        elif name == "resource":
+            resources[doc["uid"]] = doc
+        elif name == "datum":
+            datums[doc["datum_id"]] = doc
+        elif name == "datum_page":
+            for i, datum_id in enumerate(doc["datum_id"]):
+                datums[datum_id] = {
+                    "resource": doc["resource"],
+                    "datum_kwargs": {k: v[i] for k, v in doc["datum_kwargs"].items()},
+                }
+        elif name == "event":
+            if doc["descriptor"] in descriptors:
+                datum_ids.append((doc["seq_num"], doc["data"][tag]))
+        elif name == "event_page":
+            if doc["descriptor"] in descriptors:
+                datum_ids.extend(zip(doc["seq_num"], doc["data"][tag]))
+
+    if not descriptors:
+        raise ValueError("No {} data in stream {}".format(tag, stream_name))
+
+    if not datum_ids:
+        raise ValueError("No events with {} data".format(tag))
+
+    segments = []
+    frame_per_point = None
+    for _, datum_id in sorted(datum_ids, key=lambda x: x[0]):
+        datum = datums[datum_id]
+        resource = resources[datum["resource"]]
+        if resource["spec"] not in AD_HDF5_SPECS:
+            raise ValueError(
+                "Resource spec {} is not supported".format(resource["spec"])
+            )
+
+        root = root_map.get(resource.get("root", ""), resource.get("root", ""))
+        filename = os.path.join(root, resource["resource_path"])
+        fpp = resource["resource_kwargs"].get("frame_per_point", 1)
+        if frame_per_point is None:
+            frame_per_point = fpp
+        elif fpp != frame_per_point:
+            raise ValueError("Events have different numbers of frames")
+        start = datum["datum_kwargs"]["point_number"] * fpp
+        stop = start + fpp
+
+        if segments and segments[-1][0] == filename and segments[-1][2] == start:
+            segments[-1] = (filename, segments[-1][1], stop)
+        else:
+            segments.append((filename, start, stop))
+
+    return DatumPlan(segments, frame_per_point, len(datum_ids))
+
+
+def _read_contiguous(filename, offset, rowsize, start, out, nthreads):
+    """Read rows of a contiguous dataset with parallel preads"""
+    nbytes = out.nbytes
+    buf = out.reshape(-1).view(np.uint8)
+    offset = offset + start * rowsize
+    blocks = range(0, nbytes, _READ_BLOCK)
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+
+        def read(b):
+            view = buf[b : b + _READ_BLOCK]
+            n = os.preadv(fd, [view], offset + b)
+            if n != len(view):
+                raise IOError("Short read from {}".format(filename))
+
+        with ThreadPoolExecutor(nthreads) as pool:
+            list(pool.map(read, blocks))
+    finally:
+        os.close(fd)
+
+
+def _read_contiguous_region(
+    filename, offset, shape, itemsize, start, bounds, out, nthreads
+):
+    """Read a region of the frames of a contiguous dataset with parallel preads
+
+    Only the rows of the region are read from each frame.
+    """
+    (y0, y1), (x0, x1) = bounds
+    rowsize = shape[-1] * itemsize
+    framesize = shape[-2] * rowsize
+    offset = offset + start * framesize + y0 * rowsize
+    full_rows = (x0, x1) == (0, shape[-1])
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+
+        def read(i):
+            if full_rows:
+                buf = out[i]
+            else:
+                buf = np.empty((y1 - y0, shape[-1]), dtype=out.dtype)
+            n = os.preadv(fd, [buf.reshape(-1).view(np.uint8)], offset + i * framesize)
+            if n != buf.nbytes:
+                raise IOError("Short read from {}".format(filename))
+            if not full_rows:
+                out[i] = buf[:, x0:x1]
+
+        with ThreadPoolExecutor(nthreads) as pool:
+            list(pool.map(read, range(out.shape[0])))
+    finally:
+        os.close(fd)
+
+
+def _read_chunked(filename, dset, start, stop, out, nthreads, bounds=None):
+    """Read the chunks of an unfiltered dataset with parallel preads
+
+    If ``bounds`` (the (start, stop) of the region on each axis of the
+    frames) is given only the chunks overlapping the region are read.
+    """
+    chunks = dset.chunks
+    shape = dset.shape
+    dtype = dset.dtype
+    nchunks = dset.id.get_num_chunks()
+    if bounds is None:
+        bounds = tuple((0, n) for n in shape[1:])
+    bounds = ((start, stop),) + tuple(bounds)
+
+    todo = []
+    for i in range(nchunks):
+        info = dset.id.get_chunk_info(i)
+        if all(
+            c < hi and c + size > lo
+            for c, size, (lo, hi) in zip(info.chunk_offset, chunks, bounds)
+        ):
+            todo.append(info)
+
+    # Chunks which were never written hold the fill value
+    expected = 1
+    for (lo, hi), c in zip(bounds, chunks):
+        expected *= (hi - 1) // c - lo // c + 1
+    if len(todo) < expected:
+        out[...] = dset.fillvalue
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+
+        full_frames = tuple(chunks[1:]) == tuple(shape[1:]) and all(
+            b == (0, n) for b, n in zip(bounds[1:], shape[1:])
+        )
+
+        def read(info):
+            c0 = info.chunk_offset[0]
+            if full_frames and c0 >= start and c0 + chunks[0] <= stop:
+                # Whole frames inside the range are read straight into out
+                view = out[c0 - start : c0 - start + chunks[0]]
+                n = os.preadv(fd, [view.reshape(-1).view(np.uint8)], info.byte_offset)
+                if n != view.nbytes:
+                    raise IOError("Short read from {}".format(filename))
+                return
+
+            chunk = np.empty(chunks, dtype=dtype)
+            n = os.preadv(fd, [chunk.reshape(-1).view(np.uint8)], info.byte_offset)
+            if n != chunk.nbytes:
+                raise IOError("Short read from {}".format(filename))
+
+            src = []
+            dst = []
+            for offset, size, (blo, bhi) in zip(info.chunk_offset, chunks, bounds):
+                lo, hi = max(offset, blo), min(offset + size, bhi)
+                dst.append(slice(lo - blo, hi - blo))
+                src.append(slice(lo - offset, hi - offset))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        with ThreadPoolExecutor(nthreads) as pool:
+            list(pool.map(read, todo))
+    finally:
+        os.close(fd)
+
+
+def _direct_layout(dset):
+    """Return the layout if the dataset can be read without HDF5"""
+    if not hasattr(os, "preadv") or not dset.dtype.isnative:
+        return None
+
+    plist = dset.id.get_create_plist()
+    if plist.get_nfilters():
+        return None
+
+    layout = plist.get_layout()
+    if layout == h5py.h5d.CONTIGUOUS and dset.id.get_offset() is not None:
+        return layout
+    if layout == h5py.h5d.CHUNKED:
+        return layout
+    return None
+
+
+def _region_bounds(region, frame_shape):
+    """Return the (start, stop) of a region of a frame on each axis"""
+    if callable(region):
+        region = region(frame_shape)
+    region = tuple(region)
+    if len(region) > len(frame_shape):
+        raise ValueError("The region has more dimensions than the frames")
+    region = (slice(None),) * (len(frame_shape) - len(region)) + region
+    bounds = []
+    for s, n in zip(region, frame_shape):
+        start, stop, step = s.indices(n)
+        if step != 1:
+            raise ValueError("Only regions with a step of 1 can be read")
+        bounds.append((start, max(start, stop)))
+    return tuple(bounds)
+
+
+def read_segment(
+    filename, start, stop, out, key=AD_HDF5_DATASET, nthreads=None, region=None
+):
+    """Read frames from an HDF5 file into an array
+
+    Uncompressed datasets are read directly from the file with parallel
+    ``pread`` calls aligned to the chunks of the dataset. Other datasets
+    are read with h5py.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the HDF5 file.
+    start, stop : int
+        Range of frames to read.
+    out : array
+        C-contiguous array of shape (stop - start, ...) to read into.
+    key : str
+        Path of the dataset in the file.
+    nthreads : int, optional
+        Number of threads used to read. If `None`, use the value from
+        :func:`csxtools.get_num_threads`.
+    region : tuple of slices or callable, optional
+        Region of each frame to read, e.g. ``np.s_[10:20, 30:60]``. Only
+        the rows (or chunks) covering the region are read from the file
+        and ``out`` is of the shape of the region. If callable, it is
+        called with the shape of the frames and returns the slices.
+    """
+    if nthreads is None:
+        nthreads = get_num_threads()
+
+    with h5py.File(filename, "r") as f:
+        dset = f[key]
+        if stop > dset.shape[0]:
+            raise ValueError(
+                "Frames {}:{} are beyond the end of {}".format(start, stop, filename)
+            )
+
+        bounds = None
+        if region is not None:
+            bounds = _region_bounds(region, dset.shape[1:])
+
+        layout = _direct_layout(dset) if dset.dtype == out.dtype else None
+        if layout == h5py.h5d.CONTIGUOUS and (bounds is None or dset.ndim == 3):
+            offset = dset.id.get_offset()
+        elif layout == h5py.h5d.CHUNKED:
+            _read_chunked(filename, dset, start, stop, out, nthreads, bounds)
+            return out
+        else:
+            selection = (slice(start, stop),)
+            if bounds is not None:
+                selection += tuple(slice(lo, hi) for lo, hi in bounds)
+            dset.read_direct(out, selection)
+            return out
+
+    if bounds is None:
+        rowsize = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+        _read_contiguous(filename, offset, rowsize, start, out, nthreads)
+    else:
+        _read_contiguous_region(
+            filename,
+            offset,
+            dset.shape,
+            dset.dtype.itemsize,
+            start,
+            bounds,
+            out,
+            nthreads,
+        )
+    return out
+
+
+def _read_block(filename, start, stop, frame_shape, dtype, region, nthreads):
+    out = np.empty((stop - start,) + frame_shape, dtype=dtype)
+    return read_segment(filename, start, stop, out, nthreads=nthreads, region=region)
+
+
+def _read_images_lazy(plan, frame_shape, dtype, region, nthreads, chunk_size):
+    """Return a dask array with a task reading each block of frames"""
+    import dask
+    import dask.array as da
+
+    fpp = plan.frame_per_point
+    blocks = []
+    for filename, start, stop in plan.segments:
+        step = chunk_size * fpp if chunk_size else stop - start
+        for first in range(start, stop, step):
+            last = min(first + step, stop)
+            block = dask.delayed(_read_block, pure=True)(
+                filename, first, last, frame_shape, dtype, region, nthreads
+            )
+            blocks.append(
+                da.from_delayed(block, (last - first,) + frame_shape, dtype=dtype)
+            )
+
+    images = da.concatenate(blocks)
+    return images.reshape((plan.nevents, fpp) + frame_shape)
+
+
+def read_images(
+    header, tag, root_map=None, nthreads=None, region=None, lazy=False, chunk_size=None
+):
+    """Read the AreaDetector HDF5 images of a run directly
+
+    This bypasses the databroker handlers: the resource and datum
+    documents are resolved once and the files are read directly. If a
+    region is given only that part of the frames is read from the files
+    (see :func:`read_segment`) into a C-contiguous array.
+
+    With ``lazy`` a dask array is returned instead which has a task for
+    each block of frames of each file, so the frames are read where the
+    blocks are computed (e.g. by the workers of a dask cluster).
+
+    Parameters
+    ----------
+    header : databroker header
+        Header of the run.
+    tag : str
+        Data key of the detector images, e.g. ``"fccd_image"``.
+    root_map : dict, optional
+        Mapping of resource roots to local paths.
+    nthreads : int, optional
+        Number of threads used to read. If `None`, use the value from
+        :func:`csxtools.get_num_threads`.
+    region : tuple of slices or callable, optional
+        Region of each frame to read (see :func:`read_segment`).
+    lazy : bool
+        If true, return a dask array which reads the frames when it is
+        computed.
+    chunk_size : int, optional
+        Number of events read by each task if ``lazy``. If `None`, each
+        segment of a file is read by a single task.
+
+    Returns
+    -------
+    array
+        Array of images of shape (number of events, frames per event, y, x).
+    """
+    plan = resolve_datums(header, tag, root_map)
+    segments = plan.segments
+
+    with h5py.File(segments[0][0], "r") as f:
+        dset = f[AD_HDF5_DATASET]
+        frame_shape = dset.shape[1:]
+        dtype = dset.dtype
+    if region is not None:
+        bounds = _region_bounds(region, frame_shape)
+        frame_shape = tuple(hi - lo for lo, hi in bounds)
+        region = tuple(slice(lo, hi) for lo, hi in bounds)
+
+    if lazy:
+        return _read_images_lazy(plan, frame_shape, dtype, region, nthreads, chunk_size)
+
+    nframes = sum(stop - start for _, start, stop in segments)
+    out = np.empty((nframes,) + frame_shape, dtype=dtype)
+
+    with stage("read_images") as s:
+        n = 0
+        for filename, start, stop in segments:
+            read_segment(
+                filename,
+                start,
+                stop,
+                out[n : n + stop - start],
+                nthreads=nthreads,
+                region=region,
+            )
+            n += stop - start
+        s.set_output(out)
+
+    logger.info(
+        "Read %d frames from %d segments in %.3f seconds",
+        nframes,
+        len(segments),
+        s.wall_time,
+    )
+
+    return out.reshape((plan.nevents, plan.frame_per_point) + frame_shape)
+
+
+def _read_file_timestamps(filename, ranges):
+    """Read the timestamps of ranges of frames from one file"""
+    with h5py.File(filename, "r") as f:
+        if AD_HDF5_TS_SEC in f:
+            sec = f[AD_HDF5_TS_SEC][()].astype(np.float64)
+            nsec = f[AD_HDF5_TS_NSEC][()].astype(np.float64)
+            ts = sec.ravel() + nsec.ravel() * 1e-9
+        else:
+            ts = f[AD_HDF5_TIMESTAMP][()].astype(np.float64).ravel()
+
+    return np.concatenate([ts[start:stop] for start, stop in ranges])
+
+
+def read_timestamps(header, tag, root_map=None, lazy=False):
+    """Read the AreaDetector timestamps of a run without the images
+
+    Each HDF5 file of the run is opened once and the EPICS timestamps of
+    all its frames are read in one go (``NDArrayEpicsTSSec`` and
+    ``NDArrayEpicsTSnSec``, or ``NDArrayTimeStamp`` if they are missing).
+
+    Parameters
+    ----------
+    header : databroker header
+        Header of the run.
+    tag : str
+        Data key of the detector images (or timestamps).
+    root_map : dict, optional
+        Mapping of resource roots to local paths.
+    lazy : bool
+        If true, return a dask array which reads the files when computed.
+
+    Returns
+    -------
+    array
+        Timestamps (in seconds) of shape (number of events, frames per
+        event), or (number of events,) if there is one frame per event.
+    """
+    plan = resolve_datums(header, tag, root_map)
+
+    # Group the frames by file keeping the order of the events
+    files = []
+    for filename, start, stop in plan.segments:
+        if files and files[-1][0] == filename:
+            files[-1][1].append((start, stop))
+        else:
+            files.append((filename, [(start, stop)]))
+
+    if plan.frame_per_point == 1:
+        shape = (plan.nevents,)
+    else:
+        shape = (plan.nevents, plan.frame_per_point)
+
+    if lazy:
+        import dask
+        import dask.array as da
+
+        parts = [
+            da.from_delayed(
+                dask.delayed(_read_file_timestamps)(filename, ranges),
+                shape=(sum(stop - start for start, stop in ranges),),
+                dtype=np.float64,
+            )
+            for filename, ranges in files
+        ]
+        return da.concatenate(parts).reshape(shape)
+
+    with stage("read_timestamps") as s:
+        ts = np.concatenate(
+            [_read_file_timestamps(filename, ranges) for filename, ranges in files]
+        )
+        s.set_output(ts)
+
+    logger.info(
+        "Read %d timestamps from %d files in %.3f seconds",
+        len(ts),
+        len(files),
+        s.wall_time,
+    )
+    return ts.reshape(shape)
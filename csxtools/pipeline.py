@@ -0,0 +1,486 @@
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+
+from .fastccd import correct_images, correct_common_mode
+from .axis1 import correct_images_axis
+from .image import rotate90, stackmean
+from .io import read_images
+from .profiling import stage
+from . import settings
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_registry = OrderedDict()
+
+# Reduced dark images are kept for the most recently used dark runs
+_dark_cache = OrderedDict()
+_DARK_CACHE_SIZE = 16
+
+
+class DetectorDescriptor(object):
+    """Description of how the images of a detector are corrected
+
+    A descriptor supplies the detector specific parts of the correction
+    pipeline, the kernel which corrects the raw images and the geometry
+    of the corrected images. Reading the images, the ROI, the dark images
+    and the flatfield are handled by :class:`Pipeline` in the same way for
+    all detectors.
+
+    Parameters
+    ----------
+    name : str
+        Name of the detector (e.g. ``"fccd"``).
+    tag : str
+        Default data key of the images.
+    correct : callable
+        Called as ``correct(images, dark, flat, nthreads=nthreads,
+        **options)`` to correct a stack of raw images of shape (..., y, x)
+        and return the images in their final orientation.
+    decode_dark : callable, optional
+        Called with each stack of raw dark images before it is reduced to
+        a single image. If `None`, the raw images are reduced.
+    ndarks : int
+        Number of dark runs (e.g. one for each gain setting) the dark
+        images are made of. With more than one the dark images are
+        stacked to an array of shape (ndarks, y, x).
+    rotate : str, optional
+        Rotation (``"cw"`` or ``"ccw"``) applied by ``correct``. Used to
+        know the shape of the corrected images.
+    """
+
+    def __init__(self, name, tag, correct, decode_dark=None, ndarks=1, rotate=None):
+        self.name = name
+        self.tag = tag
+        self.correct = correct
+        self.decode_dark = decode_dark
+        self.ndarks = ndarks
+        self.rotate = rotate
+
+    def __repr__(self):
+        return "DetectorDescriptor({!r}, tag={!r})".format(self.name, self.tag)
+
+    def output_shape(self, shape):
+        """Return the shape of the corrected images of raw images"""
+        shape = tuple(shape)
+        if self.rotate is not None:
+            return shape[:-2] + shape[-2:][::-1]
+        return shape
+
+
+def register_detector(descriptor):
+    """Register a detector for the correction pipeline
+
+    The tag of the detector is also set in ``csxtools.settings.detectors``.
+    """
+    _registry[descriptor.name] = descriptor
+    settings.detectors[descriptor.name] = descriptor.tag
+
+
+def get_detector(name):
+    """Return the registered :class:`DetectorDescriptor` of a detector"""
+    if isinstance(name, DetectorDescriptor):
+        return name
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown detector {!r} (registered: {})".format(name, ", ".join(_registry))
+        )
+
+
+def detector_for_tag(tag, default=None):
+    """Return the registered detector whose default tag is ``tag``"""
+    for descriptor in _registry.values():
+        if descriptor.tag == tag:
+            return descriptor
+    return get_detector(default) if default is not None else None
+
+
+def clear_dark_cache():
+    """Remove all the cached dark images"""
+    _dark_cache.clear()
+
+
+def _correct_fastccd(
+    images, dark, flat, gain=(1, 4, 8), common_mode=None, nthreads=None
+):
+    images = correct_images(images, dark, flat, gain, nthreads=nthreads)
+    images = rotate90(images, "cw", nthreads=nthreads)
+    if common_mode is not None:
+        images = correct_common_mode(images, nthreads=nthreads, **common_mode)
+    return images
+
+
+def _decode_fastccd_dark(images):
+    return correct_images(images, gain=(1, 1, 1))
+
+
+def _correct_axis(images, dark, flat, nthreads=None):
+    return correct_images_axis(images, dark, flat, nthreads=nthreads)
+
+
+register_detector(
+    DetectorDescriptor(
+        "fccd",
+        "fccd_image",
+        _correct_fastccd,
+        decode_dark=_decode_fastccd_dark,
+        ndarks=3,
+        rotate="cw",
+    )
+)
+for _name in ("axis1", "axis", "axis_standard", "axis_cont"):
+    register_detector(DetectorDescriptor(_name, _name + "_image", _correct_axis))
+del _name
+
+
+def convert_roi(roi):
+    """Convert a ROI from (x, y, w, h) to (x0, y0, x1, y1)"""
+    if roi is None:
+        return None
+    roi = list(roi)
+    roi[2] = roi[0] + roi[2]
+    roi[3] = roi[1] + roi[3]
+    return roi
+
+
+def _get_images(header, tag, roi=None, direct=False):
+    """Read the (lazy) raw images of a run
+
+    The ROI is passed to the read so only the region of the frames is
+    fetched from the files (or the tiled server).
+    """
+    if direct:
+        region = None
+        if roi is not None:
+            region = partial(_raw_region, roi=roi)
+        return read_images(header, tag, region=region)
+
+    run = header.v2.new_variation(structure_clients="dask")
+    client = run["primary"]["data"][tag]
+    if roi is None:
+        return client[:]
+    return client[(Ellipsis,) + _raw_region(client.shape[-2:], roi)]
+
+
+def _iter_chunks(images, chunk_size):
+    """Yield blocks of up to chunk_size events of a (lazy) image array"""
+    for i in range(0, images.shape[0], chunk_size):
+        yield images[i : i + chunk_size]
+
+
+def _raw_region(shape, roi):
+    """Return the slices of the raw frames of shape ``shape`` of a ROI
+
+    The ROI (x0, y0, x1, y1) is in the orientation of the corrected
+    images.
+    """
+    ny, nx = shape[-2:]
+    return (
+        slice(max(ny - roi[3], 0), min(nx - roi[1], ny)),
+        slice(max(roi[0], 0), min(roi[2], nx)),
+    )
+
+
+def _crop_images(image, roi):
+    return _crop(image, roi)
+
+
+def _crop(image, roi):
+    """Crop the raw images (or flatfield) to a ROI
+
+    Numpy arrays are returned C-contiguous.
+    """
+    image = image[(Ellipsis,) + _raw_region(image.shape, roi)]
+    if isinstance(image, np.ndarray):
+        image = np.ascontiguousarray(image)
+    return image
+
+
+def _header_uid(header):
+    try:
+        return header.start["uid"]
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+class Pipeline(object):
+    """Read and correct the images of a detector
+
+    The pipeline reads the (lazy) images of a run, the dark images (which
+    are cached between runs) and crops them and the flatfield to the ROI
+    before correcting them with the kernel of the detector. The
+    correction can be made at once, a chunk of events at a time or lazily
+    on dask arrays.
+
+    Parameters
+    ----------
+    detector : str or DetectorDescriptor
+        The detector (a name registered with :func:`register_detector`).
+    tag : str, optional
+        Data key of the images. If `None`, use the tag of the detector.
+    dark_reducer : callable, optional
+        Function used to reduce each stack of dark images to a single
+        image. If `None`, use :func:`csxtools.image.stackmean`.
+    direct : bool
+        If true, read the AreaDetector HDF5 files directly with
+        :func:`csxtools.io.read_images`.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+    stage_prefix : str, optional
+        Prefix of the names of the profiling stages. If `None`, use
+        ``"pipeline.<detector>"``.
+
+    Example
+    -------
+    >>> pipe = Pipeline("fccd")
+    >>> images = pipe.images(light, (dark8, dark2, dark1), roi=(0, 0, 100, 100))
+    """
+
+    def __init__(
+        self,
+        detector,
+        tag=None,
+        dark_reducer=None,
+        direct=False,
+        nthreads=None,
+        stage_prefix=None,
+    ):
+        self.detector = get_detector(detector)
+        self.tag = tag if tag is not None else self.detector.tag
+        self.dark_reducer = dark_reducer if dark_reducer is not None else stackmean
+        self.direct = direct
+        self.nthreads = nthreads
+        if stage_prefix is None:
+            stage_prefix = "pipeline." + self.detector.name
+        self.stage_prefix = stage_prefix
+
+    def _stage(self, name, data=None):
+        return stage(self.stage_prefix + "." + name, data)
+
+    def read(self, header, roi=None):
+        """Read the (lazy) raw images of a run cropped to the ROI
+
+        Parameters
+        ----------
+        header : databroker header
+            The run to read.
+        roi : list, optional
+            ROI as (x0, y0, x1, y1) in the orientation of the corrected
+            images.
+        """
+        with self._stage("read") as s:
+            images = _get_images(header, self.tag, roi, self.direct)
+            s.set_output(images)
+        return images
+
+    def darks(self, dark_headers, roi=None):
+        """Return the reduced dark images of the dark runs
+
+        Parameters
+        ----------
+        dark_headers : databroker header or tuple of headers
+            The dark runs. For detectors with more than one dark a tuple
+            with a header (or `None`) for each.
+        roi : list, optional
+            ROI as (x0, y0, x1, y1).
+
+        Returns
+        -------
+        array_like
+            The dark images or `None` if there are no dark runs.
+        """
+        if dark_headers is None:
+            logger.warning("Processing without dark images")
+            return None
+
+        if self.detector.ndarks == 1 and not isinstance(dark_headers, (tuple, list)):
+            dark_headers = (dark_headers,)
+        if dark_headers[0] is None:
+            raise NotImplementedError(
+                "Use of header metadata to find dark" " images is not implemented yet."
+            )
+
+        uids = tuple(_header_uid(d) if d is not None else "" for d in dark_headers)
+        key = None
+        if None not in uids:
+            key = (
+                self.detector.name,
+                self.tag,
+                uids,
+                tuple(roi) if roi is not None else None,
+                self.dark_reducer,
+                self.direct,
+            )
+            if key in _dark_cache:
+                _dark_cache.move_to_end(key)
+                logger.info("Using cached dark images")
+                return _dark_cache[key]
+
+        with self._stage("dark") as s:
+            dark = []
+            b = None
+            for i, d in enumerate(dark_headers):
+                if d is not None:
+                    b = self._reduce_dark(d, roi)
+                else:
+                    logger.warning("Missing dark image %d", i)
+                dark.append(b)
+
+            if self.detector.ndarks == 1:
+                bgnd = np.asarray(dark[0])
+            else:
+                bgnd = np.array(dark)
+            s.set_output(bgnd)
+        logger.info("Computed dark images in %.3f seconds", s.wall_time)
+
+        if key is not None:
+            _dark_cache[key] = bgnd
+            while len(_dark_cache) > _DARK_CACHE_SIZE:
+                _dark_cache.popitem(last=False)
+        return bgnd
+
+    def _reduce_dark(self, header, roi):
+        events = self.read(header, roi)
+
+        # We assume that all images are for the background
+        with self._stage("convert", events) as s:
+            b = events.astype(dtype=np.uint16)
+        logger.info("Image conversion took %.3f seconds", s.wall_time)
+
+        if self.detector.decode_dark is not None:
+            b = self.detector.decode_dark(b)
+
+        with self._stage("reduce", b) as s:
+            b = self.dark_reducer(b)
+        logger.info("Reduction of image stack took %.3f seconds", s.wall_time)
+        return b
+
+    def prepare(self, light_header, dark_headers=None, flat=None, roi=None):
+        """Read the dark images and the (lazy) light images of a run
+
+        Parameters
+        ----------
+        light_header : databroker header
+            The run to correct.
+        dark_headers : databroker header or tuple of headers, optional
+            The dark runs (see :meth:`darks`).
+        flat : array_like, optional
+            The flatfield.
+        roi : list, optional
+            ROI as (x0, y0, x1, y1).
+
+        Returns
+        -------
+        tuple
+            The light images, the dark images and the flatfield cropped to
+            the ROI.
+        """
+        if roi is not None:
+            logger.info("Computing with ROI of %s", str(roi))
+        bgnd = self.darks(dark_headers, roi)
+        events = self.read(light_header, roi)
+        if flat is not None and roi is not None:
+            flat = _crop(flat, roi)
+        return events, bgnd, flat
+
+    def correct(self, images, dark=None, flat=None, **options):
+        """Correct a stack of raw images with the detector kernel"""
+        with self._stage("correct", images) as s:
+            images = self.detector.correct(
+                images, dark, flat, nthreads=self.nthreads, **options
+            )
+            s.set_output(images)
+        return images
+
+    def correct_lazy(self, images, dark=None, flat=None, **options):
+        """Correct a dask array of raw images block by block
+
+        The images are rechunked so each block holds whole frames and the
+        correction of each block is made when it is computed.
+        """
+        images = images.rechunk({images.ndim - 2: -1, images.ndim - 1: -1})
+        chunks = images.chunks[:-2] + tuple(
+            (n,) for n in self.detector.output_shape(images.shape)[-2:]
+        )
+        return images.map_blocks(
+            self.detector.correct,
+            dark,
+            flat,
+            dtype=np.float32,
+            chunks=chunks,
+            nthreads=self.nthreads,
+            **options
+        )
+
+    def images(
+        self,
+        light_header,
+        dark_headers=None,
+        flat=None,
+        roi=None,
+        chunk_size=None,
+        lazy=False,
+        **options
+    ):
+        """Read and correct the images of a run
+
+        Parameters
+        ----------
+        light_header : databroker header
+            The run to correct.
+        dark_headers : databroker header or tuple of headers, optional
+            The dark runs (see :meth:`darks`).
+        flat : array_like, optional
+            The flatfield.
+        roi : list, optional
+            ROI as (x0, y0, x1, y1).
+        chunk_size : int, optional
+            If given, correct this many events at a time into the output
+            array so only one chunk of raw images is in memory at a time.
+        lazy : bool
+            If true (and the images are read as a dask array), return a
+            dask array which is corrected when it is computed.
+        options
+            Passed to the correction kernel of the detector.
+
+        Returns
+        -------
+        array_like
+            The corrected images.
+        """
+        events, bgnd, flat = self.prepare(light_header, dark_headers, flat, roi)
+        if lazy and hasattr(events, "map_blocks"):
+            return self.correct_lazy(events, bgnd, flat, **options)
+        if chunk_size is None:
+            return self.correct(events, bgnd, flat, **options)
+
+        out = np.empty(self.detector.output_shape(events.shape), dtype=np.float32)
+        for i, block in enumerate(_iter_chunks(events, chunk_size)):
+            start = i * chunk_size
+            out[start : start + len(block)] = self.correct(block, bgnd, flat, **options)
+        return out
+
+    def accumulate(
+        self,
+        acc,
+        light_header,
+        dark_headers=None,
+        flat=None,
+        roi=None,
+        chunk_size=100,
+        **options
+    ):
+        """Add the corrected images of a run to a StackAccumulator
+
+        The run is read and corrected ``chunk_size`` events at a time.
+        """
+        events, bgnd, flat = self.prepare(light_header, dark_headers, flat, roi)
+        for block in _iter_chunks(events, chunk_size):
+            acc.update(self.correct(block, bgnd, flat, **options))
+        return acc
@@ -0,0 +1,297 @@
+import os
+import threading
+import time as ttime
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of stage records kept in the registry
+_max_records = int(os.environ.get("CSXTOOLS_PROFILE_RECORDS", 10000))
+
+_records = deque(maxlen=_max_records)
+_callbacks = []
+_lock = threading.Lock()
+_enabled = True
+_trace_memory = False
+
+# Stack of the stages currently running in each python thread
+_local = threading.local()
+
+
+class StageRecord(object):
+    """Measurements of a single run of a processing stage
+
+    Attributes
+    ----------
+    name : str
+        Name of the stage, e.g. ``"correct_images"``.
+    start : float
+        Start time of the stage (seconds since the epoch).
+    wall_time : float
+        Duration of the stage in seconds.
+    nbytes_in : int
+        Size of the input data in bytes (0 if unknown).
+    nbytes_out : int
+        Size of the output data in bytes (0 if unknown).
+    nframes : int
+        Number of frames processed (0 if unknown).
+    peak_memory : int
+        Peak memory allocated by python and numpy during the stage in
+        bytes. This is `None` unless memory tracing is enabled with
+        ``enable(trace_memory=True)``.
+    parent : str
+        Name of the enclosing stage or `None`.
+    """
+
+    __slots__ = (
+        "name",
+        "start",
+        "wall_time",
+        "nbytes_in",
+        "nbytes_out",
+        "nframes",
+        "peak_memory",
+        "parent",
+    )
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.start = ttime.time()
+        self.wall_time = 0.0
+        self.nbytes_in = 0
+        self.nbytes_out = 0
+        self.nframes = 0
+        self.peak_memory = None
+        self.parent = parent
+
+    @property
+    def frames_per_second(self):
+        """Throughput of the stage in frames per second"""
+        if self.wall_time > 0:
+            return self.nframes / self.wall_time
+        return 0.0
+
+    @property
+    def bytes_per_second(self):
+        """Throughput of the stage in input bytes per second"""
+        if self.wall_time > 0:
+            return self.nbytes_in / self.wall_time
+        return 0.0
+
+    def set_input(self, data):
+        """Record the size and number of frames of the input array"""
+        self.nbytes_in, self.nframes = _array_size(data)
+
+    def set_output(self, data):
+        """Record the size (and number of frames) of the output array"""
+        self.nbytes_out, nframes = _array_size(data)
+        if not self.nframes:
+            self.nframes = nframes
+
+    def as_dict(self):
+        """Return the record as a dictionary"""
+        d = {key: getattr(self, key) for key in self.__slots__}
+        d["frames_per_second"] = self.frames_per_second
+        d["bytes_per_second"] = self.bytes_per_second
+        return d
+
+    def __repr__(self):
+        return "StageRecord(name={!r}, wall_time={:.6f}, nframes={})".format(
+            self.name, self.wall_time, self.nframes
+        )
+
+
+def _array_size(data):
+    """Return the number of bytes and frames of an (N, y, x) array"""
+    if data is None:
+        return 0, 0
+    shape = getattr(data, "shape", ())
+    nframes = 1
+    for n in shape[:-2]:
+        nframes *= n
+    nbytes = getattr(data, "nbytes", 0)
+    return int(nbytes), int(nframes) if len(shape) >= 2 else 0
+
+
+def enable(trace_memory=False):
+    """Enable recording of stage measurements
+
+    Parameters
+    ----------
+    trace_memory : bool
+        If true, also measure the peak memory of each stage using
+        :mod:`tracemalloc`. This slows down python code so is off by
+        default. The peak is process wide so is only meaningful when a
+        single pipeline is running.
+    """
+    global _enabled, _trace_memory
+    _enabled = True
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Disable recording of stage measurements"""
+    global _enabled, _trace_memory
+    _enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+
+
+def is_enabled():
+    """Return true if stage measurements are being recorded"""
+    return _enabled
+
+
+def add_callback(func):
+    """Add a function called with each new :class:`StageRecord`
+
+    This can be used to forward the measurements to a monitoring system.
+    The callback is called from the thread which ran the stage.
+    """
+    with _lock:
+        _callbacks.append(func)
+
+
+def remove_callback(func):
+    """Remove a function added with :func:`add_callback`"""
+    with _lock:
+        _callbacks.remove(func)
+
+
+def get_records(name=None):
+    """Return the recorded stage measurements
+
+    Parameters
+    ----------
+    name : str, optional
+        If given, only return the records of stages with this name.
+
+    Returns
+    -------
+    list
+        List of :class:`StageRecord` in the order the stages finished.
+    """
+    with _lock:
+        records = list(_records)
+    if name is not None:
+        records = [r for r in records if r.name == name]
+    return records
+
+
+def summary():
+    """Return the total time, bytes and frames of each stage
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by stage name of dictionaries with the number of
+        ``calls``, total ``wall_time``, ``nbytes_in``, ``nbytes_out`` and
+        ``nframes`` and the overall ``frames_per_second``.
+    """
+    totals = {}
+    for r in get_records():
+        t = totals.setdefault(
+            r.name,
+            {
+                "calls": 0,
+                "wall_time": 0.0,
+                "nbytes_in": 0,
+                "nbytes_out": 0,
+                "nframes": 0,
+            },
+        )
+        t["calls"] += 1
+        t["wall_time"] += r.wall_time
+        t["nbytes_in"] += r.nbytes_in
+        t["nbytes_out"] += r.nbytes_out
+        t["nframes"] += r.nframes
+
+    for t in totals.values():
+        t["frames_per_second"] = (
+            t["nframes"] / t["wall_time"] if t["wall_time"] > 0 else 0.0
+        )
+    return totals
+
+
+def clear():
+    """Remove all the recorded stage measurements"""
+    with _lock:
+        _records.clear()
+
+
+@contextmanager
+def stage(name, data=None):
+    """Context manager to measure a processing stage
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    data : array_like, optional
+        Input array of the stage, used to record the input size and number
+        of frames.
+
+    Yields
+    ------
+    StageRecord
+        The record of the stage. Call its ``set_output()`` method with the
+        result to record the output size.
+
+    Example
+    -------
+    >>> with stage("my_correction", images) as s:
+    ...     out = correct_images(images, dark)
+    ...     s.set_output(out)
+    >>> get_records("my_correction")[-1].frames_per_second
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    parent = stack[-1] if stack else None
+    record = StageRecord(name, parent.name if parent is not None else None)
+    if data is not None:
+        record.set_input(data)
+
+    trace = _enabled and _trace_memory and tracemalloc.is_tracing()
+    if trace:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        record.peak_memory = 0
+
+    stack.append(record)
+    t = ttime.perf_counter()
+    try:
+        yield record
+    finally:
+        record.wall_time = ttime.perf_counter() - t
+        stack.pop()
+
+        if trace:
+            # The peak was reset by any nested stage so include theirs
+            peak = max(tracemalloc.get_traced_memory()[1], record.peak_memory)
+            if parent is not None and parent.peak_memory is not None:
+                parent.peak_memory = max(parent.peak_memory, peak)
+            record.peak_memory = max(peak - start_memory, 0)
+
+        if _enabled:
+            _publish(record)
+
+
+def _publish(record):
+    with _lock:
+        _records.append(record)
+        callbacks = list(_callbacks)
+
+    for func in callbacks:
+        try:
+            func(record)
+        except Exception:
+            logger.exception("Error in profiling callback %r", func)
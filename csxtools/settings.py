@@ -1,3 +1,5 @@
+import os
+
 detectors = {}
 detectors["fccd"] = "fccd_image"
 detectors["axis1"] = "axis1_image"
@@ -6,3 +8,9 @@ detectors["axis_standard"] = "axis_standard_image"
 detectors["axis_cont"] = "axis_cont_image"
 
 diff_angles = ["delta", "theta", "gamma", None, None, None]
+
+# Directory of the flatfield store (see csxtools.flatfield.FlatfieldStore)
+flatfield_dir = os.environ.get(
+    "CSXTOOLS_FLATFIELD_DIR",
+    os.path.join(os.path.expanduser("~"), ".csxtools", "flatfields"),
+)
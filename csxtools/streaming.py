@@ -0,0 +1,167 @@
+import time as ttime
+from copy import deepcopy
+
+import numpy as np
+from event_model import DocumentRouter
+
+from .fastccd import correct_images
+from .axis1 import correct_images_axis
+from .profiling import stage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CorrectionRouter(DocumentRouter):
+    """Correct detector images in a live bluesky document stream
+
+    The router consumes the documents of a run as they are produced (for
+    example by subscribing it to the RunEngine or adding it to an
+    ``event_model.RunRouter``) and returns the same documents with the
+    corrected images added under ``data_key + "_corrected"``. Events and
+    event pages are corrected as soon as they arrive with a single call to
+    the C correction for each page, so the latency is that of correcting
+    one page.
+
+    The dark images are obtained once per run and reused for every page.
+
+    Parameters
+    ----------
+    data_key : str
+        Data key of the images to correct, e.g. ``"fccd_image"``.
+    dark : array_like or callable, optional
+        Dark images. For the FastCCD this is an array of shape (3, y, x)
+        (see :func:`csxtools.fastccd.correct_images`) and for the AXIS
+        detectors of shape (y, x). If callable, it is called with the
+        start document of each run and must return the dark images. To
+        share darks between runs, get them with
+        :meth:`csxtools.pipeline.Pipeline.darks` which caches the reduced
+        darks by the uids of the dark runs.
+    flat : array_like, optional
+        Flatfield of shape (y, x).
+    gain : tuple, optional
+        Gain multipliers of the FastCCD.
+    detector : string
+        'fccd' to use :func:`csxtools.fastccd.correct_images` or 'axis' to
+        use :func:`csxtools.axis1.correct_images_axis`.
+    drop_raw : bool
+        If true, remove the raw images from the output documents.
+    callback : callable, optional
+        Function called with ``(name, doc)`` for every output document,
+        e.g. a live viewer or a ``bluesky.callbacks.zmq.Publisher``.
+    filler : callable, optional
+        Function called with ``(name, doc)`` which returns the document
+        with external data filled in, e.g. an ``event_model.Filler``. The
+        images must be filled before they can be corrected.
+
+    Example
+    -------
+    >>> router = CorrectionRouter("fccd_image", dark, callback=viewer,
+    ...                           filler=Filler(handler_registry))
+    >>> RE.subscribe(router)
+    """
+
+    def __init__(
+        self,
+        data_key,
+        dark=None,
+        flat=None,
+        gain=(1, 4, 8),
+        detector="fccd",
+        drop_raw=False,
+        callback=None,
+        filler=None,
+    ):
+        if detector not in ("fccd", "axis"):
+            raise ValueError("detector must be 'fccd' or 'axis'")
+
+        self.data_key = data_key
+        self.out_data_key = data_key + "_corrected"
+        self.dark = dark
+        self.flat = flat
+        self.gain = gain
+        self.detector = detector
+        self.drop_raw = drop_raw
+        self.callback = callback
+        self.filler = filler
+
+        self._run_dark = None
+        self._descriptors = set()
+
+    def __call__(self, name, doc, validate=False):
+        if self.filler is not None:
+            name, doc = self.filler(name, doc)
+        name, doc = super().__call__(name, doc, validate)
+        if self.callback is not None:
+            self.callback(name, doc)
+        return name, doc
+
+    def start(self, doc):
+        if callable(self.dark):
+            t = ttime.time()
+            self._run_dark = self.dark(doc)
+            logger.info("Obtained dark images in %.3f seconds", ttime.time() - t)
+        else:
+            self._run_dark = self.dark
+        self._descriptors.clear()
+        return doc
+
+    def descriptor(self, doc):
+        if self.data_key not in doc["data_keys"]:
+            return doc
+
+        self._descriptors.add(doc["uid"])
+        doc = dict(doc)
+        doc["data_keys"] = deepcopy(doc["data_keys"])
+
+        data_key = dict(doc["data_keys"][self.data_key])
+        data_key.pop("external", None)
+        data_key["source"] = "csxtools.streaming"
+        data_key["dtype"] = "array"
+        data_key["dtype_str"] = "<f4"
+        doc["data_keys"][self.out_data_key] = data_key
+
+        if self.drop_raw:
+            doc["data_keys"].pop(self.data_key)
+            for obj in doc.get("object_keys", {}).values():
+                if self.data_key in obj:
+                    obj.remove(self.data_key)
+        return doc
+
+    def event_page(self, doc):
+        if doc["descriptor"] not in self._descriptors:
+            return doc
+
+        filled = doc.get("filled", {}).get(self.data_key)
+        if filled is not None and not all(filled):
+            raise ValueError(
+                "Images in {} are not filled. Pass a filler to "
+                "CorrectionRouter.".format(self.data_key)
+            )
+
+        raw = np.asarray(doc["data"][self.data_key])
+        with stage("stream_correct", raw):
+            corrected = self.correct(raw)
+
+        doc = dict(doc)
+        doc["data"] = dict(doc["data"])
+        doc["timestamps"] = dict(doc["timestamps"])
+        doc["data"][self.out_data_key] = corrected
+        doc["timestamps"][self.out_data_key] = [ttime.time()] * len(corrected)
+        if "filled" in doc:
+            doc["filled"] = dict(doc["filled"])
+            doc["filled"][self.out_data_key] = [True] * len(corrected)
+
+        if self.drop_raw:
+            doc["data"].pop(self.data_key)
+            doc["timestamps"].pop(self.data_key)
+            if "filled" in doc:
+                doc["filled"].pop(self.data_key, None)
+        return doc
+
+    def correct(self, images):
+        """Correct a stack of raw images of shape (N, ..., y, x)"""
+        if self.detector == "fccd":
+            return correct_images(images, self._run_dark, self.flat, self.gain)
+        return correct_images_axis(images, self._run_dark, self.flat)
@@ -0,0 +1,101 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from .ext import image as extimage
+
+# Number of threads used by the C extensions. A value of 0 uses the OpenMP
+# default (normally the number of cores or OMP_NUM_THREADS).
+_num_threads = int(os.environ.get("CSXTOOLS_NUM_THREADS", 0))
+
+# Per python-thread override set by the num_threads() context manager
+_local = threading.local()
+
+
+def set_num_threads(nthreads=None):
+    """Set the number of threads used by the C extensions
+
+    This sets the default number of OpenMP threads used by all the
+    routines in :mod:`csxtools.fastccd`, :mod:`csxtools.axis1` and
+    :mod:`csxtools.image`. This is useful to avoid oversubscribing a node
+    when running inside dask workers or a process pool. The initial value
+    can be set with the ``CSXTOOLS_NUM_THREADS`` environment variable.
+
+    Parameters
+    ----------
+    nthreads : int, optional
+        Number of threads to use. If `None` or 0, use the OpenMP default.
+    """
+    global _num_threads
+
+    if nthreads is None:
+        nthreads = 0
+    if nthreads < 0:
+        raise ValueError("nthreads must be a positive integer")
+    _num_threads = int(nthreads)
+
+
+def get_num_threads():
+    """Return the number of threads used by the C extensions
+
+    Returns
+    -------
+    int
+        Number of threads used by the next call to a C routine from this
+        thread.
+    """
+    nthreads = resolve_nthreads()
+    if nthreads == 0:
+        nthreads = extimage.max_threads()
+    return nthreads
+
+
+@contextmanager
+def num_threads(nthreads):
+    """Context manager to temporarily set the number of threads
+
+    The setting only applies to calls made from the current python thread
+    so it can be used safely from threaded dask workers.
+
+    Parameters
+    ----------
+    nthreads : int
+        Number of threads to use. If `None` or 0, use the OpenMP default.
+
+    Example
+    -------
+    >>> with num_threads(4):
+    ...     images = correct_images(raw, dark)
+    """
+    if nthreads is None:
+        nthreads = 0
+    if nthreads < 0:
+        raise ValueError("nthreads must be a positive integer")
+
+    previous = getattr(_local, "nthreads", None)
+    _local.nthreads = int(nthreads)
+    try:
+        yield
+    finally:
+        _local.nthreads = previous
+
+
+def resolve_nthreads(nthreads=None):
+    """Return the number of threads to pass to a C routine
+
+    Parameters
+    ----------
+    nthreads : int, optional
+        Number of threads requested for the call. If `None`, use the value
+        from :func:`num_threads` or :func:`set_num_threads`.
+
+    Returns
+    -------
+    int
+        Number of threads, 0 meaning the OpenMP default.
+    """
+    if nthreads is None:
+        nthreads = getattr(_local, "nthreads", None)
+    if nthreads is None:
+        nthreads = _num_threads
+    return int(nthreads)
@@ -1,10 +1,11 @@
 import numpy as np
-import time as ttime
 
-from .fastccd import correct_images
-from .axis1 import correct_images_axis
-from .image import rotate90, stackmean
-from .settings import detectors
+from .image import StackAccumulator
+from .ext import image as extimage
+from .threads import resolve_nthreads
+from .io import read_timestamps
+from .pipeline import Pipeline, convert_roi, detector_for_tag
+from .pipeline import _get_images  # noqa: F401
 from databroker.assets.handlers import AreaDetectorHDF5TimestampHandler
 
 import logging
@@ -13,7 +14,15 @@ logger = logging.getLogger(__name__)
 
 
 def get_fastccd_images(
-    light_header, dark_headers=None, flat=None, gain=(1, 4, 8), tag=None, roi=None
+    light_header,
+    dark_headers=None,
+    flat=None,
+    gain=(1, 4, 8),
+    tag=None,
+    roi=None,
+    dark_reducer=None,
+    common_mode=None,
+    direct=False,
 ):
     """Retreive and correct FastCCD Images from associated headers
 
@@ -36,9 +45,12 @@ def get_fastccd_images(
         (most sensitive to least sensitive) settings. If a set is not
         avaliable then ``None`` can be entered.
 
-    flat : array_like
+    flat : array_like or "auto"
         Array to use for the flatfield correction. This should be a 2D
-        array sized as the last two dimensions of the image stack.
+        array sized as the last two dimensions of the image stack. If
+        ``"auto"``, use the flatfield from the
+        :class:`csxtools.flatfield.FlatfieldStore` valid at the time of
+        the light header.
 
     gain : tuple
         Gain multipliers for the 3 gain settings (most sensitive to
@@ -53,81 +65,66 @@ def get_fastccd_images(
         coordinates of the upper-left corner and width and height of
         the ROI: e.g., (x, y, w, h)
 
+    dark_reducer : callable
+        Function used to reduce each stack of dark images to a single
+        image. If `None`, use :func:`csxtools.image.stackmean`. Use
+        :func:`csxtools.image.stackmedian` or
+        :func:`csxtools.image.stackclipmean` to reject cosmic rays.
+
+    common_mode : dict or bool
+        If not `None` (or `False`) remove the common mode offset of the
+        readout channels after correction using
+        :func:`csxtools.fastccd.correct_common_mode`. A dict is passed as
+        keyword arguments. Any ``mask`` should be in the orientation of
+        the returned images and is cropped to the ROI.
+
+    direct : bool
+        If true, read the AreaDetector HDF5 files directly with
+        :func:`csxtools.io.read_images` instead of through the databroker
+        handlers. The images are then read into memory.
+
     Returns
     -------
     dask.array : corrected images
 
     """
 
-    if tag is None:
-        tag = detectors["fccd"]
-
-    # Now lets sort out the ROI
-    if roi is not None:
-        roi = list(roi)
-        # Convert ROI to start:stop from start:size
-        roi[2] = roi[0] + roi[2]
-        roi[3] = roi[1] + roi[3]
-        logger.info("Computing with ROI of %s", str(roi))
-
-    if dark_headers is None:
-        bgnd = None
-        logger.warning("Processing without dark images")
-    else:
-        if dark_headers[0] is None:
-            raise NotImplementedError(
-                "Use of header metadata to find dark" " images is not implemented yet."
-            )
-
-        # Read the images for the dark headers
-        t = ttime.time()
-
-        dark = []
-        for i, d in enumerate(dark_headers):
-            if d is not None:
-                # Get the images
-
-                bgnd_events = _get_images(d, tag, roi)
-
-                # We assume that all images are for the background
-                # TODO : Perhaps we can loop over the generator
-                # If we want to do something lazy
-
-                tt = ttime.time()
-                b = bgnd_events.astype(dtype=np.uint16)
-                logger.info("Image conversion took %.3f seconds", ttime.time() - tt)
-
-                b = correct_images(b, gain=(1, 1, 1))
-                tt = ttime.time()
-                b = stackmean(b)
-                logger.info("Mean of image stack took %.3f seconds", ttime.time() - tt)
-
-            else:
-                if i == 0:
-                    logger.warning("Missing dark image" " for gain setting 8")
-                elif i == 1:
-                    logger.warning("Missing dark image" " for gain setting 2")
-                elif i == 2:
-                    logger.warning("Missing dark image" " for gain setting 1")
-
-            dark.append(b)
-
-        bgnd = np.array(dark)
-
-        logger.info("Computed dark images in %.3f seconds", ttime.time() - t)
-
-    events = _get_images(light_header, tag, roi)
-
-    # Ok, so lets return a pims pipeline which does the image conversion
-
-    # Crop Flatfield image
-    if flat is not None and roi is not None:
-        flat = _crop(flat, roi)
-
-    return _correct_fccd_images(events, bgnd, flat, gain)
-
-
-def get_axis_images(light_header, dark_header=None, flat=None, tag=None, roi=None):
+    if isinstance(flat, str) and flat == "auto":
+        from .flatfield import FlatfieldStore
+
+        flat = FlatfieldStore().load("fccd", light_header.start["time"])
+
+    roi = convert_roi(roi)
+
+    if common_mode is True:
+        common_mode = {}
+    elif common_mode is False:
+        common_mode = None
+    if common_mode is not None and roi is not None:
+        if common_mode.get("mask") is not None:
+            # The rows of the rotated images are the x axis of the ROI
+            common_mode = dict(common_mode)
+            common_mode["mask"] = np.asarray(common_mode["mask"])[
+                roi[0] : roi[2], roi[1] : roi[3]
+            ]
+
+    pipe = Pipeline(
+        "fccd", tag, dark_reducer, direct, stage_prefix="get_fastccd_images"
+    )
+    return pipe.images(
+        light_header, dark_headers, flat, roi, gain=gain, common_mode=common_mode
+    )
+
+
+def get_axis_images(
+    light_header,
+    dark_header=None,
+    flat=None,
+    tag=None,
+    roi=None,
+    dark_reducer=None,
+    direct=False,
+):
     """Retreive and correct AXIS Images from associated headers
 
     Retrieve AXIS Images from databroker and correct for:
@@ -159,60 +156,47 @@ def get_axis_images(light_header, dark_header=None, flat=None, tag=None, roi=Non
         coordinates of the upper-left corner and width and height of
         the ROI: e.g., (x, y, w, h)
 
+    dark_reducer : callable
+        Function used to reduce the stack of dark images to a single
+        image. If `None`, use :func:`csxtools.image.stackmean`.
+
+    direct : bool
+        If true, read the AreaDetector HDF5 files directly with
+        :func:`csxtools.io.read_images` instead of through the databroker
+        handlers. The images are then read into memory.
+
     Returns
     -------
     dask.array : corrected images
 
     """
-    flipped_image = _get_axis1_images(light_header, dark_header, flat, tag, roi)
+    flipped_image = _get_axis1_images(
+        light_header, dark_header, flat, tag, roi, dark_reducer, direct
+    )
     return flipped_image[..., ::-1]
 
 
-def _get_axis1_images(light_header, dark_header=None, flat=None, tag=None, roi=None):
+def _get_axis1_images(
+    light_header,
+    dark_header=None,
+    flat=None,
+    tag=None,
+    roi=None,
+    dark_reducer=None,
+    direct=False,
+):
+    return _axis_pipeline(tag, dark_reducer, direct).images(
+        light_header, dark_header, flat, convert_roi(roi)
+    )
+
 
+def _axis_pipeline(tag, dark_reducer=None, direct=False):
+    """Return the pipeline for the AXIS detector with the data key ``tag``"""
     if tag is None:
         logger.error("Must pass 'tag' argument to get_axis_images()")
         raise ValueError("Must pass 'tag' argument")
-
-    # Now lets sort out the ROI
-    if roi is not None:
-        roi = list(roi)
-        # Convert ROI to start:stop from start:size
-        roi[2] = roi[0] + roi[2]
-        roi[3] = roi[1] + roi[3]
-        logger.info("Computing with ROI of %s", str(roi))
-
-    if dark_header is None:
-        bgnd = None
-        logger.warning("Processing without dark images")
-    else:
-
-        # Read the images for the dark headers
-        t = ttime.time()
-
-        d = dark_header
-        bgnd_events = _get_images(d, tag, roi)
-
-        tt = ttime.time()
-        b = bgnd_events.astype(dtype=np.uint16)
-        logger.info("Image conversion took %.3f seconds", ttime.time() - tt)
-        tt = ttime.time()
-        b = stackmean(b)
-        logger.info("Mean of image stack took %.3f seconds", ttime.time() - tt)
-
-        bgnd = np.array(b)
-
-        logger.info("Computed dark images in %.3f seconds", ttime.time() - t)
-
-    events = _get_images(light_header, tag, roi)
-
-    # Ok, so lets return a pims pipeline which does the image conversion
-
-    # Crop Flatfield image
-    if flat is not None and roi is not None:
-        flat = _crop(flat, roi)
-
-    return _correct_axis_images(events, bgnd, flat)
+    detector = detector_for_tag(tag, default="axis1")
+    return Pipeline(detector, tag, dark_reducer, direct, stage_prefix="get_axis_images")
 
 
 def get_images_to_4D(images, dtype=None):
@@ -261,40 +245,7 @@ def get_images_to_3D(images, dtype=None):
     return im
 
 
-def _get_images(header, tag, roi=None):
-    run = header.v2.new_variation(structure_clients="dask")
-    images = run["primary"]["data"][tag][:]
-    if roi is not None:
-        images = _crop_images(images, roi)
-    return images
-
-
-def _correct_fccd_images(image, bgnd, flat, gain):
-    image = correct_images(image, bgnd, flat, gain)
-    image = rotate90(image, "cw")
-    return image
-
-
-def _correct_axis_images(image, bgnd, flat):
-    """
-    The correct_images_axis modified to include rotate90
-    """
-    image = correct_images_axis(image, bgnd, flat)
-    return image
-
-
-def _crop_images(image, roi):
-    return _crop(image, roi)
-
-
-def _crop(image, roi):
-    image_shape = image.shape
-    # Assuming ROI is specified in the "rotated" (correct) orientation
-    roi = [image_shape[-2] - roi[3], roi[0], image_shape[-1] - roi[1], roi[2]]
-    return image.T[roi[1] : roi[3], roi[0] : roi[2]].T
-
-
-def get_fastccd_timestamps(header, tag="fccd_image"):
+def get_fastccd_timestamps(header, tag="fccd_image", direct=False):
     """Return the FastCCD timestamps from the Areadetector Data File
 
     Return a list of numpy arrays of the timestamps for the images as
@@ -306,19 +257,26 @@ def get_fastccd_timestamps(header, tag="fccd_image"):
         This header defines the run
     tag : string
         This is the tag or name of the fastccd.
+    direct : bool
+        If true, read the timestamps of all the events from the data
+        files at once with :func:`csxtools.io.read_timestamps`. A single
+        array of shape (number of events, ...) is then returned.
 
     Returns
     -------
         list of arrays of the timestamps
 
     """
+    if direct:
+        return read_timestamps(header, tag)
+
     with header.db.reg.handler_context({"AD_HDF5": AreaDetectorHDF5TimestampHandler}):
         timestamps = list(header.data(tag))
 
     return timestamps
 
 
-def get_axis_timestamps(header, tag="axis1_hdf5_time_stamp"):
+def get_axis_timestamps(header, tag="axis1_hdf5_time_stamp", direct=False):
     """Return the AXIS timestamps from the Areadetector Data File
 
     Return a list of numpy arrays of the timestamps for the images as
@@ -330,12 +288,18 @@ def get_axis_timestamps(header, tag="axis1_hdf5_time_stamp"):
         This header defines the run
     tag : string
         This is the tag or name of the fastccd.
+    direct : bool
+        If true, read the timestamps of all the events from the data
+        files at once with :func:`csxtools.io.read_timestamps`. A single
+        array of shape (number of events, ...) is then returned.
 
     Returns
     -------
         list of arrays of the timestamps
 
     """
+    if direct:
+        return read_timestamps(header, tag)
 
     timestamps = list(header.data(tag))
 
@@ -348,7 +312,9 @@ def calculate_flatfield(image, limits=(0.6, 1.4)):
     This routine calculates the flatfield correction from fluorescence data
     The image is thresholded by limits from the median value of the image.
     The flatfield is then constructed from the mean of the image divided by
-    the masked (by NaN) image resulting in a true flatfield correction
+    the masked (by NaN) image resulting in a true flatfield correction.
+    The returned flatfield is rotated 90 deg ccw. The calculation is done
+    in C and the input image is not modified.
 
     Parameters
     ----------
@@ -364,20 +330,11 @@ def calculate_flatfield(image, limits=(0.6, 1.4)):
 
     """
 
-    flat = image
-    limits = np.array(limits)
-    limits = np.nanmedian(image) * limits
-
-    flat[flat < limits[0]] = np.nan
-    flat[flat > limits[1]] = np.nan
-    flat = np.nanmean(flat) / flat
-    flat = np.rot90(flat)
-
-    return flat
+    return extimage.flatfield(image, tuple(limits), resolve_nthreads())
 
 
 def get_fastccd_flatfield(
-    light, dark, flat=None, limits=(0.6, 1.4), half_interval=False
+    light, dark, flat=None, limits=(0.6, 1.4), half_interval=False, chunk_size=100
 ):
     """Calculate a flatfield from two headers
 
@@ -398,6 +355,9 @@ def get_fastccd_flatfield(
     half_interval : boolean or tuple to perform calculation for only half of the FastCCD
         Default is False. If True, then the hard-code portion is retained.  Customize image
         manipulation using a tuple of length 2 for (row_start, row_stop).
+    chunk_size : int
+        Number of events read and corrected at once. The light images are
+        averaged a chunk at a time so the whole run is never in memory.
 
 
     Returns
@@ -405,26 +365,15 @@ def get_fastccd_flatfield(
     array_like
         Flatfield correction.  The correction is orientated as "raw data" not final data generated by get_fastccd_images().
     """
-    images = get_images_to_3D(get_fastccd_images(light, dark, flat))
-    images = stackmean(images)
-    if half_interval:
-        if isinstance(half_interval, bool):
-            row_start, row_stop = (7, 486)  # hard coded for the broken half of the fccd
-        else:
-            row_start, row_stop = half_interval
-            print(row_start, row_stop)
-        images[:, row_start:row_stop] = np.nan
-    flat = calculate_flatfield(images, limits)
-    removed = np.sum(np.isnan(flat))
-    if removed != 0:
-        logger.warning(
-            "Flatfield correction removed %d pixels (%.2f %%)"
-            % (removed, removed * 100 / flat.size)
-        )
-    return flat
+    acc = Pipeline("fccd").accumulate(
+        StackAccumulator(), light, dark, flat, chunk_size=chunk_size
+    )
+    return _finish_flatfield(acc.mean, limits, half_interval)
 
 
-def get_axis_flatfield(light, dark, flat=None, limits=(0.6, 1.4), half_interval=False):
+def get_axis_flatfield(
+    light, dark, flat=None, limits=(0.6, 1.4), half_interval=False, chunk_size=100
+):
     """Calculate a flatfield from two headers
 
     This routine calculates the flatfield using the
@@ -444,6 +393,9 @@ def get_axis_flatfield(light, dark, flat=None, limits=(0.6, 1.4), half_interval=
     half_interval : boolean or tuple to perform calculation for only half of the FastCCD
         Default is False. If True, then the hard-code portion is retained.  Customize image
         manipulation using a tuple of length 2 for (row_start, row_stop).
+    chunk_size : int
+        Number of events read and corrected at once. The light images are
+        averaged a chunk at a time so the whole run is never in memory.
 
 
     Returns
@@ -451,8 +403,14 @@ def get_axis_flatfield(light, dark, flat=None, limits=(0.6, 1.4), half_interval=
     array_like
         Flatfield correction.  The correction is orientated as "raw data" not final data generated by get_fastccd_images().
     """
-    images = get_images_to_3D(_get_axis1_images(light, dark, flat))
-    images = stackmean(images)
+    acc = Pipeline("axis1").accumulate(
+        StackAccumulator(), light, dark, flat, chunk_size=chunk_size
+    )
+    return _finish_flatfield(acc.mean, limits, half_interval)
+
+
+def _finish_flatfield(images, limits=(0.6, 1.4), half_interval=False):
+    """Calculate the flatfield from the mean image"""
     if half_interval:
         if isinstance(half_interval, bool):
             row_start, row_stop = (7, 486)  # hard coded for the broken half of the fccd
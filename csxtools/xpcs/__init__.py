@@ -0,0 +1,18 @@
+from .correlation import MultiTauCorrelator, multi_tau_auto_corr, multi_tau_lags
+from .twotime import two_time_corr
+from .speckle import photon_statistics, speckle_contrast
+
+__all__ = [
+    "MultiTauCorrelator",
+    "multi_tau_auto_corr",
+    "multi_tau_lags",
+    "two_time_corr",
+    "photon_statistics",
+    "speckle_contrast",
+]
+
+# set version string using versioneer
+from .._version import get_versions
+
+__version__ = get_versions()["version"]
+del get_versions
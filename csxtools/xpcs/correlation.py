@@ -0,0 +1,247 @@
+import numpy as np
+import time as ttime
+from ..ext import xpcs as extxpcs
+from ..threads import resolve_nthreads
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def multi_tau_lags(num_levels, num_bufs):
+    """Calculate the lag steps of a multi-tau correlator
+
+    Parameters
+    ----------
+    num_levels : int
+        Number of levels of the correlator.
+    num_bufs : int
+        Number of buffers per level. This must be even.
+
+    Returns
+    -------
+    array
+        1D array of lag steps (in frames) for each channel.
+    """
+    if num_bufs % 2:
+        raise ValueError("num_bufs must be even")
+
+    lags = [np.arange(num_bufs)]
+    for level in range(1, num_levels):
+        lags.append(np.arange(num_bufs // 2, num_bufs) * 2**level)
+    return np.concatenate(lags)
+
+
+def _iter_frame_blocks(images, chunk_size):
+    """Yield blocks of frames of shape (n, y, x) from images
+
+    ``images`` can be any array (numpy, dask, h5py ...) of shape
+    (..., y, x) which is read ``chunk_size`` frames at a time, or an
+    iterable of such arrays.
+    """
+    if not hasattr(images, "ndim"):
+        for block in images:
+            yield from _iter_frame_blocks(block, chunk_size)
+        return
+
+    if images.ndim == 2:
+        yield np.asarray(images)[np.newaxis]
+    elif images.ndim == 3:
+        for i in range(0, images.shape[0], chunk_size):
+            yield np.asarray(images[i : i + chunk_size])
+    else:
+        for image in images:
+            yield from _iter_frame_blocks(image, chunk_size)
+
+
+def _roi_pixels(labels):
+    """Return the ROI ids, pixel indices and ROI start offsets of labels
+
+    The flat indices of the labelled pixels are sorted by ROI so the
+    pixels of ROI ``i`` are ``pixels[roi_start[i]:roi_start[i + 1]]``.
+    """
+    flat = np.asarray(labels).ravel()
+    pixels = np.flatnonzero(flat > 0)
+    pixels = pixels[np.argsort(flat[pixels], kind="stable")]
+    roi_ids = np.unique(flat[pixels])
+    roi_start = np.searchsorted(flat[pixels], np.append(roi_ids, np.inf))
+    return (
+        roi_ids,
+        np.ascontiguousarray(pixels, dtype=np.intp),
+        roi_start.astype(np.intp),
+    )
+
+
+class MultiTauCorrelator(object):
+    """Streaming multi-tau correlator for XPCS
+
+    This calculates the one-time intensity autocorrelation g2 of the
+    pixels in each region of interest (ROI) using the multi-tau scheme.
+    Frames are added as they are produced (e.g. a chunk at a time from
+    :func:`csxtools.get_fastccd_images`) so the whole stack never needs to
+    be held in memory. The correlation is calculated in C using OpenMP.
+
+    For each ROI and lag tau the symmetric normalisation is used::
+
+        g2(tau) = <I(t) I(t + tau)> / (<I(t)> <I(t + tau)>)
+
+    where the brackets are averages over the pixels of the ROI and the
+    frames. Pixels which are not finite (e.g. ``np.nan`` for masked
+    pixels) in either image of a pair are left out of the averages of
+    that pair.
+
+    Parameters
+    ----------
+    labels : array_like
+        Integer array of shape (y, x) labelling the ROIs. Pixels with a
+        label of 0 are not used.
+    num_levels : int
+        Number of levels of the correlator.
+    num_bufs : int
+        Number of buffers per level. This must be even.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Example
+    -------
+    >>> images = get_fastccd_images(light_header, dark_headers)
+    >>> corr = MultiTauCorrelator(labels, num_levels=8, num_bufs=16)
+    >>> corr.update(images)
+    >>> lags, g2 = corr.result()
+    >>> tau = lags * get_fastccd_exp(light_header).exp_period
+    """
+
+    def __init__(self, labels, num_levels=7, num_bufs=8, nthreads=None):
+        if num_bufs % 2:
+            raise ValueError("num_bufs must be even")
+        if num_levels < 1:
+            raise ValueError("num_levels must be at least 1")
+
+        labels = np.asarray(labels)
+        if labels.ndim != 2:
+            raise ValueError("labels must be a 2D array")
+
+        self.shape = labels.shape
+        self.num_levels = num_levels
+        self.num_bufs = num_bufs
+        self.nthreads = nthreads
+        self.nframes = 0
+
+        self.roi_ids, self._pixels, self._roi_start = _roi_pixels(labels)
+        pixels = self._pixels
+
+        self.lag_steps = multi_tau_lags(num_levels, num_bufs)
+        nchannels = len(self.lag_steps)
+        nroi = len(self.roi_ids)
+
+        self._buf = np.zeros((num_levels, num_bufs, len(pixels)), dtype=np.float32)
+        self._cur = np.full(num_levels, num_bufs - 1, dtype=np.int32)
+        self._img_per_level = np.zeros(num_levels, dtype=np.int64)
+        self._track_level = np.zeros(num_levels, dtype=np.int32)
+        self._G = np.zeros((nchannels, nroi), dtype=np.float64)
+        self._IP = np.zeros((nchannels, nroi), dtype=np.float64)
+        self._IF = np.zeros((nchannels, nroi), dtype=np.float64)
+        self._count = np.zeros((nchannels, nroi), dtype=np.int64)
+
+    def update(self, images, chunk_size=100):
+        """Add images to the correlator
+
+        Parameters
+        ----------
+        images : array_like or iterable
+            Images of shape (..., y, x) added in order. All leading axes
+            are treated as a single series of frames. Arrays which are not
+            in memory (e.g. dask or h5py) are read ``chunk_size`` frames at
+            a time. An iterable of such arrays is also accepted.
+        chunk_size : int
+            Number of frames read at once.
+        """
+        t = ttime.time()
+        nframes = 0
+
+        for block in _iter_frame_blocks(images, chunk_size):
+            if block.shape[-2:] != self.shape:
+                raise ValueError(
+                    "Image shape {} does not match labels shape {}".format(
+                        block.shape[-2:], self.shape
+                    )
+                )
+            extxpcs.multitau(
+                block,
+                self._pixels,
+                self._roi_start,
+                self._buf,
+                self._cur,
+                self._img_per_level,
+                self._track_level,
+                self._G,
+                self._IP,
+                self._IF,
+                self._count,
+                resolve_nthreads(self.nthreads),
+            )
+            nframes += block.shape[0]
+
+        self.nframes += nframes
+        t = ttime.time() - t
+        logger.info(
+            "Correlated %d frames in %.3f seconds (%.1f frames/s)",
+            nframes,
+            t,
+            nframes / t if t > 0 else np.inf,
+        )
+
+    def result(self):
+        """Return the correlation
+
+        Returns
+        -------
+        lag_steps : array
+            1D array of lag steps (in frames) of the channels computed.
+        g2 : array
+            Array of shape (len(lag_steps), number of ROIs) of the
+            normalised intensity autocorrelation.
+        """
+        valid = (self._count > 0).any(axis=1)
+        count = self._count[valid]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            g2 = (self._G[valid] * count) / (self._IP[valid] * self._IF[valid])
+        return self.lag_steps[valid], g2
+
+
+def multi_tau_auto_corr(
+    images, labels, num_levels=7, num_bufs=8, chunk_size=100, nthreads=None
+):
+    """Calculate the multi-tau one-time correlation of a stack of images
+
+    This is a convenience function which feeds ``images`` through a
+    :class:`MultiTauCorrelator` a chunk at a time.
+
+    Parameters
+    ----------
+    images : array_like or iterable
+        Corrected images of shape (..., y, x). See
+        :meth:`MultiTauCorrelator.update`.
+    labels : array_like
+        Integer array of shape (y, x) labelling the ROIs. Pixels with a
+        label of 0 are not used.
+    num_levels : int
+        Number of levels of the correlator.
+    num_bufs : int
+        Number of buffers per level. This must be even.
+    chunk_size : int
+        Number of frames read at once.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    tuple
+        tuple of the lag steps (in frames) and the g2 array of shape
+        (number of lags, number of ROIs)
+    """
+    corr = MultiTauCorrelator(labels, num_levels, num_bufs, nthreads)
+    corr.update(images, chunk_size)
+    return corr.result()
@@ -0,0 +1,88 @@
+import numpy as np
+from ..ext import xpcs as extxpcs
+from ..threads import resolve_nthreads
+from .correlation import _roi_pixels
+
+
+def photon_statistics(data, labels, photon_energy=1.0, max_photons=10, nthreads=None):
+    """Calculate the photon number distribution of each ROI
+
+    For every frame and region of interest (ROI) this counts the number of
+    pixels which detected k photons, where k is the pixel value divided by
+    ``photon_energy`` and rounded to the nearest integer. The whole stack
+    is reduced in a single pass in C using OpenMP.
+
+    Parameters
+    ----------
+    data : array_like
+        Stack of images of shape (..., y, x) such as the energy returned by
+        :func:`csxtools.fastccd.photon_count`. Pixels which are ``np.nan``
+        are not counted.
+    labels : array_like
+        Integer array of shape (y, x) labelling the ROIs. Pixels with a
+        label of 0 are not used.
+    photon_energy : float
+        Value of a single photon in the units of data. The default of 1
+        is for data which is already in photon counts.
+    max_photons : int
+        Largest number of photons to histogram. Pixels with more photons
+        are counted in the last bin.
+    nthreads : int, optional
+        Number of threads to use. If `None`, use the value set by
+        :func:`csxtools.set_num_threads`.
+
+    Returns
+    -------
+    hist : array
+        Integer array of shape (..., number of ROIs, max_photons + 1) of
+        the number of pixels with k photons.
+    mean : array
+        Array of shape (..., number of ROIs) of the mean number of photons
+        per pixel (including those above max_photons).
+    """
+    _, pixels, roi_start = _roi_pixels(labels)
+    return extxpcs.photon_histogram(
+        data,
+        pixels,
+        roi_start,
+        1.0 / photon_energy,
+        max_photons,
+        resolve_nthreads(nthreads),
+    )
+
+
+def speckle_contrast(hist, axis=None):
+    """Calculate the speckle contrast from photon number histograms
+
+    The contrast (visibility) beta is found from the moments of the
+    photon number distribution assuming it is negative binomial::
+
+        beta = (<k^2> - <k>^2 - <k>) / <k>^2
+
+    Parameters
+    ----------
+    hist : array_like
+        Photon number histograms of shape (..., max_photons + 1) as
+        returned by :func:`photon_statistics`.
+    axis : int or tuple of ints, optional
+        Axes of ``hist`` (excluding the last) to sum over before
+        calculating the moments, e.g. ``axis=0`` to combine all frames.
+
+    Returns
+    -------
+    tuple
+        tuple of the probability P(k), the mean number of photons and the
+        contrast beta.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    if axis is not None:
+        hist = hist.sum(axis=axis)
+
+    k = np.arange(hist.shape[-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prob = hist / hist.sum(axis=-1, keepdims=True)
+        mean = (prob * k).sum(axis=-1)
+        var = (prob * k**2).sum(axis=-1) - mean**2
+        beta = (var - mean) / mean**2
+
+    return prob, mean, beta
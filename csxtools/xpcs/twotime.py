@@ -0,0 +1,181 @@
+import numpy as np
+import time as ttime
+from .correlation import _iter_frame_blocks, _roi_pixels
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _extract_roi_frames(images, pixels, frame_bin, chunk_size):
+    """Read the ROI pixels of images a chunk at a time
+
+    Returns an array of shape (number of binned frames, len(pixels)) where
+    each row is the mean of ``frame_bin`` consecutive frames. Frames left
+    over at the end which do not fill a bin are dropped.
+    """
+    rows = []
+    carry = np.empty((0, len(pixels)), dtype=np.float32)
+    shape = None
+
+    for block in _iter_frame_blocks(images, chunk_size):
+        if shape is None:
+            shape = block.shape[-2:]
+        elif block.shape[-2:] != shape:
+            raise ValueError("All images must have the same shape")
+
+        block = block.reshape(block.shape[0], -1)[:, pixels]
+        block = np.concatenate([carry, block.astype(np.float32)])
+
+        nbins = block.shape[0] // frame_bin
+        used = nbins * frame_bin
+        if nbins:
+            binned = block[:used].reshape(nbins, frame_bin, -1)
+            rows.append(binned.mean(axis=1, dtype=np.float64).astype(np.float32))
+        carry = block[used:]
+
+    if not rows:
+        return np.empty((0, len(pixels)), dtype=np.float32), shape
+
+    return np.concatenate(rows), shape
+
+
+def _blocks(nframes, block_size):
+    """Yield the tiles of the upper triangle of the matrix"""
+    for i0 in range(0, nframes, block_size):
+        i1 = min(i0 + block_size, nframes)
+        for j0 in range(i0, nframes, block_size):
+            yield i0, i1, j0, min(j0 + block_size, nframes)
+
+
+def _tiles(roi, nframes, block_size):
+    npix = roi.shape[1]
+    mean = roi.mean(axis=1, dtype=np.float64)
+    for i0, i1, j0, j1 in _blocks(nframes, block_size):
+        tile = np.dot(roi[i0:i1], roi[j0:j1].T).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tile /= npix * np.outer(mean[i0:i1], mean[j0:j1])
+        yield i0, i1, j0, j1, tile
+
+
+def _tiles_masked(roi, valid, nframes, block_size):
+    """Tiles of a ROI with pixels which are not finite
+
+    The averages of each pair of frames are taken over the pixels which
+    are finite in both frames. With ``v`` the mask of the finite pixels
+    and ``x`` the ROI with the other pixels set to zero, the sums over
+    these pixels are matrix products.
+    """
+    x = np.where(valid, roi, 0).astype(np.float32)
+    v = valid.astype(np.float32)
+    for i0, i1, j0, j1 in _blocks(nframes, block_size):
+        npix = np.dot(v[i0:i1], v[j0:j1].T).astype(np.float64)
+        s12 = np.dot(x[i0:i1], x[j0:j1].T).astype(np.float64)
+        s1 = np.dot(x[i0:i1], v[j0:j1].T).astype(np.float64)
+        s2 = np.dot(v[i0:i1], x[j0:j1].T).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tile = npix * s12 / (s1 * s2)
+        tile[npix == 0] = np.nan
+        yield i0, i1, j0, j1, tile
+
+
+def two_time_corr(
+    images,
+    labels,
+    frame_bin=1,
+    chunk_size=100,
+    block_size=1024,
+    filename=None,
+    dtype=np.float32,
+):
+    """Calculate the two-time correlation of a stack of images
+
+    The two-time correlation of each region of interest (ROI) is::
+
+        C(t1, t2) = <I(t1) I(t2)> / (<I(t1)> <I(t2)>)
+
+    where the brackets are averages over the pixels of the ROI which are
+    finite (e.g. not ``np.nan`` for masked pixels) in both frames. The images
+    are read ``chunk_size`` frames at a time and only the ROI pixels are
+    kept. The matrix is then calculated in tiles of ``block_size`` frames
+    using matrix multiplies (which use the threads of the BLAS library)
+    and, as it is symmetric, only the upper triangle of tiles is
+    calculated. The result can be written to a memory mapped file so that
+    it does not need to fit in memory.
+
+    Parameters
+    ----------
+    images : array_like or iterable
+        Corrected images of shape (..., y, x) such as those returned by
+        :func:`csxtools.get_fastccd_images`. All leading axes are treated
+        as a single series of frames. An iterable of such arrays is also
+        accepted.
+    labels : array_like
+        Integer array of shape (y, x) labelling the ROIs. Pixels with a
+        label of 0 are not used.
+    frame_bin : int
+        Number of consecutive frames to average before correlating. The
+        size of the result scales as 1 / frame_bin**2.
+    chunk_size : int
+        Number of frames read at once.
+    block_size : int
+        Number of (binned) frames in each tile of the calculation.
+    filename : str, optional
+        If given, the result is written to a ``.npy`` file of this name
+        and returned as a memory mapped array.
+    dtype : dtype
+        Data type of the result.
+
+    Returns
+    -------
+    array
+        Array of shape (number of ROIs, nframes, nframes) of the two-time
+        correlation where nframes is the number of binned frames.
+    """
+    if frame_bin < 1:
+        raise ValueError("frame_bin must be at least 1")
+    if block_size < 1:
+        raise ValueError("block_size must be at least 1")
+
+    labels = np.asarray(labels)
+    roi_ids, pixels, roi_start = _roi_pixels(labels)
+
+    t = ttime.time()
+    data, shape = _extract_roi_frames(images, pixels, frame_bin, chunk_size)
+    if shape is not None and shape != labels.shape:
+        raise ValueError(
+            "Image shape {} does not match labels shape {}".format(shape, labels.shape)
+        )
+
+    nframes = data.shape[0]
+    out_shape = (len(roi_ids), nframes, nframes)
+    if filename is not None:
+        out = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=dtype, shape=out_shape
+        )
+    else:
+        out = np.empty(out_shape, dtype=dtype)
+
+    for r in range(len(roi_ids)):
+        roi = data[:, roi_start[r] : roi_start[r + 1]]
+        valid = np.isfinite(roi)
+        if valid.all():
+            tiles = _tiles(roi, nframes, block_size)
+        else:
+            tiles = _tiles_masked(roi, valid, nframes, block_size)
+        for i0, i1, j0, j1, tile in tiles:
+            out[r, i0:i1, j0:j1] = tile
+            if j0 != i0:
+                out[r, j0:j1, i0:i1] = tile.T
+
+    if filename is not None:
+        out.flush()
+
+    logger.info(
+        "Computed two-time correlation of %d ROIs and %d frames in %.3f seconds",
+        len(roi_ids),
+        nframes,
+        ttime.time() - t,
+    )
+
+    return out
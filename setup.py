@@ -44,7 +44,7 @@ with open("requirements-extras.txt") as f:
 # C extensions
 fastccd = Extension(
     "fastccd",
-    sources=["src/fastccdmodule.c", "src/fastccd.c"],
+    sources=["src/fastccdmodule.c", "src/fastccd.c", "src/median.c"],
     extra_compile_args=["-fopenmp"],
     extra_link_args=["-lgomp"],
 )
@@ -58,7 +58,7 @@ axis1 = Extension(
 
 image = Extension(
     "image",
-    sources=["src/imagemodule.c", "src/image.c"],
+    sources=["src/imagemodule.c", "src/image.c", "src/median.c"],
     extra_compile_args=["-fopenmp"],
     extra_link_args=["-lgomp"],
 )
@@ -70,6 +70,13 @@ phocount = Extension(
     extra_link_args=["-lgomp"],
 )
 
+xpcs = Extension(
+    "xpcs",
+    sources=["src/xpcsmodule.c", "src/xpcs.c"],
+    extra_compile_args=["-fopenmp"],
+    extra_link_args=["-lgomp"],
+)
+
 # Setup
 setuptools.setup(
     name="csxtools",
@@ -88,7 +95,8 @@ setuptools.setup(
     install_requires=requirements,
     extras_require=extras_require,
     ext_package="csxtools.ext",
-    ext_modules=[fastccd, axis1, image, phocount],
+    ext_modules=[fastccd, axis1, image, phocount, xpcs],
+    entry_points={"console_scripts": ["csxtools-batch = csxtools.batch:main"]},
     url="https://github.com/NSLS-II-CSX/csxtools",
     keywords="Xray Analysis",
     license="BSD",
@@ -45,10 +45,14 @@
 
 // Correct axis1 images by looping over all images correcting for background
 int correct_axis_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
-                        int ndims, index_t *dims) {
+                        int ndims, index_t *dims, int nthreads) {
     index_t nimages, k;
     int n;
 
+    if (nthreads <= 0) {
+        nthreads = omp_get_max_threads();
+    }
+
     if (ndims == 2) {
         nimages = 1;
     } else {
@@ -62,7 +66,7 @@ int correct_axis_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
     index_t width = dims[ndims - 1];   // x
     index_t imsize = height * width;
 
-#pragma omp parallel for private(k) schedule(static)
+#pragma omp parallel for private(k) schedule(static) num_threads(nthreads)
     for (index_t img = 0; img < nimages; img++) {
         for (index_t y = 0; y < height; y++) {
             for (index_t x = 0; x < width; x++) {
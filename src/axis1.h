@@ -42,5 +42,5 @@ typedef long index_t;
 typedef float data_t;
 
 int correct_axis_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
-                        int ndims, index_t *dims);
+                        int ndims, index_t *dims, int nthreads);
 #endif
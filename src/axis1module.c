@@ -57,8 +57,9 @@ static PyObject* axis1_correct_images(PyObject *self, PyObject *args){
   npy_intp *dims_bgnd;
   npy_intp *dims_flat;
   int ndims;
+  int nthreads = 0;
 
-  if(!PyArg_ParseTuple(args, "OOO", &_input, &_bgnd, &_flat)){   
+  if(!PyArg_ParseTuple(args, "OOO|i", &_input, &_bgnd, &_flat, &nthreads)){
     return NULL;
   }
   
@@ -106,7 +107,7 @@ static PyObject* axis1_correct_images(PyObject *self, PyObject *args){
   Py_BEGIN_ALLOW_THREADS
 
   correct_axis_images(input_p, out_p, bgnd_p, flat_p,
-		      ndims, (index_t*)dims);
+		      ndims, (index_t*)dims, nthreads);
   
   Py_END_ALLOW_THREADS
 
@@ -41,14 +41,19 @@
 #include <stdint.h>
 
 #include "fastccd.h"
+#include "median.h"
 
 
 // Correct fast ccd images by looping over all images correcting for background
 int correct_fccd_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
-                        int ndims, index_t *dims, data_t* gain){
+                        int ndims, index_t *dims, data_t* gain, int nthreads){
   index_t nimages,k;
   int n;
 
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
   if(ndims == 2)
   {
     nimages = 1;
@@ -61,7 +66,7 @@ int correct_fccd_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
 
   index_t imsize = dims[ndims-1] * dims[ndims-2];
 
-#pragma omp parallel for private(k) shared(in, out, bg, imsize, gain, flat) schedule(static,imsize)
+#pragma omp parallel for private(k) shared(in, out, bg, imsize, gain, flat) schedule(static,imsize) num_threads(nthreads)
   for(k=0;k<nimages*imsize;k++){
     // Reset the background pointer each time
     data_t *bgp = bg + (k % imsize);
@@ -85,3 +90,95 @@ int correct_fccd_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
   return 0;
 }
 
+// Remove the common mode offset of each readout channel. Each line of each
+// image (a row if axis is 0 or a column if axis is 1) is split into
+// nchannels segments and the median of the pixels selected by the mask is
+// subtracted from all the pixels of the segment. NaNs are ignored.
+int correct_common_mode(data_t *data, uint8_t *mask, int ndims, index_t *dims,
+                        int nchannels, int axis, int nthreads){
+  index_t nimages;
+  int n;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  if(ndims == 2)
+  {
+    nimages = 1;
+  } else {
+    nimages = dims[0];
+    for(n=1;n<(ndims-2);n++){
+      nimages = nimages * dims[n];
+    }
+  }
+
+  index_t M = dims[ndims-1];
+  index_t N = dims[ndims-2];
+  index_t imsize = N * M;
+
+  // Stride between lines and between pixels along a line
+  index_t nlines, length, line_stride, pixel_stride;
+  if(axis == 0){
+    nlines = N;
+    length = M;
+    line_stride = M;
+    pixel_stride = 1;
+  } else {
+    nlines = M;
+    length = N;
+    line_stride = 1;
+    pixel_stride = M;
+  }
+  index_t seglen = length / nchannels;
+
+  int error = 0;
+
+#pragma omp parallel shared(data, mask, error) num_threads(nthreads)
+  {
+    data_t *buffer = malloc(sizeof(data_t) * seglen);
+    if(!buffer){
+#pragma omp atomic write
+      error = 1;
+    }
+
+    index_t k;
+#pragma omp for schedule(static)
+    for(k=0;k<(nimages * nlines);k++){
+      if(!buffer){
+        continue;
+      }
+
+      index_t line = k % nlines;
+      data_t *datap = data + (k / nlines) * imsize + line * line_stride;
+      uint8_t *maskp = mask + line * line_stride;
+
+      int c;
+      for(c=0;c<nchannels;c++){
+        index_t j, nvalues = 0;
+        index_t offset = c * seglen * pixel_stride;
+        for(j=0;j<seglen;j++){
+          index_t idx = offset + j * pixel_stride;
+          if(maskp[idx] && !isnan(datap[idx])){
+            buffer[nvalues++] = datap[idx];
+          }
+        }
+
+        if(!nvalues){
+          continue;
+        }
+
+        data_t offset_value = median(buffer, nvalues);
+        for(j=0;j<seglen;j++){
+          datap[offset + j * pixel_stride] -= offset_value;
+        }
+      }
+    }
+
+    if(buffer){
+      free(buffer);
+    }
+  } // pragma omp parallel
+
+  return error;
+}
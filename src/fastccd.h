@@ -48,6 +48,8 @@ typedef float data_t;
 #define PIXEL_MASK  0x1FFF
 
 int correct_fccd_images(uint16_t *in, data_t *out, data_t *bg, data_t *flat,
-                        int ndims, index_t *dims, data_t *gain);
+                        int ndims, index_t *dims, data_t *gain, int nthreads);
+int correct_common_mode(data_t *data, uint8_t *mask, int ndims, index_t *dims,
+                        int nchannels, int axis, int nthreads);
 
 #endif
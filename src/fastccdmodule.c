@@ -58,10 +58,12 @@ static PyObject* fastccd_correct_images(PyObject *self, PyObject *args){
   npy_intp *dims_flat;
   int ndims;
   float gain[3];
+  int nthreads = 0;
 
 
-  if(!PyArg_ParseTuple(args, "OOO(fff)", &_input, &_bgnd, &_flat,
-                                         &gain[0], &gain[1], &gain[2])){
+  if(!PyArg_ParseTuple(args, "OOO(fff)|i", &_input, &_bgnd, &_flat,
+                                           &gain[0], &gain[1], &gain[2],
+                                           &nthreads)){
     return NULL;
   }
 
@@ -112,7 +114,7 @@ static PyObject* fastccd_correct_images(PyObject *self, PyObject *args){
   Py_BEGIN_ALLOW_THREADS
 
   correct_fccd_images(input_p, out_p, bgnd_p, flat_p, 
-                      ndims, (index_t*)dims, (data_t*)gain);
+                      ndims, (index_t*)dims, (data_t*)gain, nthreads);
 
   Py_END_ALLOW_THREADS
 
@@ -129,9 +131,85 @@ error:
   return NULL;
 }
 
+static PyObject* fastccd_correct_common_mode(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyObject *_mask = NULL;
+  PyArrayObject *mask = NULL;
+  PyArrayObject *out = NULL;
+  npy_intp *dims;
+  npy_intp *dims_mask;
+  int ndims;
+  int nchannels = 1;
+  int axis = 0;
+  int nthreads = 0;
+  int retval;
+
+  if(!PyArg_ParseTuple(args, "OOii|i", &_input, &_mask, &nchannels, &axis,
+                       &nthreads)){
+    return NULL;
+  }
+
+  if(axis < 0 || axis > 1){
+    PyErr_SetString(PyExc_ValueError, "Axis must be 0 (rows) or 1 (columns)");
+    return NULL;
+  }
+
+  // The correction is done in place on a copy of the input
+  out = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, 0,
+                                        NPY_ARRAY_IN_ARRAY | NPY_ARRAY_ENSURECOPY);
+  if(!out){
+    goto error;
+  }
+
+  mask = (PyArrayObject*)PyArray_FROMANY(_mask, NPY_UINT8, 2, 2, NPY_ARRAY_IN_ARRAY);
+  if(!mask){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(out);
+  dims = PyArray_DIMS(out);
+  dims_mask = PyArray_DIMS(mask);
+
+  if((dims[ndims-2] != dims_mask[0]) || (dims[ndims-1] != dims_mask[1])){
+    PyErr_SetString(PyExc_ValueError, "Dimensions of image array do not match mask array dimensions.");
+    goto error;
+  }
+
+  if(nchannels <= 0 || (dims[ndims - 1 - axis] % nchannels)){
+    PyErr_SetString(PyExc_ValueError, "Number of channels must divide the line length");
+    goto error;
+  }
+
+  data_t *out_p = (data_t*)PyArray_DATA(out);
+  uint8_t *mask_p = (uint8_t*)PyArray_DATA(mask);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  retval = correct_common_mode(out_p, mask_p, ndims, (index_t*)dims,
+                               nchannels, axis, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  if(retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory");
+    goto error;
+  }
+
+  Py_XDECREF(mask);
+  return Py_BuildValue("N", out);
+
+error:
+  Py_XDECREF(mask);
+  Py_XDECREF(out);
+  return NULL;
+}
+
 static PyMethodDef FastCCDMethods[] = {
   { "correct_images", fastccd_correct_images, METH_VARARGS,
     "Correct FastCCD Images"},
+  { "correct_common_mode", fastccd_correct_common_mode, METH_VARARGS,
+    "Remove common mode offset of FastCCD readout channels"},
   {NULL, NULL, 0, NULL}
 };
 
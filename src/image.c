@@ -41,13 +41,19 @@
 #include <stdint.h>
 
 #include "image.h"
+#include "median.h"
 
-void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense){
+void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense,
+              int nthreads){
   index_t nimages = dims[0];
   index_t M = dims[ndims-1];
   index_t N = dims[ndims-2];
   index_t imsize = N*M;
 
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
   int x;
   for(x=1;x<(ndims-2);x++){
     nimages = nimages * dims[x];
@@ -58,7 +64,7 @@ void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense){
     return;
   }
 
-#pragma omp parallel shared(in,out,map,N,M,imsize,nimages)
+#pragma omp parallel shared(in,out,map,N,M,imsize,nimages) num_threads(nthreads)
   {
     index_t i;
 #pragma omp for private(i) 
@@ -88,150 +94,481 @@ void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense){
 }
 
 
-int stackprocess(data_t *in, data_t *mout, long int *nout, int ndims, index_t *dims, int mode){
+// Convert the accumulated sums of a block of pixels into the result
+static void stackfinish(double *sum, double *scnd_moment, int32_t *nvalues,
+                        data_t *mout, long int *nout, index_t size, int mode){
+  index_t j;
+  for(j=0;j<size;j++){
+    nout[j] = nvalues[j];
+    if(mode == 0){
+      mout[j] = sum[j];
+    } else if(mode == 1){
+      if(nvalues[j]){
+        mout[j] = sum[j] / nvalues[j];
+      } else {
+        mout[j] = 0.0;
+      }
+    } else {
+      double var = (scnd_moment[j] - (sum[j] * sum[j]) / nvalues[j]) / nvalues[j];
+      if(mode == 2){
+        mout[j] = var;
+      } else if(mode == 3){
+        mout[j] = sqrt(var);
+      } else {
+        mout[j] = sqrt(var) / sqrt(nvalues[j]);
+      }
+    }
+  }
+}
+
+int stackprocess(data_t *in, data_t *mout, long int *nout, int ndims, index_t *dims, int mode,
+                 int naxes, int nthreads){
   index_t M = dims[ndims-1];
   index_t N = dims[ndims-2];
   index_t imsize = N*M;
 
-  int error=0;
-
-  long int **nvalues;
-  data_t **mean;
-  data_t **scnd_moment;
-
-  int num_threads;
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
 
+  // The naxes axes before the image are reduced, the axes before those
+  // are kept (the outer axes) giving an output of shape (..., N, M)
   int x;
-  index_t nimages = dims[0];
-  for(x=1;x<(ndims-2);x++){
-    nimages = nimages * dims[x];
+  index_t nouter = 1;
+  index_t nimages = 1;
+  for(x=0;x<(ndims-2);x++){
+    if(x < (ndims - 2 - naxes)){
+      nouter = nouter * dims[x];
+    } else {
+      nimages = nimages * dims[x];
+    }
   }
 
-  // Get the maximum threads 
+  // The image is split into blocks of pixels which are small enough for the
+  // sums to stay in cache. Each block is owned by a single thread which
+  // loops over all the images, so no merging of the results is needed. For
+  // small images with fewer blocks than threads the images are also split
+  // into nsplit groups and the partial sums merged at the end.
 
-  int max_threads = omp_get_max_threads(); 
-  if(!(nvalues = malloc(sizeof(long int *) * max_threads))){
-    return 1;
+  index_t nblocks = (imsize + STACK_BLOCK - 1) / STACK_BLOCK;
+  index_t nouterblocks = nouter * nblocks;
+  if(nouterblocks == 0){
+    // The output has no pixels
+    return 0;
   }
-  if(!(mean = malloc(sizeof(data_t *) * max_threads))){
-    free(nvalues);
-    return 1;
+  index_t nsplit = 1;
+  if(nouterblocks < nthreads){
+    nsplit = nthreads / nouterblocks;
+    if(nsplit > nimages){
+      nsplit = nimages;
+    }
+    if(nsplit < 1){
+      nsplit = 1;
+    }
   }
-  if(!(scnd_moment = malloc(sizeof(data_t *) * max_threads))){
+  index_t nitems = nouterblocks * nsplit;
+  index_t nscratch = (nsplit == 1) ? nthreads : nitems;
+
+  double *sum = malloc(sizeof(double) * STACK_BLOCK * nscratch);
+  int32_t *nvalues = malloc(sizeof(int32_t) * STACK_BLOCK * nscratch);
+  double *scnd_moment = NULL;
+  if(mode > 1){
+    scnd_moment = malloc(sizeof(double) * STACK_BLOCK * nscratch);
+  }
+
+  if(!sum || !nvalues || ((mode > 1) && !scnd_moment)){
+    free(sum);
     free(nvalues);
-    free(mean);
+    free(scnd_moment);
     return 1;
   }
 
-#pragma omp parallel shared(nvalues, mean, num_threads, imsize, in, error)
+#pragma omp parallel shared(in, mout, nout, sum, nvalues, scnd_moment) num_threads(nthreads)
   {
-    // Allocate both a result array and an array for the number of values
+    index_t item;
+#pragma omp for schedule(static)
+    for(item=0;item<nitems;item++){
+      index_t outer = item / (nblocks * nsplit);
+      index_t block = (item / nsplit) % nblocks;
+      index_t split = item % nsplit;
+      index_t start = block * STACK_BLOCK;
+      index_t size = imsize - start;
+      if(size > STACK_BLOCK){
+        size = STACK_BLOCK;
+      }
 
-#pragma omp single
-    num_threads = omp_get_num_threads();
+      index_t first = (nimages * split) / nsplit;
+      index_t last = (nimages * (split + 1)) / nsplit;
 
-    int thread_num = omp_get_thread_num();
+      index_t scratch = (nsplit == 1) ? omp_get_thread_num() : item;
+      double *_sum = sum + (scratch * STACK_BLOCK);
+      int32_t *_nvalues = nvalues + (scratch * STACK_BLOCK);
+      double *_scnd_moment = NULL;
+      if(mode > 1){
+        _scnd_moment = scnd_moment + (scratch * STACK_BLOCK);
+      }
 
-    data_t *_mean = NULL;
-    if(!(_mean = calloc(imsize, sizeof(data_t)))){
-      error = 1;
-    }
+      index_t i, j;
+      for(j=0;j<size;j++){
+        _sum[j] = 0;
+        _nvalues[j] = 0;
+        if(mode > 1){
+          _scnd_moment[j] = 0;
+        }
+      }
 
-    long int *_nvalues = NULL;
-    if(!(_nvalues = calloc(imsize, sizeof(long int)))){
-      error = 1;
-    }
+      data_t *outerp = in + (outer * nimages * imsize);
+      for(i=first;i<last;i++){
+        data_t *inp = outerp + (i * imsize) + start;
+        if(mode > 1){
+          for(j=0;j<size;j++){
+            data_t ival = inp[j];
+            if(!isnan(ival)){
+              _sum[j] += ival;
+              _scnd_moment[j] += (double)ival * ival;
+              _nvalues[j]++;
+            }
+          }
+        } else {
+          for(j=0;j<size;j++){
+            data_t ival = inp[j];
+            if(!isnan(ival)){
+              _sum[j] += ival;
+              _nvalues[j]++;
+            }
+          }
+        }
+      }
 
-    data_t *_scnd_moment = NULL;
-    if(mode > 1){
-      // We are doing the varience 
-      if(!(_scnd_moment = calloc(imsize, sizeof(data_t)))){
-        error = 1;
+      if(nsplit == 1){
+        index_t offset = outer * imsize + start;
+        stackfinish(_sum, _scnd_moment, _nvalues, mout + offset, nout + offset,
+                    size, mode);
       }
     }
 
-    mean[thread_num] = _mean;
-    nvalues[thread_num] = _nvalues;
-    scnd_moment[thread_num] = _scnd_moment;
+    if(nsplit > 1){
+      // Merge the partial sums of the image groups for each block
+      index_t outerblock;
+#pragma omp for schedule(static)
+      for(outerblock=0;outerblock<nouterblocks;outerblock++){
+        index_t start = (outerblock % nblocks) * STACK_BLOCK;
+        index_t size = imsize - start;
+        if(size > STACK_BLOCK){
+          size = STACK_BLOCK;
+        }
 
-    // Test if we have the memory allocated
-    if(!error){
+        double *_sum = sum + (outerblock * nsplit * STACK_BLOCK);
+        int32_t *_nvalues = nvalues + (outerblock * nsplit * STACK_BLOCK);
+        double *_scnd_moment = NULL;
+        if(mode > 1){
+          _scnd_moment = scnd_moment + (outerblock * nsplit * STACK_BLOCK);
+        }
 
-      // Now do the actual mean calculation
-      int i;
-#pragma omp for private(i) 
-      for(i=0;i<nimages;i++){
-        int j;
-        for(j=0;j<imsize;j++){
-          data_t ival = in[(i * imsize + j)];
-          if(!isnan(ival)){
-            _mean[j] += ival;
-            _nvalues[j]++;
+        index_t split, j;
+        for(split=1;split<nsplit;split++){
+          index_t offset = split * STACK_BLOCK;
+          for(j=0;j<size;j++){
+            _sum[j] += _sum[offset + j];
+            _nvalues[j] += _nvalues[offset + j];
             if(mode > 1){
-              _scnd_moment[j] += (ival * ival);
+              _scnd_moment[j] += _scnd_moment[offset + j];
             }
           }
         }
+
+        index_t offset = (outerblock / nblocks) * imsize + start;
+        stackfinish(_sum, _scnd_moment, _nvalues, mout + offset, nout + offset,
+                    size, mode);
       }
     }
+  } // pragma omp parallel
+
+  free(sum);
+  free(nvalues);
+  free(scnd_moment);
 
-  } // pragma omp paralell
+  return 0;
+}
 
-  // Now calculate the mean 
 
-  if(!error){
-    int n,i;
-    for(n=1;n<num_threads;n++){
-      for(i=0;i<imsize;i++){
-        mean[0][i] += mean[n][i];
-        nvalues[0][i] += nvalues[n][i];
-        if(mode > 1){
-          scnd_moment[0][i] += scnd_moment[n][i];
-        }
+// Calculate the sigma clipped mean of n values. The values are clipped
+// about the median by nsigma times the standard deviation until no more
+// values are removed or maxiters is reached. The values are reordered and
+// the number of values remaining is returned in nleft.
+data_t clipmean(data_t *values, index_t n, data_t nsigma, int maxiters,
+                index_t *nleft){
+  int iter;
+  index_t j;
+  double sum = 0;
+
+  for(iter=0;iter<maxiters;iter++){
+    if(n < 3){
+      break;
+    }
+
+    double scnd_moment = 0;
+    sum = 0;
+    for(j=0;j<n;j++){
+      sum += values[j];
+      scnd_moment += (double)values[j] * values[j];
+    }
+    double std = sqrt((scnd_moment - (sum * sum) / n) / n);
+    if(!(std > 0)){
+      break;
+    }
+
+    data_t center = median(values, n);
+    double limit = nsigma * std;
+
+    // Compact the values we keep to the start of the array
+    index_t nkeep = 0;
+    for(j=0;j<n;j++){
+      if(fabs(values[j] - center) <= limit){
+        values[nkeep++] = values[j];
       }
     }
 
-    for(i=0;i<imsize;i++){
-      nout[i] = nvalues[0][i];
-      if (mode == 0){
-        mout[i] = mean[0][i];
-      } else if(mode == 1) {
-        if(nvalues[0][i]){
-          mout[i] = mean[0][i] / nvalues[0][i];
+    if(nkeep == n){
+      break;
+    }
+    n = nkeep;
+  }
+
+  sum = 0;
+  for(j=0;j<n;j++){
+    sum += values[j];
+  }
+
+  *nleft = n;
+  if(n){
+    return sum / n;
+  }
+  return 0.0;
+}
+
+int stackrobust(data_t *in, data_t *mout, int32_t *nout, int ndims, index_t *dims,
+                int mode, data_t nsigma, int maxiters, int nthreads){
+  index_t M = dims[ndims-1];
+  index_t N = dims[ndims-2];
+  index_t imsize = N*M;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  int error = 0;
+
+  int x;
+  index_t nimages = dims[0];
+  for(x=1;x<(ndims-2);x++){
+    nimages = nimages * dims[x];
+  }
+
+  index_t nblocks = (imsize + ROBUST_BLOCK - 1) / ROBUST_BLOCK;
+
+#pragma omp parallel shared(in, mout, nout, error) num_threads(nthreads)
+  {
+    // Each thread gathers a block of pixels from all images into a
+    // buffer of shape (ROBUST_BLOCK, nimages) so we read the stack with
+    // contiguous accesses and only hold one block in memory per thread.
+    data_t *buffer = malloc(sizeof(data_t) * ROBUST_BLOCK * nimages);
+    index_t nvalues[ROBUST_BLOCK];
+
+    if(!buffer){
+#pragma omp atomic write
+      error = 1;
+    }
+
+    index_t b;
+#pragma omp for schedule(dynamic)
+    for(b=0;b<nblocks;b++){
+      if(!buffer){
+        continue;
+      }
+
+      index_t start = b * ROBUST_BLOCK;
+      index_t size = imsize - start;
+      if(size > ROBUST_BLOCK){
+        size = ROBUST_BLOCK;
+      }
+
+      index_t i, j;
+      for(j=0;j<size;j++){
+        nvalues[j] = 0;
+      }
+
+      for(i=0;i<nimages;i++){
+        data_t *inp = in + (i * imsize) + start;
+        for(j=0;j<size;j++){
+          if(!isnan(inp[j])){
+            buffer[j * nimages + nvalues[j]] = inp[j];
+            nvalues[j]++;
+          }
+        }
+      }
+
+      for(j=0;j<size;j++){
+        data_t *values = buffer + (j * nimages);
+        index_t n = nvalues[j];
+        if(mode == 0){
+          mout[start + j] = median(values, n);
         } else {
-          mout[i] = 0.0;
-          nout[i] = 0;
+          mout[start + j] = clipmean(values, n, nsigma, maxiters, &n);
+        }
+        nout[start + j] = n;
+      }
+    }
+
+    if(buffer){
+      free(buffer);
+    }
+  } // pragma omp parallel
+
+  return error;
+}
+
+int binstack(data_t *in, data_t *out, int ndims, index_t *dims,
+             index_t frame_bin, index_t ybin, index_t xbin, int omitnan,
+             int nthreads){
+  index_t M = dims[ndims-1];
+  index_t N = dims[ndims-2];
+  index_t imsize = N*M;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  // The frame axis is the one before the image, any axes before that
+  // are kept. Pixels and frames which do not fill a bin are dropped.
+  int x;
+  index_t nouter = 1;
+  index_t nframes = 1;
+  if(ndims > 2){
+    nframes = dims[ndims-3];
+    for(x=0;x<(ndims-3);x++){
+      nouter = nouter * dims[x];
+    }
+  }
+
+  index_t outM = M / xbin;
+  index_t outN = N / ybin;
+  index_t outF = nframes / frame_bin;
+  index_t nrows = nouter * outF * outN;
+
+  int error = 0;
+
+#pragma omp parallel shared(in, out, error) num_threads(nthreads)
+  {
+    double *sum = malloc(sizeof(double) * outM);
+    index_t *nvalues = malloc(sizeof(index_t) * outM);
+
+    if(!sum || !nvalues){
+#pragma omp atomic write
+      error = 1;
+    }
+
+    index_t row;
+#pragma omp for schedule(static)
+    for(row=0;row<nrows;row++){
+      if(!sum || !nvalues){
+        continue;
+      }
+
+      index_t outer = row / (outF * outN);
+      index_t frame = (row / outN) % outF;
+      index_t y = row % outN;
+
+      index_t i, j, k;
+      for(j=0;j<outM;j++){
+        sum[j] = 0;
+        nvalues[j] = 0;
+      }
+
+      for(i=0;i<frame_bin;i++){
+        data_t *framep = in + ((outer * nframes + frame * frame_bin + i) * imsize);
+        for(k=0;k<ybin;k++){
+          data_t *inp = framep + ((y * ybin + k) * M);
+          for(j=0;j<(outM * xbin);j++){
+            if(omitnan && isnan(inp[j])){
+              continue;
+            }
+            sum[j / xbin] += inp[j];
+            nvalues[j / xbin]++;
+          }
         }
-      } 
-      if(mode > 1){
-        mout[i] = (scnd_moment[0][i] - (mean[0][i] * mean[0][i]) / nvalues[0][i]) / nvalues[0][i];
-      } 
-      if(mode == 3){
-        mout[i] = pow(mout[i], 0.5);
       }
-      if(mode == 4){
-        mout[i] = pow(mout[i], 0.5) / pow(nvalues[0][i], 0.5);
+
+      data_t *outp = out + (row * outM);
+      for(j=0;j<outM;j++){
+        if(nvalues[j]){
+          outp[j] = sum[j] / nvalues[j];
+        } else {
+          outp[j] = 0.0;
+        }
       }
     }
+
+    free(sum);
+    free(nvalues);
+  } // pragma omp parallel
+
+  return error;
+}
+
+int flatfield(data_t *in, data_t *out, index_t N, index_t M, data_t lo,
+              data_t hi, int nthreads){
+  index_t imsize = N*M;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  // Gather the values which are not NaN to find the median
+  data_t *buffer = malloc(sizeof(data_t) * (imsize ? imsize : 1));
+  if(!buffer){
+    return 1;
   }
 
-  // free up all memory
- 
-  int n;
-  for(n=0;n<num_threads;n++){
-    if(mean[n]) {
-      free(mean[n]);
-    } 
-    if(nvalues[n]){
-      free(nvalues[n]);
+  index_t i, n = 0;
+  for(i=0;i<imsize;i++){
+    if(!isnan(in[i])){
+      buffer[n++] = in[i];
     }
-    if(scnd_moment[n]){
-      free(scnd_moment[n]);
+  }
+
+  data_t med = median(buffer, n);
+  free(buffer);
+
+  data_t lower = lo * med;
+  data_t upper = hi * med;
+
+  // Mean of the values within the limits
+  double sum = 0;
+  index_t count = 0;
+#pragma omp parallel for reduction(+:sum,count) num_threads(nthreads)
+  for(i=0;i<imsize;i++){
+    data_t v = in[i];
+    if(!isnan(v) && (v >= lower) && (v <= upper)){
+      sum += v;
+      count++;
     }
   }
 
-  free(mean);
-  free(nvalues);
+  data_t mean = count ? (sum / count) : NAN;
 
-  return error;
+  // Write the flatfield rotated 90 deg ccw, out is of shape (M, N)
+#pragma omp parallel for num_threads(nthreads)
+  for(i=0;i<imsize;i++){
+    index_t r = i / N;
+    index_t c = i % N;
+    data_t v = in[c * M + (M - 1 - r)];
+    if(!isnan(v) && (v >= lower) && (v <= upper)){
+      out[i] = mean / v;
+    } else {
+      out[i] = NAN;
+    }
+  }
+
+  return 0;
 }
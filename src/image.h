@@ -37,12 +37,29 @@
 #ifndef _IMAGE_H
 #define _IMAGE_H
 
+#include <stdint.h>
+
 // Use a size of long for big arrays
 typedef long index_t;
 typedef float data_t;
 
+// Number of pixels processed at once by the stack reductions
+#define STACK_BLOCK 2048
+#define ROBUST_BLOCK 64
+
 // Function prototypes
-void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense);
-int stackprocess(data_t *in, data_t *mout, long int *nout, int ndims, index_t *dims, int norm);
+void rotate90(data_t *in, data_t *out, int ndims, index_t *dims, int sense,
+              int nthreads);
+int stackprocess(data_t *in, data_t *mout, long int *nout, int ndims, index_t *dims, int norm,
+                 int naxes, int nthreads);
+int stackrobust(data_t *in, data_t *mout, int32_t *nout, int ndims, index_t *dims,
+                int mode, data_t nsigma, int maxiters, int nthreads);
+int binstack(data_t *in, data_t *out, int ndims, index_t *dims,
+             index_t frame_bin, index_t ybin, index_t xbin, int omitnan,
+             int nthreads);
+int flatfield(data_t *in, data_t *out, index_t N, index_t M, data_t lo,
+              data_t hi, int nthreads);
+data_t clipmean(data_t *values, index_t n, data_t nsigma, int maxiters,
+                index_t *nleft);
 
 #endif
@@ -35,6 +35,7 @@
  */
 
 #include <stdio.h>
+#include <omp.h>
 #include <Python.h>
 
 /* Include python and numpy header files */
@@ -52,8 +53,9 @@ static PyObject* image_rotate90(PyObject *self, PyObject *args){
   npy_intp *dims;
   npy_intp temp;
   int ndims, sense = 0;
+  int nthreads = 0;
 
-  if(!PyArg_ParseTuple(args, "Oi", &_input, &sense)){
+  if(!PyArg_ParseTuple(args, "Oi|i", &_input, &sense, &nthreads)){
     return NULL;
   }
 
@@ -84,7 +86,7 @@ static PyObject* image_rotate90(PyObject *self, PyObject *args){
   Py_BEGIN_ALLOW_THREADS
 
   rotate90((data_t*)PyArray_DATA(input), (data_t*)PyArray_DATA(out),
-           ndims, dims, sense);
+           ndims, dims, sense, nthreads);
 
   Py_END_ALLOW_THREADS
 
@@ -98,6 +100,84 @@ error:
 }
 
 static PyObject* image_stackprocess(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyArrayObject *input = NULL;
+  PyArrayObject *nout = NULL;
+  PyArrayObject *mout = NULL;
+  npy_intp *dims;
+  npy_intp newdims[NPY_MAXDIMS];
+  int ndims, newndims;
+  int norm;
+  int nthreads = 0;
+  int naxes = -1;
+  int retval;
+  int x;
+
+  if(!PyArg_ParseTuple(args, "Oi|ii", &_input, &norm, &nthreads, &naxes)){
+    return NULL;
+  }
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 3, 0,NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(input);
+  dims = PyArray_DIMS(input);
+
+  // By default reduce all the axes before the image
+  if(naxes < 0){
+    naxes = ndims - 2;
+  }
+  if(naxes == 0 || naxes > (ndims - 2)){
+    PyErr_SetString(PyExc_ValueError, "Number of axes to reduce is out of range");
+    goto error;
+  }
+
+  // Keep the outer axes and the image axes
+  newndims = ndims - naxes;
+  for(x=0;x<(newndims-2);x++){
+    newdims[x] = dims[x];
+  }
+  newdims[newndims-2] = dims[ndims-2];
+  newdims[newndims-1] = dims[ndims-1];
+
+  mout = (PyArrayObject*)PyArray_SimpleNew(newndims, newdims, NPY_FLOAT);
+  if(!mout){
+    goto error;
+  }
+  nout = (PyArrayObject*)PyArray_SimpleNew(newndims, newdims, NPY_LONG);
+  if(!nout){
+    goto error;
+  }
+  
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+  data_t *mout_p = (data_t*)PyArray_DATA(mout);
+  long int *nout_p = (long int*)PyArray_DATA(nout);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+  
+  retval = stackprocess(input_p, mout_p, nout_p, ndims, dims, norm, naxes, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  if(retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory");
+    goto error;
+  }
+
+  Py_XDECREF(input);
+  return Py_BuildValue("(NN)", mout, nout);
+
+error:
+  Py_XDECREF(input);
+  Py_XDECREF(nout);
+  Py_XDECREF(mout);
+  return NULL;
+}
+
+static PyObject* image_stackrobust(PyObject *self, PyObject *args){
   PyObject *_input = NULL;
   PyArrayObject *input = NULL;
   PyArrayObject *nout = NULL;
@@ -105,10 +185,19 @@ static PyObject* image_stackprocess(PyObject *self, PyObject *args){
   npy_intp *dims;
   npy_intp newdims[2];
   int ndims;
-  int norm;
+  int mode;
+  float nsigma = 3.0;
+  int maxiters = 5;
+  int nthreads = 0;
   int retval;
 
-  if(!PyArg_ParseTuple(args, "Oi", &_input, &norm)){
+  if(!PyArg_ParseTuple(args, "Oi|fii", &_input, &mode, &nsigma, &maxiters,
+                       &nthreads)){
+    return NULL;
+  }
+
+  if(mode < 0 || mode > 1){
+    PyErr_SetString(PyExc_ValueError, "Mode must be 0 (median) or 1 (clipped mean)");
     return NULL;
   }
 
@@ -128,19 +217,20 @@ static PyObject* image_stackprocess(PyObject *self, PyObject *args){
   if(!mout){
     goto error;
   }
-  nout = (PyArrayObject*)PyArray_SimpleNew(2, newdims, NPY_LONG);
+  nout = (PyArrayObject*)PyArray_SimpleNew(2, newdims, NPY_INT32);
   if(!nout){
     goto error;
   }
-  
+
   data_t *input_p = (data_t*)PyArray_DATA(input);
   data_t *mout_p = (data_t*)PyArray_DATA(mout);
-  long int *nout_p = (long int*)PyArray_DATA(nout);
+  int32_t *nout_p = (int32_t*)PyArray_DATA(nout);
 
   // Ok now we don't touch Python Object ... Release the GIL
   Py_BEGIN_ALLOW_THREADS
-  
-  retval = stackprocess(input_p, mout_p, nout_p, ndims, dims, norm);
+
+  retval = stackrobust(input_p, mout_p, nout_p, ndims, dims, mode,
+                       nsigma, maxiters, nthreads);
 
   Py_END_ALLOW_THREADS
 
@@ -159,11 +249,152 @@ error:
   return NULL;
 }
 
+static PyObject* image_binstack(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyArrayObject *input = NULL;
+  PyArrayObject *out = NULL;
+  npy_intp *dims;
+  npy_intp newdims[NPY_MAXDIMS];
+  int ndims;
+  int frame_bin, ybin, xbin;
+  int omitnan = 1;
+  int nthreads = 0;
+  int retval;
+  int x;
+
+  if(!PyArg_ParseTuple(args, "Oiii|pi", &_input, &frame_bin, &ybin, &xbin,
+                       &omitnan, &nthreads)){
+    return NULL;
+  }
+
+  if(frame_bin < 1 || ybin < 1 || xbin < 1){
+    PyErr_SetString(PyExc_ValueError, "Bin sizes must be at least 1");
+    return NULL;
+  }
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, 0,NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(input);
+  dims = PyArray_DIMS(input);
+
+  if(ndims == 2 && frame_bin != 1){
+    PyErr_SetString(PyExc_ValueError, "Frames can only be binned for a stack of images");
+    goto error;
+  }
+
+  for(x=0;x<ndims;x++){
+    newdims[x] = dims[x];
+  }
+  newdims[ndims-1] = dims[ndims-1] / xbin;
+  newdims[ndims-2] = dims[ndims-2] / ybin;
+  if(ndims > 2){
+    newdims[ndims-3] = dims[ndims-3] / frame_bin;
+  }
+
+  out = (PyArrayObject*)PyArray_SimpleNew(ndims, newdims, NPY_FLOAT);
+  if(!out){
+    goto error;
+  }
+
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+  data_t *out_p = (data_t*)PyArray_DATA(out);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  retval = binstack(input_p, out_p, ndims, dims, frame_bin, ybin, xbin,
+                    omitnan, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  if(retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory");
+    goto error;
+  }
+
+  Py_XDECREF(input);
+  return Py_BuildValue("N", out);
+
+error:
+  Py_XDECREF(input);
+  Py_XDECREF(out);
+  return NULL;
+}
+
+static PyObject* image_flatfield(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyArrayObject *input = NULL;
+  PyArrayObject *out = NULL;
+  npy_intp *dims;
+  npy_intp newdims[2];
+  float lo, hi;
+  int nthreads = 0;
+  int retval;
+
+  if(!PyArg_ParseTuple(args, "O(ff)|i", &_input, &lo, &hi, &nthreads)){
+    return NULL;
+  }
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, 2, NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  dims = PyArray_DIMS(input);
+
+  // The flatfield is rotated so swap the dims
+  newdims[0] = dims[1];
+  newdims[1] = dims[0];
+
+  out = (PyArrayObject*)PyArray_SimpleNew(2, newdims, NPY_FLOAT);
+  if(!out){
+    goto error;
+  }
+
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+  data_t *out_p = (data_t*)PyArray_DATA(out);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  retval = flatfield(input_p, out_p, dims[0], dims[1], lo, hi, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  if(retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory");
+    goto error;
+  }
+
+  Py_XDECREF(input);
+  return Py_BuildValue("N", out);
+
+error:
+  Py_XDECREF(input);
+  Py_XDECREF(out);
+  return NULL;
+}
+
+static PyObject* image_max_threads(PyObject *self, PyObject *args){
+  return Py_BuildValue("i", omp_get_max_threads());
+}
+
 static PyMethodDef imageMethods[] = {
   { "rotate90", image_rotate90, METH_VARARGS,
     "Rotate stack of images 90 degrees (with sense)"},
   { "stackprocess", image_stackprocess, METH_VARARGS,
     "Calculate mean of an image stack"},
+  { "stackrobust", image_stackrobust, METH_VARARGS,
+    "Calculate median or sigma clipped mean of an image stack"},
+  { "binstack", image_binstack, METH_VARARGS,
+    "Bin the pixels and frames of an image stack"},
+  { "flatfield", image_flatfield, METH_VARARGS,
+    "Calculate a flatfield from a mean image"},
+  { "max_threads", image_max_threads, METH_NOARGS,
+    "Return the default number of OpenMP threads"},
   {NULL, NULL, 0, NULL}
 };
 
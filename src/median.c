@@ -0,0 +1,104 @@
+/*
+ * Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        
+ * National Laboratory. All rights reserved.                            
+ *                                                                      
+ * Redistribution and use in source and binary forms, with or without   
+ * modification, are permitted provided that the following conditions   
+ * are met:                                                             
+ *                                                                      
+ * * Redistributions of source code must retain the above copyright     
+ *   notice, this list of conditions and the following disclaimer.      
+ *                                                                      
+ * * Redistributions in binary form must reproduce the above copyright  
+ *   notice this list of conditions and the following disclaimer in     
+ *   the documentation and/or other materials provided with the         
+ *   distribution.                                                      
+ *                                                                      
+ * * Neither the name of the Brookhaven Science Associates, Brookhaven  
+ *   National Laboratory nor the names of its contributors may be used  
+ *   to endorse or promote products derived from this software without  
+ *   specific prior written permission.                                 
+ *                                                                      
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   
+ * IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   
+ * POSSIBILITY OF SUCH DAMAGE.                                          
+ *
+ */
+
+#include <stdlib.h>
+
+#include "median.h"
+
+// Find the k-th smallest value of the array (Hoare's quickselect). The
+// array is partially reordered in place so that all elements before k are
+// smaller or equal to the k-th value. The array must not contain NaNs.
+float select_kth(float *array, long n, long k){
+  long left = 0;
+  long right = n - 1;
+
+  while(left < right){
+    float pivot = array[k];
+    long i = left;
+    long j = right;
+    do {
+      while(array[i] < pivot){
+        i++;
+      }
+      while(pivot < array[j]){
+        j--;
+      }
+      if(i <= j){
+        float t = array[i];
+        array[i] = array[j];
+        array[j] = t;
+        i++;
+        j--;
+      }
+    } while(i <= j);
+
+    if(j < k){
+      left = i;
+    }
+    if(k < i){
+      right = j;
+    }
+  }
+
+  return array[k];
+}
+
+// Calculate the median of the array. For an even number of elements the
+// mean of the two central values is returned (as numpy does). The array is
+// reordered in place.
+float median(float *array, long n){
+  if(n <= 0){
+    return 0.0;
+  }
+
+  long k = n / 2;
+  float upper = select_kth(array, n, k);
+  if(n % 2){
+    return upper;
+  }
+
+  // All values below k are now <= upper, the lower central value is the
+  // largest of these
+  float lower = array[0];
+  long i;
+  for(i=1;i<k;i++){
+    if(array[i] > lower){
+      lower = array[i];
+    }
+  }
+
+  return 0.5 * (lower + upper);
+}
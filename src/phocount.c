@@ -45,12 +45,16 @@
 int count(data_t *in, data_t *out, data_t *stddev, 
           int ndims, index_t *dims, 
           data_t *thresh, data_t *sum_filter, data_t *std_filter,
-          int sum_max, int nan){
+          int sum_max, int nan, int nthreads){
   index_t nimages = dims[0];
   index_t M = dims[ndims-1];
   index_t N = dims[ndims-2];
   index_t imsize = N*M;
 
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
   data_t nodata;
   if(nan){
     // Pad no data with nan not zero
@@ -65,7 +69,7 @@ int count(data_t *in, data_t *out, data_t *stddev,
   }   
 
   index_t i;
-#pragma omp parallel shared(in, out, stddev) 
+#pragma omp parallel shared(in, out, stddev) num_threads(nthreads)
   {
 #pragma omp for
     for(i=0;i<nimages;i++){
@@ -187,3 +191,83 @@ void sort(data_t *array, int n){
     }
   }
 }
+
+#define NO_ROUNDING(v) (v)
+
+// ADU per photon of pixel p of frame f
+#define ADU_PER_PHOTON(f, p) \
+  (adu * (frame_scale ? frame_scale[f] : 1.0f) * (gain ? gain[p] : 1.0f))
+
+// Convert to photons and clip to the range of the output type
+#define CONVERT_INT(TYPE, LO, HI, ROUND) {                              \
+    TYPE *outp = (TYPE*)out;                                            \
+    TYPE nodata = (TYPE)sentinel;                                       \
+    _Pragma("omp parallel for collapse(2) num_threads(nthreads)")       \
+    for(f=0;f<nframes;f++){                                             \
+      for(p=0;p<imsize;p++){                                            \
+        index_t i = f * imsize + p;                                     \
+        data_t v = ROUND(in[i] / ADU_PER_PHOTON(f, p));                 \
+        outp[i] = isnan(v) ? nodata : (TYPE)(v < LO ? LO : (v > HI ? HI : v)); \
+      }                                                                 \
+    }                                                                   \
+  }
+
+#define CONVERT_FLOAT(ROUND) {                                          \
+    data_t *outp = (data_t*)out;                                        \
+    _Pragma("omp parallel for collapse(2) num_threads(nthreads)")       \
+    for(f=0;f<nframes;f++){                                             \
+      for(p=0;p<imsize;p++){                                            \
+        index_t i = f * imsize + p;                                     \
+        data_t v = ROUND(in[i] / ADU_PER_PHOTON(f, p));                 \
+        outp[i] = isnan(v) ? sentinel : v;                              \
+      }                                                                 \
+    }                                                                   \
+  }
+
+// Select the loop for the rounding mode
+#define CONVERT_ROUNDING(CONVERT, ...)                                  \
+  switch(rounding){                                                     \
+    case ROUND_NEAREST:                                                 \
+      CONVERT(__VA_ARGS__ rintf);                                       \
+      break;                                                            \
+    case ROUND_FLOOR:                                                   \
+      CONVERT(__VA_ARGS__ floorf);                                      \
+      break;                                                            \
+    case ROUND_CEIL:                                                    \
+      CONVERT(__VA_ARGS__ ceilf);                                       \
+      break;                                                            \
+    case ROUND_TRUNC:                                                   \
+      CONVERT(__VA_ARGS__ truncf);                                      \
+      break;                                                            \
+    default:                                                            \
+      CONVERT(__VA_ARGS__ NO_ROUNDING);                                 \
+      break;                                                            \
+  }
+
+int convert(data_t *in, void *out, int out_type, index_t nframes, index_t imsize,
+            data_t adu, data_t *gain, data_t *frame_scale,
+            int rounding, data_t sentinel, int nthreads){
+  index_t f, p;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  switch(out_type){
+    case PHOTONS_INT8:
+      CONVERT_ROUNDING(CONVERT_INT, int8_t, INT8_MIN, INT8_MAX,);
+      break;
+    case PHOTONS_INT16:
+      CONVERT_ROUNDING(CONVERT_INT, int16_t, INT16_MIN, INT16_MAX,);
+      break;
+    case PHOTONS_INT32:
+      // INT32_MAX is not representable as a float so clip below it
+      CONVERT_ROUNDING(CONVERT_INT, int32_t, -2147483648.0f, 2147483520.0f,);
+      break;
+    default:
+      CONVERT_ROUNDING(CONVERT_FLOAT,);
+      break;
+  }
+
+  return 0;
+}
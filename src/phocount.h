@@ -45,7 +45,24 @@ typedef float data_t;
 int count(data_t *in, data_t *out, data_t *stddev, 
           int ndims, index_t *dims, 
           data_t *thresh, data_t *sum_filter, data_t *std_filter,
-          int sum_max, int nan);
+          int sum_max, int nan, int nthreads);
 void sort(data_t *array, int n);
 
+// Output types of convert
+#define PHOTONS_FLOAT32 0
+#define PHOTONS_INT8 1
+#define PHOTONS_INT16 2
+#define PHOTONS_INT32 3
+
+// Rounding modes of convert
+#define ROUND_NONE 0
+#define ROUND_NEAREST 1
+#define ROUND_FLOOR 2
+#define ROUND_CEIL 3
+#define ROUND_TRUNC 4
+
+int convert(data_t *in, void *out, int out_type, index_t nframes, index_t imsize,
+            data_t adu, data_t *gain, data_t *frame_scale,
+            int rounding, data_t sentinel, int nthreads);
+
 #endif
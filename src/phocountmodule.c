@@ -55,11 +55,12 @@ static PyObject* phocount_count(PyObject *self, PyObject *args){
   float thresh[2], sum_filter[2], std_filter[2];
   int sum_max;
   int nan = 0;
+  int nthreads = 0;
 
-  if(!PyArg_ParseTuple(args, "O(ff)(ff)(ff)i|p", &_input, &thresh[0], &thresh[1],
-                                             &sum_filter[0], &sum_filter[1], 
-                                             &std_filter[0], &std_filter[1], 
-                                             &sum_max, &nan)){
+  if(!PyArg_ParseTuple(args, "O(ff)(ff)(ff)i|pi", &_input, &thresh[0], &thresh[1],
+                                              &sum_filter[0], &sum_filter[1], 
+                                              &std_filter[0], &std_filter[1], 
+                                              &sum_max, &nan, &nthreads)){
     return NULL;
   }
 
@@ -94,7 +95,7 @@ static PyObject* phocount_count(PyObject *self, PyObject *args){
   Py_BEGIN_ALLOW_THREADS
   
   count(input_p, out_p, stddev_p, ndims, dims, thresh, 
-        sum_filter, std_filter, sum_max, nan);
+        sum_filter, std_filter, sum_max, nan, nthreads);
 
   Py_END_ALLOW_THREADS
 
@@ -108,9 +109,136 @@ error:
   return NULL;
 }
 
+static PyObject* phocount_convert(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyObject *_gain = Py_None;
+  PyObject *_frame_scale = Py_None;
+  PyArrayObject *input = NULL;
+  PyArrayObject *gain = NULL;
+  PyArrayObject *frame_scale = NULL;
+  PyArrayObject *out = NULL;
+  npy_intp *dims;
+  int ndims;
+  float adu, sentinel;
+  int rounding;
+  int out_type;
+  int nthreads = 0;
+  int x;
+
+  if(!PyArg_ParseTuple(args, "OO!fif|OOi", &_input, &PyArray_Type, &out,
+                       &adu, &rounding, &sentinel, &_gain, &_frame_scale,
+                       &nthreads)){
+    return NULL;
+  }
+
+  if(adu <= 0){
+    PyErr_SetString(PyExc_ValueError, "ADU per photon must be positive");
+    return NULL;
+  }
+
+  switch(PyArray_TYPE(out)){
+    case NPY_FLOAT:
+      out_type = PHOTONS_FLOAT32;
+      break;
+    case NPY_INT8:
+      out_type = PHOTONS_INT8;
+      break;
+    case NPY_INT16:
+      out_type = PHOTONS_INT16;
+      break;
+    case NPY_INT32:
+      out_type = PHOTONS_INT32;
+      break;
+    default:
+      PyErr_SetString(PyExc_ValueError, "Output must be of type float32, int8, int16 or int32");
+      return NULL;
+  }
+
+  if(!PyArray_ISCARRAY(out)){
+    PyErr_SetString(PyExc_ValueError, "Output must be a writeable C-contiguous array");
+    return NULL;
+  }
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, 0, NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(input);
+  dims = PyArray_DIMS(input);
+
+  if(PyArray_NDIM(out) != ndims){
+    PyErr_SetString(PyExc_ValueError, "Output must be the shape of the input");
+    goto error;
+  }
+  for(x=0;x<ndims;x++){
+    if(PyArray_DIM(out, x) != dims[x]){
+      PyErr_SetString(PyExc_ValueError, "Output must be the shape of the input");
+      goto error;
+    }
+  }
+
+  index_t imsize = dims[ndims-1] * dims[ndims-2];
+  index_t nframes = 1;
+  for(x=0;x<(ndims-2);x++){
+    nframes = nframes * dims[x];
+  }
+
+  data_t *gain_p = NULL;
+  if(_gain != Py_None){
+    gain = (PyArrayObject*)PyArray_FROMANY(_gain, NPY_FLOAT, 0, 0, NPY_ARRAY_IN_ARRAY);
+    if(!gain){
+      goto error;
+    }
+    if(PyArray_SIZE(gain) != imsize){
+      PyErr_SetString(PyExc_ValueError, "Gain map must be the shape of the images");
+      goto error;
+    }
+    gain_p = (data_t*)PyArray_DATA(gain);
+  }
+
+  data_t *frame_scale_p = NULL;
+  if(_frame_scale != Py_None){
+    frame_scale = (PyArrayObject*)PyArray_FROMANY(_frame_scale, NPY_FLOAT, 0, 0, NPY_ARRAY_IN_ARRAY);
+    if(!frame_scale){
+      goto error;
+    }
+    if(PyArray_SIZE(frame_scale) != nframes){
+      PyErr_SetString(PyExc_ValueError, "Frame scale must have one value per image");
+      goto error;
+    }
+    frame_scale_p = (data_t*)PyArray_DATA(frame_scale);
+  }
+
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+  void *out_p = PyArray_DATA(out);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  convert(input_p, out_p, out_type, nframes, imsize, adu, gain_p, frame_scale_p,
+          rounding, sentinel, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  Py_XDECREF(input);
+  Py_XDECREF(gain);
+  Py_XDECREF(frame_scale);
+  Py_INCREF(out);
+  return (PyObject*)out;
+
+error:
+  Py_XDECREF(input);
+  Py_XDECREF(gain);
+  Py_XDECREF(frame_scale);
+  return NULL;
+}
+
 static PyMethodDef phocountMethods[] = {
   { "count", phocount_count, METH_VARARGS,
     "Identify and count photons in CCD image"},
+  { "convert", phocount_convert, METH_VARARGS,
+    "Convert ADU to photons"},
   {NULL, NULL, 0, NULL}
 };
 
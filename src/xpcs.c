@@ -0,0 +1,209 @@
+/*
+ * Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        
+ * National Laboratory. All rights reserved.                            
+ *                                                                      
+ * Redistribution and use in source and binary forms, with or without   
+ * modification, are permitted provided that the following conditions   
+ * are met:                                                             
+ *                                                                      
+ * * Redistributions of source code must retain the above copyright     
+ *   notice, this list of conditions and the following disclaimer.      
+ *                                                                      
+ * * Redistributions in binary form must reproduce the above copyright  
+ *   notice this list of conditions and the following disclaimer in     
+ *   the documentation and/or other materials provided with the         
+ *   distribution.                                                      
+ *                                                                      
+ * * Neither the name of the Brookhaven Science Associates, Brookhaven  
+ *   National Laboratory nor the names of its contributors may be used  
+ *   to endorse or promote products derived from this software without  
+ *   specific prior written permission.                                 
+ *                                                                      
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   
+ * IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   
+ * POSSIBILITY OF SUCH DAMAGE.                                          
+ *
+ */
+
+#include <omp.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <math.h>
+#include <stdint.h>
+
+#include "xpcs.h"
+
+// Correlate the newest buffer of a level with all the previous buffers
+// of the level and add the results to the sums
+static void multitau_process(multitau_t *s, int level, int nthreads){
+  int num_bufs = s->num_bufs;
+  int bufno = s->cur[level];
+  int lag_min = (level == 0) ? 0 : (num_bufs / 2);
+  int lag_max = (s->img_per_level[level] < num_bufs) ?
+                 s->img_per_level[level] : num_bufs;
+
+  if(lag_max <= lag_min){
+    return;
+  }
+
+  data_t *levelp = s->buf + ((index_t)level * num_bufs * s->npixels);
+  data_t *future = levelp + ((index_t)bufno * s->npixels);
+  int nroi = s->nroi;
+  index_t nitems = (index_t)(lag_max - lag_min) * nroi;
+
+  index_t item;
+#pragma omp parallel for schedule(dynamic) num_threads(nthreads)
+  for(item=0;item<nitems;item++){
+    int lag = lag_min + (item / nroi);
+    int roi = item % nroi;
+
+    // Channel index of this lag (level 0 has lags 0 .. num_bufs - 1,
+    // higher levels add num_bufs / 2 new lags each)
+    index_t t = (level == 0) ? lag : ((index_t)level * num_bufs / 2 + lag);
+    int delay = (bufno - lag + num_bufs) % num_bufs;
+    data_t *past = levelp + ((index_t)delay * s->npixels);
+
+    // Pixels which are not finite in either image (e.g. masked pixels)
+    // are skipped and the sums are normalised by the valid pixels
+    double pf = 0, p = 0, f = 0;
+    index_t npix = 0;
+    index_t j;
+    for(j=s->roi_start[roi];j<s->roi_start[roi+1];j++){
+      if(!isfinite(past[j]) || !isfinite(future[j])){
+        continue;
+      }
+      pf += (double)past[j] * future[j];
+      p += past[j];
+      f += future[j];
+      npix++;
+    }
+
+    if(npix){
+      s->G[t * nroi + roi] += pf / npix;
+      s->IP[t * nroi + roi] += p / npix;
+      s->IF[t * nroi + roi] += f / npix;
+      s->count[t * nroi + roi]++;
+    }
+  }
+}
+
+// Add frames to the multi-tau correlator. Each frame is added to the
+// level 0 ring buffer and every second image of a level is averaged into
+// the next level, so lags of 2^level frames are computed at each level.
+int multitau(data_t *frames, index_t nframes, index_t imsize,
+             multitau_t *s, int nthreads){
+  int num_bufs = s->num_bufs;
+  index_t npixels = s->npixels;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  index_t n;
+  for(n=0;n<nframes;n++){
+    data_t *frame = frames + (n * imsize);
+
+    s->cur[0] = (s->cur[0] + 1) % num_bufs;
+    data_t *bufp = s->buf + ((index_t)s->cur[0] * npixels);
+
+    index_t j;
+#pragma omp parallel for schedule(static) num_threads(nthreads)
+    for(j=0;j<npixels;j++){
+      bufp[j] = frame[s->pixels[j]];
+    }
+
+    s->img_per_level[0]++;
+    multitau_process(s, 0, nthreads);
+
+    int level;
+    for(level=1;level<s->num_levels;level++){
+      if(!s->track_level[level]){
+        // Wait for a second image at the previous level
+        s->track_level[level] = 1;
+        break;
+      }
+
+      data_t *prevp = s->buf + ((index_t)(level - 1) * num_bufs * npixels);
+      data_t *prev1 = prevp + ((index_t)s->cur[level-1] * npixels);
+      data_t *prev2 = prevp + ((index_t)((s->cur[level-1] - 1 + num_bufs) % num_bufs) * npixels);
+
+      s->cur[level] = (s->cur[level] + 1) % num_bufs;
+      bufp = s->buf + (((index_t)level * num_bufs + s->cur[level]) * npixels);
+
+#pragma omp parallel for schedule(static) num_threads(nthreads)
+      for(j=0;j<npixels;j++){
+        bufp[j] = 0.5 * (prev1[j] + prev2[j]);
+      }
+
+      s->track_level[level] = 0;
+      s->img_per_level[level]++;
+      multitau_process(s, level, nthreads);
+    }
+  }
+
+  return 0;
+}
+
+// Histogram the number of photons in each pixel of each roi for every
+// frame. The photon number is the value scaled and rounded to the nearest
+// integer. Values above max_photons go in the last bin and NaN values
+// (empty pixels) are skipped.
+int photon_histogram(data_t *in, index_t nframes, index_t imsize,
+                     index_t *pixels, index_t *roi_start, int nroi,
+                     data_t scale, int max_photons, int64_t *hist,
+                     double *mean, int nthreads){
+  index_t nbins = max_photons + 1;
+  index_t nitems = nframes * nroi;
+
+  if(nthreads <= 0){
+    nthreads = omp_get_max_threads();
+  }
+
+  index_t item;
+#pragma omp parallel for schedule(static) num_threads(nthreads)
+  for(item=0;item<nitems;item++){
+    index_t frame = item / nroi;
+    int roi = item % nroi;
+    data_t *inp = in + (frame * imsize);
+    int64_t *histp = hist + (item * nbins);
+
+    index_t j;
+    for(j=0;j<nbins;j++){
+      histp[j] = 0;
+    }
+
+    double sum = 0;
+    index_t n = 0;
+    for(j=roi_start[roi];j<roi_start[roi+1];j++){
+      data_t v = inp[pixels[j]];
+      if(isnan(v)){
+        continue;
+      }
+
+      long k = lrintf(v * scale);
+      if(k < 0){
+        k = 0;
+      }
+      sum += k;
+      n++;
+
+      if(k > max_photons){
+        k = max_photons;
+      }
+      histp[k]++;
+    }
+
+    mean[item] = n ? (sum / n) : NAN;
+  }
+
+  return 0;
+}
@@ -0,0 +1,71 @@
+/*
+ * Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        
+ * National Laboratory. All rights reserved.                            
+ *                                                                      
+ * Redistribution and use in source and binary forms, with or without   
+ * modification, are permitted provided that the following conditions   
+ * are met:                                                             
+ *                                                                      
+ * * Redistributions of source code must retain the above copyright     
+ *   notice, this list of conditions and the following disclaimer.      
+ *                                                                      
+ * * Redistributions in binary form must reproduce the above copyright  
+ *   notice this list of conditions and the following disclaimer in     
+ *   the documentation and/or other materials provided with the         
+ *   distribution.                                                      
+ *                                                                      
+ * * Neither the name of the Brookhaven Science Associates, Brookhaven  
+ *   National Laboratory nor the names of its contributors may be used  
+ *   to endorse or promote products derived from this software without  
+ *   specific prior written permission.                                 
+ *                                                                      
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   
+ * IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   
+ * POSSIBILITY OF SUCH DAMAGE.                                          
+ *
+ */
+
+#ifndef _XPCS_H
+#define _XPCS_H
+
+#include <stdint.h>
+
+// Use a size of long for big arrays
+typedef long index_t;
+typedef float data_t;
+
+// State of the multi-tau correlator which is kept between calls
+typedef struct {
+  int num_levels;
+  int num_bufs;
+  index_t npixels;
+  int nroi;
+  index_t *pixels;        // Index of each pixel in the image (sorted by roi)
+  index_t *roi_start;     // Offset of the first pixel of each roi (nroi + 1)
+  data_t *buf;            // Ring buffers (num_levels, num_bufs, npixels)
+  int32_t *cur;           // Current buffer of each level
+  int64_t *img_per_level; // Number of images processed at each level
+  int32_t *track_level;   // Flag to average every second image of a level
+  double *G;              // Sum of <I(t)I(t+tau)> (nchannels, nroi)
+  double *IP;             // Sum of <I(t)> (nchannels, nroi)
+  double *IF;             // Sum of <I(t+tau)> (nchannels, nroi)
+  int64_t *count;         // Number of values in the sums (nchannels, nroi)
+} multitau_t;
+
+int multitau(data_t *frames, index_t nframes, index_t imsize,
+             multitau_t *state, int nthreads);
+int photon_histogram(data_t *in, index_t nframes, index_t imsize,
+                     index_t *pixels, index_t *roi_start, int nroi,
+                     data_t scale, int max_photons, int64_t *hist,
+                     double *mean, int nthreads);
+
+#endif
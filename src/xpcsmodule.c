@@ -0,0 +1,282 @@
+/*
+ * Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        
+ * National Laboratory. All rights reserved.                            
+ *                                                                      
+ * Redistribution and use in source and binary forms, with or without   
+ * modification, are permitted provided that the following conditions   
+ * are met:                                                             
+ *                                                                      
+ * * Redistributions of source code must retain the above copyright     
+ *   notice, this list of conditions and the following disclaimer.      
+ *                                                                      
+ * * Redistributions in binary form must reproduce the above copyright  
+ *   notice this list of conditions and the following disclaimer in     
+ *   the documentation and/or other materials provided with the         
+ *   distribution.                                                      
+ *                                                                      
+ * * Neither the name of the Brookhaven Science Associates, Brookhaven  
+ *   National Laboratory nor the names of its contributors may be used  
+ *   to endorse or promote products derived from this software without  
+ *   specific prior written permission.                                 
+ *                                                                      
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   
+ * IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   
+ * POSSIBILITY OF SUCH DAMAGE.                                          
+ *
+ */
+
+#include <stdio.h>
+#include <Python.h>
+
+/* Include python and numpy header files */
+#include <math.h>
+#define NPY_NO_DEPRECATED_API NPY_1_9_API_VERSION
+#include <numpy/ndarraytypes.h>
+#include <numpy/ndarrayobject.h>
+
+#include "xpcs.h"
+
+// The correlator state is updated in place so it must be passed as arrays
+// of the exact type which are contiguous and writeable
+static int check_state(PyObject *obj, int type, const char *name){
+  if(!PyArray_Check(obj) || (PyArray_TYPE((PyArrayObject*)obj) != type) ||
+     !PyArray_ISCARRAY((PyArrayObject*)obj)){
+    PyErr_Format(PyExc_ValueError, "State array %s has the wrong type or layout", name);
+    return 0;
+  }
+  return 1;
+}
+
+static PyObject* xpcs_multitau(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyObject *_pixels, *_roi_start, *_buf, *_cur, *_img_per_level;
+  PyObject *_track_level, *_G, *_IP, *_IF, *_count;
+  PyArrayObject *input = NULL;
+  npy_intp *dims;
+  npy_intp *dims_buf;
+  int ndims;
+  int nthreads = 0;
+  int x;
+  multitau_t state;
+
+  if(!PyArg_ParseTuple(args, "OOOOOOOOOOO|i", &_input, &_pixels, &_roi_start,
+                       &_buf, &_cur, &_img_per_level, &_track_level,
+                       &_G, &_IP, &_IF, &_count, &nthreads)){
+    return NULL;
+  }
+
+  if(!check_state(_pixels, NPY_INTP, "pixels") ||
+     !check_state(_roi_start, NPY_INTP, "roi_start") ||
+     !check_state(_buf, NPY_FLOAT, "buf") ||
+     !check_state(_cur, NPY_INT32, "cur") ||
+     !check_state(_img_per_level, NPY_INT64, "img_per_level") ||
+     !check_state(_track_level, NPY_INT32, "track_level") ||
+     !check_state(_G, NPY_DOUBLE, "G") ||
+     !check_state(_IP, NPY_DOUBLE, "IP") ||
+     !check_state(_IF, NPY_DOUBLE, "IF") ||
+     !check_state(_count, NPY_INT64, "count")){
+    return NULL;
+  }
+
+  if(PyArray_NDIM((PyArrayObject*)_buf) != 3){
+    PyErr_SetString(PyExc_ValueError, "Buffer array must be of shape (num_levels, num_bufs, npixels)");
+    return NULL;
+  }
+  dims_buf = PyArray_DIMS((PyArrayObject*)_buf);
+
+  state.num_levels = dims_buf[0];
+  state.num_bufs = dims_buf[1];
+  state.npixels = dims_buf[2];
+  state.nroi = PyArray_SIZE((PyArrayObject*)_roi_start) - 1;
+  state.pixels = (index_t*)PyArray_DATA((PyArrayObject*)_pixels);
+  state.roi_start = (index_t*)PyArray_DATA((PyArrayObject*)_roi_start);
+  state.buf = (data_t*)PyArray_DATA((PyArrayObject*)_buf);
+  state.cur = (int32_t*)PyArray_DATA((PyArrayObject*)_cur);
+  state.img_per_level = (int64_t*)PyArray_DATA((PyArrayObject*)_img_per_level);
+  state.track_level = (int32_t*)PyArray_DATA((PyArrayObject*)_track_level);
+  state.G = (double*)PyArray_DATA((PyArrayObject*)_G);
+  state.IP = (double*)PyArray_DATA((PyArrayObject*)_IP);
+  state.IF = (double*)PyArray_DATA((PyArrayObject*)_IF);
+  state.count = (int64_t*)PyArray_DATA((PyArrayObject*)_count);
+
+  index_t nchannels = (index_t)(state.num_levels + 1) * state.num_bufs / 2;
+  if((PyArray_SIZE((PyArrayObject*)_pixels) != state.npixels) ||
+     (PyArray_SIZE((PyArrayObject*)_cur) != state.num_levels) ||
+     (PyArray_SIZE((PyArrayObject*)_img_per_level) != state.num_levels) ||
+     (PyArray_SIZE((PyArrayObject*)_track_level) != state.num_levels) ||
+     (PyArray_SIZE((PyArrayObject*)_G) != nchannels * state.nroi) ||
+     (PyArray_SIZE((PyArrayObject*)_IP) != nchannels * state.nroi) ||
+     (PyArray_SIZE((PyArrayObject*)_IF) != nchannels * state.nroi) ||
+     (PyArray_SIZE((PyArrayObject*)_count) != nchannels * state.nroi)){
+    PyErr_SetString(PyExc_ValueError, "State arrays have inconsistent sizes");
+    return NULL;
+  }
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, 0, NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(input);
+  dims = PyArray_DIMS(input);
+
+  index_t imsize = dims[ndims-1] * dims[ndims-2];
+  index_t nframes = 1;
+  for(x=0;x<(ndims-2);x++){
+    nframes = nframes * dims[x];
+  }
+
+  // Check the pixel indices are inside the image
+  index_t j;
+  for(j=0;j<state.npixels;j++){
+    if(state.pixels[j] < 0 || state.pixels[j] >= imsize){
+      PyErr_SetString(PyExc_ValueError, "Dimensions of image array do not match labels");
+      goto error;
+    }
+  }
+
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  multitau(input_p, nframes, imsize, &state, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  Py_XDECREF(input);
+  Py_RETURN_NONE;
+
+error:
+  Py_XDECREF(input);
+  return NULL;
+}
+
+static PyObject* xpcs_photon_histogram(PyObject *self, PyObject *args){
+  PyObject *_input = NULL;
+  PyObject *_pixels, *_roi_start;
+  PyArrayObject *input = NULL;
+  PyArrayObject *hist = NULL;
+  PyArrayObject *mean = NULL;
+  npy_intp *dims;
+  npy_intp dims_out[NPY_MAXDIMS];
+  int ndims;
+  float scale = 1.0;
+  int max_photons;
+  int nthreads = 0;
+  int x;
+
+  if(!PyArg_ParseTuple(args, "OOOfi|i", &_input, &_pixels, &_roi_start,
+                       &scale, &max_photons, &nthreads)){
+    return NULL;
+  }
+
+  if(!check_state(_pixels, NPY_INTP, "pixels") ||
+     !check_state(_roi_start, NPY_INTP, "roi_start")){
+    return NULL;
+  }
+
+  if(max_photons < 0){
+    PyErr_SetString(PyExc_ValueError, "max_photons must be positive");
+    return NULL;
+  }
+
+  index_t npixels = PyArray_SIZE((PyArrayObject*)_pixels);
+  int nroi = PyArray_SIZE((PyArrayObject*)_roi_start) - 1;
+  index_t *pixels = (index_t*)PyArray_DATA((PyArrayObject*)_pixels);
+  index_t *roi_start = (index_t*)PyArray_DATA((PyArrayObject*)_roi_start);
+
+  input = (PyArrayObject*)PyArray_FROMANY(_input, NPY_FLOAT, 2, NPY_MAXDIMS - 1, NPY_ARRAY_IN_ARRAY);
+  if(!input){
+    goto error;
+  }
+
+  ndims = PyArray_NDIM(input);
+  dims = PyArray_DIMS(input);
+
+  index_t imsize = dims[ndims-1] * dims[ndims-2];
+  index_t nframes = 1;
+  for(x=0;x<(ndims-2);x++){
+    nframes = nframes * dims[x];
+    dims_out[x] = dims[x];
+  }
+  dims_out[ndims-2] = nroi;
+  dims_out[ndims-1] = max_photons + 1;
+
+  index_t j;
+  for(j=0;j<npixels;j++){
+    if(pixels[j] < 0 || pixels[j] >= imsize){
+      PyErr_SetString(PyExc_ValueError, "Dimensions of image array do not match labels");
+      goto error;
+    }
+  }
+
+  hist = (PyArrayObject*)PyArray_SimpleNew(ndims, dims_out, NPY_INT64);
+  if(!hist){
+    goto error;
+  }
+
+  mean = (PyArrayObject*)PyArray_SimpleNew(ndims - 1, dims_out, NPY_DOUBLE);
+  if(!mean){
+    goto error;
+  }
+
+  data_t *input_p = (data_t*)PyArray_DATA(input);
+  int64_t *hist_p = (int64_t*)PyArray_DATA(hist);
+  double *mean_p = (double*)PyArray_DATA(mean);
+
+  // Ok now we don't touch Python Object ... Release the GIL
+  Py_BEGIN_ALLOW_THREADS
+
+  photon_histogram(input_p, nframes, imsize, pixels, roi_start, nroi,
+                   scale, max_photons, hist_p, mean_p, nthreads);
+
+  Py_END_ALLOW_THREADS
+
+  Py_XDECREF(input);
+  return Py_BuildValue("(NN)", hist, mean);
+
+error:
+  Py_XDECREF(input);
+  Py_XDECREF(hist);
+  Py_XDECREF(mean);
+  return NULL;
+}
+
+static PyMethodDef xpcsMethods[] = {
+  { "multitau", xpcs_multitau, METH_VARARGS,
+    "Add images to a multi-tau correlator"},
+  { "photon_histogram", xpcs_photon_histogram, METH_VARARGS,
+    "Histogram the number of photons per pixel of each roi"},
+  {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef xpcsmodule = {
+   PyModuleDef_HEAD_INIT,
+   "xpcs",      /* name of module */
+   NULL,        /* module documentation, may be NULL */
+   -1,          /* size of per-interpreter state of the module,
+                   or -1 if the module keeps state in global variables. */
+   xpcsMethods
+};
+
+PyMODINIT_FUNC PyInit_xpcs(void) {
+  PyObject *m;
+  m = PyModule_Create(&xpcsmodule);
+  if(m == NULL){
+    return NULL;
+  }
+
+  import_array();
+
+  return m;
+}
@@ -0,0 +1,211 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal
+
+from csxtools import batch, pipeline
+from csxtools.axis1 import correct_images_axis
+from csxtools.io import read_corrected, read_provenance
+
+
+class FakeHeader(object):
+    def __init__(self, uid, images):
+        self.start = {"uid": uid, "time": 0.0}
+        self.images = images
+
+
+def _raw(seed, shape=(5, 10, 12)):
+    np.random.seed(seed)
+    return np.random.randint(0, 0x1FFF, size=shape).astype(np.uint16)
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """A catalog of fake axis1 runs, scan 1 is the dark of the others"""
+    db = {s: FakeHeader("uid{}".format(s), _raw(s)) for s in range(1, 6)}
+
+    def _get_images(header, tag, roi=None, direct=False):
+        if header.start["uid"] == "uid4":
+            raise RuntimeError("Unreadable run")
+        images = header.images
+        if roi is not None:
+            images = pipeline._crop(images, roi)
+        return images
+
+    monkeypatch.setattr(pipeline, "_get_images", _get_images)
+    monkeypatch.setattr(batch, "_open_catalog", lambda name: db)
+    pipeline.clear_dark_cache()
+    yield db
+    pipeline.clear_dark_cache()
+
+
+def test_parse_scan_ids():
+    assert batch.parse_scan_ids("5") == [5]
+    assert batch.parse_scan_ids(["1-3", "7"]) == [1, 2, 3, 7]
+    assert batch.parse_scan_ids("1-3,2,8") == [1, 2, 3, 8]
+    assert batch.parse_scan_ids("-1") == [-1]
+    assert batch.parse_scan_ids("-3--2") == [-3, -2]
+    for spec in ("a", "3-1", "1-"):
+        with pytest.raises(ValueError):
+            batch.parse_scan_ids(spec)
+
+
+def test_process_scan(tmpdir, catalog):
+    record = batch.process_scan(
+        catalog, 2, str(tmpdir), detector="axis1", darks=(1,), chunk_size=2
+    )
+    assert record["status"] == "done"
+    assert record["dark_uids"] == ["uid1"]
+    assert record["shape"] == [5, 10, 12]
+
+    expected = correct_images_axis(
+        _raw(2), catalog[1].images.mean(axis=0).astype(np.float32)
+    )
+    assert_array_almost_equal(read_corrected(record["output"], lazy=False), expected)
+    assert read_provenance(record["output"])["scan_id"] == 2
+    assert not os.path.exists(record["output"] + ".part")
+
+
+def test_main_resume(tmpdir, catalog, monkeypatch):
+    output = str(tmpdir)
+    argv = ["2-4", "5", "--output", output, "--detector", "axis1", "--darks", "1"]
+
+    assert batch.main(argv) == 1
+    records = batch.read_manifest(os.path.join(output, batch.MANIFEST))
+    assert sorted(records) == [2, 3, 4, 5]
+    assert records[4]["status"] == "failed"
+    assert "Unreadable run" in records[4]["error"]
+    assert all(records[s]["status"] == "done" for s in (2, 3, 5))
+
+    # Only the failed scan and the scan whose output is missing are redone
+    os.remove(records[3]["output"])
+    with open(os.path.join(output, batch.MANIFEST), "a") as f:
+        f.write('{"scan_id": 5, "sta')
+    processed = []
+    process_scan = batch.process_scan
+
+    def _process_scan(db, scan_id, output, **kwargs):
+        processed.append(scan_id)
+        return process_scan(db, scan_id, output, **kwargs)
+
+    monkeypatch.setattr(batch, "process_scan", _process_scan)
+    assert batch.main(argv) == 1
+    assert processed == [3, 4]
+
+    with open(os.path.join(output, batch.MANIFEST)) as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[-1])["scan_id"] == 4
+
+
+def test_resume_options_changed(tmpdir, catalog, monkeypatch):
+    output = str(tmpdir)
+    argv = ["2", "3", "--output", output, "--detector", "axis1", "--darks", "1"]
+    assert batch.main(argv) == 0
+
+    processed = []
+    process_scan = batch.process_scan
+
+    def _process_scan(db, scan_id, output, **kwargs):
+        processed.append(scan_id)
+        return process_scan(db, scan_id, output, **kwargs)
+
+    monkeypatch.setattr(batch, "process_scan", _process_scan)
+    assert batch.main(argv) == 0
+    assert processed == []
+
+    # The scans are redone with another ROI
+    assert batch.main(argv + ["--roi", "0,0,4,4"]) == 0
+    assert processed == [2, 3]
+    records = batch.read_manifest(os.path.join(output, batch.MANIFEST))
+    assert records[2]["options"]["roi"] == [0, 0, 4, 4]
+    assert records[2]["shape"] == [5, 4, 4]
+
+
+FAKE_CATALOG = """
+import os
+
+import numpy as np
+
+from csxtools import pipeline
+
+
+class FakeHeader(object):
+    def __init__(self, uid, images):
+        self.start = {"uid": uid, "time": 0.0}
+        self.images = images
+
+
+def _get_images(header, tag, roi=None, direct=False):
+    if header.start["uid"] == "uid4":
+        os._exit(1)  # A worker killed while processing the scan
+    return header.images
+
+
+def catalog():
+    pipeline._get_images = _get_images
+    np.random.seed(0)
+    return {
+        s: FakeHeader("uid{}".format(s), np.random.randint(0, 100, size=(3, 6, 5)))
+        for s in range(1, 12)
+    }
+"""
+
+
+def test_pool_worker_dies(tmpdir, monkeypatch):
+    tmpdir.join("fake_batch_catalog.py").write(FAKE_CATALOG)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    output = str(tmpdir.join("out"))
+
+    results = batch.run_batch(
+        [2, 3, 4, 5, 6],
+        "fake_batch_catalog:catalog",
+        output,
+        workers=2,
+        threads=2,
+        detector="axis1",
+        darks=(1,),
+    )
+    assert results[4]["status"] == "failed"
+    assert "died" in results[4]["error"]
+    for s in (2, 3, 5, 6):
+        assert results[s]["status"] == "done"
+        # The workers run with the thread cap
+        assert results[s]["threads"] == 2
+        assert read_corrected(results[s]["output"], lazy=False).shape == (3, 6, 5)
+
+    # The environment of this process is left alone
+    assert "OMP_NUM_THREADS" not in os.environ
+    records = batch.read_manifest(os.path.join(output, batch.MANIFEST))
+    assert sorted(records) == [2, 3, 4, 5, 6]
+
+
+def test_pool_worker_dies_queued(tmpdir, monkeypatch):
+    tmpdir.join("fake_batch_catalog.py").write(FAKE_CATALOG)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    pools = []
+    start_pool = batch._start_pool
+
+    def _start_pool(workers, *args):
+        pools.append(workers)
+        return start_pool(workers, *args)
+
+    monkeypatch.setattr(batch, "_start_pool", _start_pool)
+    scan_ids = list(range(2, 12))
+    results = batch.run_batch(
+        scan_ids,
+        "fake_batch_catalog:catalog",
+        str(tmpdir.join("out")),
+        workers=2,
+        threads=1,
+        detector="axis1",
+        darks=(1,),
+    )
+    assert results[4]["status"] == "failed"
+    assert all(results[s]["status"] == "done" for s in scan_ids if s != 4)
+    # The scans queued behind the dying scan are not processed one at a time,
+    # only those running with it (at most one per worker)
+    assert pools[:2] == [2, 2]
+    assert 1 <= pools.count(1) <= 2
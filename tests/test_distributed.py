@@ -0,0 +1,204 @@
+import pickle
+import warnings
+
+import dask
+import dask.array as da
+import h5py
+import numpy as np
+import pytest
+from event_model import compose_run
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from csxtools import distributed, pipeline
+from csxtools.fastccd import adu_to_photons
+from csxtools.pipeline import Pipeline
+
+
+class FakeHeader(object):
+    def __init__(self, uid, images):
+        self.start = {"uid": uid}
+        self.images = images
+
+
+@pytest.fixture(autouse=True)
+def reads(monkeypatch):
+    """Read the fake headers as dask arrays (as from tiled)"""
+
+    def _get_images(header, tag, roi=None, direct=False):
+        images = header.images
+        if roi is not None:
+            images = pipeline._crop(images, roi)
+        if direct:
+            return images
+        return da.from_array(images, chunks=(2,) + images.shape[1:])
+
+    monkeypatch.setattr(pipeline, "_get_images", _get_images)
+    pipeline.clear_dark_cache()
+    yield
+    pipeline.clear_dark_cache()
+
+
+def _raw(seed, shape=(6, 2, 10, 12)):
+    np.random.seed(seed)
+    return np.random.randint(0, 0x1FFF, size=shape).astype(np.uint16)
+
+
+def test_broadcast():
+    assert distributed.broadcast(None) is None
+    data = np.arange(12.0).reshape(3, 4)
+    payload = distributed.broadcast(data)
+    assert_array_equal(payload.compute(), data)
+
+    images = da.ones((8, 3, 4), chunks=(2, 3, 4))
+    out = images.map_blocks(lambda b, d: b + d, payload, dtype=float)
+    assert_array_equal(out.compute(), 1 + np.broadcast_to(data, (8, 3, 4)))
+    # The payload is a single task shared by the four blocks
+    graph = dict(out.__dask_graph__())
+    assert len(graph) == 2 * 4 + 1
+
+
+def test_correct_images():
+    light = FakeHeader("light", _raw(0))
+    darks = tuple(FakeHeader("dark{}".format(i), _raw(i + 1)) for i in range(3))
+    flat = np.random.uniform(0.8, 1.2, size=(12, 10)).astype(np.float32)
+
+    images = distributed.correct_images("fccd", light, darks, flat)
+    assert isinstance(images, da.Array)
+    assert images.shape == (6, 2, 12, 10)
+
+    expected = Pipeline("fccd").images(light, darks, flat)
+    with dask.config.set(scheduler="sync"):
+        assert_array_almost_equal(images.compute(), expected)
+
+
+class FileHeader(object):
+    """Header of a run with the images in AreaDetector files"""
+
+    def __init__(self, tmpdir, files, fpp):
+        run = compose_run()
+        self.start = run.start_doc
+        self.docs = [("start", run.start_doc)]
+        desc = run.compose_descriptor(
+            data_keys={
+                "fccd_image": {
+                    "source": "test",
+                    "dtype": "array",
+                    "shape": [fpp, 12, 12],
+                    "external": "FILESTORE:",
+                }
+            },
+            name="primary",
+        )
+        self.docs.append(("descriptor", desc.descriptor_doc))
+        seq_num = 1
+        for filename, data in files:
+            with h5py.File(str(tmpdir.join(filename)), "w") as f:
+                f.create_dataset("entry/data/data", data=data)
+            res = run.compose_resource(
+                spec="AD_HDF5",
+                root=str(tmpdir),
+                resource_path=filename,
+                resource_kwargs={"frame_per_point": fpp},
+            )
+            self.docs.append(("resource", res.resource_doc))
+            for i in range(len(data) // fpp):
+                datum = res.compose_datum(datum_kwargs={"point_number": i})
+                self.docs.append(("datum", datum))
+                event = desc.compose_event(
+                    data={"fccd_image": datum["datum_id"]},
+                    timestamps={"fccd_image": 0.0},
+                    seq_num=seq_num,
+                    filled={"fccd_image": False},
+                )
+                self.docs.append(("event", event))
+                seq_num += 1
+        self.docs.append(("stop", run.compose_stop()))
+
+    def documents(self, fill=False):
+        return iter(self.docs)
+
+
+def test_correct_images_direct(tmpdir):
+    raw = _raw(0, (20, 2, 12, 12))
+    frames = raw.reshape(-1, 12, 12)
+    light = FileHeader(tmpdir, [("a.h5", frames[:24]), ("b.h5", frames[24:])], 2)
+    darks = tuple(
+        FakeHeader("dark{}".format(i), _raw(i + 1, (3, 2, 12, 12))) for i in range(3)
+    )
+    flat = np.random.uniform(0.8, 1.2, size=(12, 12)).astype(np.float32)
+    roi = [2, 1, 9, 10]
+
+    images = distributed.correct_images(
+        "fccd", light, darks, flat, roi=roi, chunk_size=5, direct=True
+    )
+    # The graph reads the frames of each block, it only holds the payloads
+    graph = dict(images.__dask_graph__())
+    assert len(pickle.dumps(graph)) < raw.nbytes / 2
+    # Blocks of up to 5 events in each of the two files
+    assert images.chunks[0] == (5, 5, 2, 5, 3)
+
+    pipe = Pipeline("fccd")
+    crop = pipeline._crop
+    expected = pipe.correct(crop(raw, roi), pipe.darks(darks, roi), crop(flat, roi))
+    with dask.config.set(scheduler="sync"):
+        assert_array_almost_equal(images.compute(), expected)
+
+
+def test_stack_mean():
+    np.random.seed(3)
+    data = np.random.uniform(0, 10, size=(13, 2, 5, 6)).astype(np.float32)
+    data[:, :, 0, 0] = np.nan
+    data[::2, :, 1, 1] = np.nan
+    images = da.from_array(data, chunks=(1, 2, 5, 3))
+
+    mean = distributed.stack_mean(images, split_every=3)
+    assert mean.shape == (5, 6)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = np.nanmean(data.reshape(-1, 5, 6), axis=0)
+    # As stackmean, pixels without values are zero
+    expected[0, 0] = 0
+    assert_array_almost_equal(mean.compute(), expected, decimal=5)
+
+    with pytest.raises(ValueError):
+        distributed.stack_mean(images, split_every=1)
+
+
+def test_count_photons():
+    np.random.seed(4)
+    data = np.random.uniform(0, 200, size=(8, 5, 6)).astype(np.float32)
+    gain = np.random.uniform(0.9, 1.1, size=(5, 6)).astype(np.float32)
+    images = da.from_array(data, chunks=(2, 5, 6))
+
+    photons = distributed.count_photons(images, 30.0, gain=gain)
+    assert photons.dtype == np.int16
+    assert_array_equal(photons.compute(), adu_to_photons(data, 30.0, gain=gain))
+
+    with pytest.raises(ValueError):
+        distributed.count_photons(data, 30.0)
+
+
+def test_local_cluster():
+    pytest.importorskip("distributed")
+    from distributed import Client, Future, LocalCluster
+
+    light = FakeHeader("light", _raw(0))
+    darks = (FakeHeader("dark", _raw(1)),)
+    flat = np.random.uniform(0.8, 1.2, size=(12, 10)).astype(np.float32)
+    gain = np.random.uniform(0.9, 1.1, size=(12, 10)).astype(np.float32)
+
+    with LocalCluster(n_workers=1, processes=False) as cluster, Client(
+        cluster
+    ) as client:
+        # The payload is scattered to the workers once
+        payload = distributed.broadcast(flat)
+        assert isinstance(payload.compute(), np.ndarray)
+        assert any(isinstance(v, Future) for v in payload.dask.values())
+
+        images = distributed.correct_images("fccd", light, darks, flat)
+        photons = distributed.count_photons(images, 30.0, gain=gain)
+        result, counts = client.compute([images, photons], sync=True)
+
+    expected = Pipeline("fccd").images(light, darks, flat)
+    assert_array_almost_equal(result, expected)
+    assert_array_equal(counts, adu_to_photons(expected, 30.0, gain=gain))
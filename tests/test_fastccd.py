@@ -1,5 +1,12 @@
 import numpy as np
-from csxtools.fastccd import correct_images, photon_count
+import pytest
+from csxtools.fastccd import (
+    correct_images,
+    correct_common_mode,
+    photon_count,
+    adu_to_photons,
+    fe55_gain_map,
+)
 from numpy.testing import (
     assert_array_max_ulp,
     assert_array_equal,
@@ -21,6 +28,28 @@ def test_correct_images():
     assert_array_max_ulp(z, np.zeros_like(x))
 
 
+def test_correct_common_mode():
+    offsets = np.arange(4 * 10 * 2, dtype=np.float32).reshape(4, 10, 2)
+    x = np.repeat(offsets, 5, axis=-1)
+    x[:, 3, 1] += 100.0
+    x[0, 4, 7] = np.nan
+
+    mask = np.ones((10, 10), dtype=bool)
+    mask[:, 1] = False
+
+    y = np.zeros_like(x)
+    y[:, 3, 1] = 100.0
+    y[0, 4, 7] = np.nan
+
+    z = correct_common_mode(x, mask=mask, nchannels=2, axis="row")
+    assert_array_equal(z, y)
+
+    z = correct_common_mode(
+        np.swapaxes(x, -1, -2), mask=mask.T, nchannels=2, axis="column"
+    )
+    assert_array_equal(z, np.swapaxes(y, -1, -2))
+
+
 def test_photon_count():
     x = np.array(
         [
@@ -51,3 +80,102 @@ def test_photon_count():
 
     assert_array_equal(op[0], np.array([y, y, y]))
     assert_array_almost_equal(op[1], np.array([z, z, z]), decimal=6)
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.int16, np.int32, np.float32])
+@pytest.mark.parametrize("rounding", ["nearest", "floor", "ceil", "trunc"])
+def test_adu_to_photons(dtype, rounding):
+    np.random.seed(4)
+    data = np.random.uniform(-100, 2000, size=(3, 2, 10, 12)).astype(np.float32)
+    data[0, 0, 1, 1] = np.nan
+    data[1, 1, 2, 3] = 1e6
+
+    func = {"nearest": np.round, "floor": np.floor, "ceil": np.ceil, "trunc": np.trunc}
+    expected = func[rounding](data / np.float32(30))
+    if np.dtype(dtype).kind == "i":
+        info = np.iinfo(dtype)
+        expected = np.clip(expected, info.min, info.max)
+        expected[np.isnan(data)] = -1
+    photons = adu_to_photons(data, 30, rounding, dtype)
+    assert photons.dtype == dtype
+    assert_array_equal(photons, expected.astype(dtype))
+
+
+def test_adu_to_photons_out():
+    data = np.array([[[np.nan, 44.0], [45.0, 75.0]]], dtype=np.float32)
+
+    out = np.zeros((1, 2, 2), dtype=np.int8)
+    assert adu_to_photons(data, 30, out=out, sentinel=-5) is out
+    assert_array_equal(out, [[[-5, 1], [2, 2]]])
+
+    assert_array_equal(adu_to_photons(data, 30, None, np.int16), [[[-1, 1], [1, 2]]])
+    photons = adu_to_photons(data, 30, dtype=np.float32)
+    assert np.isnan(photons[0, 0, 0])
+
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 30, dtype=np.int64)
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 30, out=np.zeros((1, 2, 3), dtype=np.int16))
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 0)
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 30, "up")
+
+
+def test_adu_to_photons_dask():
+    da = pytest.importorskip("dask.array")
+    np.random.seed(5)
+    data = np.random.uniform(0, 300, size=(6, 8, 9)).astype(np.float32)
+    lazy = adu_to_photons(da.from_array(data, chunks=(2, 8, 9)), 25, dtype=np.int8)
+    assert lazy.dtype == np.int8
+    assert_array_equal(lazy.compute(), adu_to_photons(data, 25, dtype=np.int8))
+
+
+def test_adu_to_photons_gain_energy():
+    np.random.seed(6)
+    data = np.random.uniform(0, 500, size=(4, 2, 6, 7)).astype(np.float32)
+    gain = np.random.uniform(0.8, 1.2, size=(6, 7)).astype(np.float32)
+    gain[2, 3] = np.nan
+    scale = np.array([1.0, 1.5, 2.0, 0.5], dtype=np.float32)
+
+    # One scale per event broadcast over the frames of the event
+    adu = np.float32(30) * scale[:, None, None, None] * gain
+    expected = np.round(data / adu)
+    expected[np.isnan(expected)] = -1
+
+    photons = adu_to_photons(data, 30, gain=gain, frame_scale=scale)
+    assert_array_equal(photons, expected.astype(np.int16))
+
+    da = pytest.importorskip("dask.array")
+    lazy = adu_to_photons(
+        da.from_array(data, chunks=(1, 2, 3, 7)), 30, gain=gain, frame_scale=scale
+    )
+    assert_array_equal(lazy.compute(), photons)
+
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 30, gain=gain[:5])
+    with pytest.raises(ValueError):
+        adu_to_photons(data, 30, frame_scale=scale[:3])
+
+
+def test_fe55_gain_map():
+    np.random.seed(7)
+    gain = np.random.uniform(0.8, 1.2, size=(20, 24)).astype(np.float32)
+    images = np.zeros((60, 20, 24), dtype=np.float32)
+    # Isolated single pixel photons of 100 ADU (times the gain)
+    for n in range(60):
+        for y in range(1 + n % 3, 19, 3):
+            for x in range(1 + (n // 3) % 3, 23, 3):
+                images[n, y, x] = 100 * gain[y, x]
+
+    gain_map, adu = fe55_gain_map(
+        images, thresh=(50, 200), mean_filter=(50, 200), nsum=1, min_hits=5
+    )
+    inner = np.s_[1:19, 1:23]
+    ref = gain[inner] / np.median(gain[inner])
+    assert_array_almost_equal(gain_map[inner], ref, decimal=5)
+    assert np.isnan(gain_map[0, 0])
+    assert adu == pytest.approx(100 * np.median(gain[inner]), rel=1e-5)
+
+    with pytest.raises(ValueError):
+        fe55_gain_map(images, thresh=(500, 600), mean_filter=(500, 600), nsum=1)
@@ -0,0 +1,95 @@
+import datetime
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from csxtools import settings
+from csxtools.flatfield import FlatfieldStore, FlatfieldAccumulator
+from csxtools.utils import calculate_flatfield, get_fastccd_images
+
+
+class FakeHeader(object):
+    def __init__(self, start):
+        self.start = start
+
+
+def test_store_versions(tmpdir):
+    store = FlatfieldStore(str(tmpdir))
+    assert store.entries() == []
+    assert store.find("fccd", 100.0) is None
+
+    a = np.ones((4, 5))
+    b = np.full((4, 5), 2.0)
+    c = np.full((4, 5), 3.0)
+    assert store.save(a, "fccd", start=0, runs=["uid1"]) == 1
+    assert store.save(b, "fccd", start=100, end=200) == 2
+    assert store.save(c, "axis1", start=0, variance=c) == 1
+
+    assert_array_equal(store.load("fccd", 50), a)
+    assert_array_equal(store.load("fccd", 150), b)
+    # The range excludes the end so the older version is used
+    assert_array_equal(store.load("fccd", 200), a)
+    assert_array_equal(store.load("fccd", version=2), b)
+    assert_array_equal(store.load("fccd"), b)
+
+    flat, var = store.load("axis1", 10, variance=True)
+    assert_array_equal(var, c)
+    assert store.load("fccd", 10, variance=True)[1] is None
+
+    assert [e["version"] for e in store.entries("fccd")] == [1, 2]
+    assert len(store.entries()) == 3
+    assert store.find("fccd", 50)["runs"] == ["uid1"]
+
+    with pytest.raises(ValueError):
+        store.load("fccd", -1)
+    with pytest.raises(ValueError):
+        store.load("fccd", version=3)
+    with pytest.raises(ValueError):
+        store.save(a, "fccd", start=10, end=5)
+    with pytest.raises(ValueError):
+        store.save(a[0], "fccd", start=0)
+
+
+def test_store_datetimes(tmpdir):
+    store = FlatfieldStore(str(tmpdir))
+    store.save(np.ones((2, 2)), "fccd", start="2026-01-01", end="2026-02-01")
+    t = datetime.datetime(2026, 1, 15)
+    assert store.find("fccd", t)["version"] == 1
+    assert store.find("fccd", t.timestamp())["version"] == 1
+    assert store.find("fccd", "2026-02-01") is None
+
+
+def test_accumulator(tmpdir):
+    np.random.seed(0)
+    x = np.random.normal(100, 10, size=(10, 6, 7)).astype(np.float32)
+    y = np.random.normal(100, 10, size=(5, 6, 7)).astype(np.float32)
+
+    acc = FlatfieldAccumulator("fccd", limits=(0.5, 1.5))
+    with pytest.raises(ValueError):
+        acc.flatfield()
+    acc.add_images(x, run="a")
+    acc.add_images(y, weight=2.0, run="b")
+
+    ref = np.concatenate([x, y, y])
+    assert_array_almost_equal(acc.mean, ref.mean(axis=0), decimal=4)
+    assert_array_almost_equal(acc.var, ref.var(axis=0), decimal=2)
+    assert_array_almost_equal(acc.uncertainty, np.sqrt(ref.var(axis=0) / 20), decimal=3)
+    assert_array_almost_equal(
+        acc.flatfield(), calculate_flatfield(acc.mean, (0.5, 1.5))
+    )
+
+    store = FlatfieldStore(str(tmpdir))
+    assert acc.save(store, start=0) == 1
+    entry = store.find("fccd", 1)
+    assert entry["runs"] == ["a", "b"]
+    assert entry["metadata"]["limits"] == [0.5, 1.5]
+
+    with pytest.raises(ValueError):
+        FlatfieldAccumulator("nodetector")
+
+
+def test_auto_flat_missing(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, "flatfield_dir", str(tmpdir))
+    with pytest.raises(ValueError):
+        get_fastccd_images(FakeHeader({"time": 100.0}), flat="auto")
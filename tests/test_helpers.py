@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from csxtools.helpers import (
+    get_fastccd_config,
+    clear_config_cache,
+    get_fastccd_exp,
+    get_fastccd_roi,
+    convert_photons,
+)
+from csxtools.helpers.fastccd import get_fastccd_pixel_readout
+
+
+class Table(dict):
+    pass
+
+
+class FakeHeader(object):
+    """Header which counts the fetches of its descriptors and table"""
+
+    def __init__(self, uid, config):
+        self.start = {"uid": uid, "time": 0.0, "scan_id": 1}
+        self.stop = {"time": 1.0, "exit_status": "success"}
+        self._config = config
+        self.fetches = 0
+
+    @property
+    def descriptors(self):
+        self.fetches += 1
+        return [{"configuration": {"fccd": {"data": self._config}}}]
+
+    def table(self):
+        self.fetches += 1
+        return Table(
+            fccd_acquire_time={1: 0.1},
+            fccd_acquire_period={1: 0.2},
+            fccd_num_images={1: 5},
+        )
+
+
+@pytest.fixture(autouse=True)
+def _clear():
+    clear_config_cache()
+    yield
+    clear_config_cache()
+
+
+def test_config_cached():
+    config = {
+        "fccd_cam_acquire_time": 1.0,
+        "fccd_cam_acquire_period": 1.5,
+        "fccd_cam_num_images": 10,
+        "fccd_cam_overscan_cols": 2,
+        "fccd_fccd1_rows": 480,
+        "fccd_fccd1_row_offset": 6,
+        "fccd_roi1_min_xyz_min_x": 1,
+        "fccd_roi1_size_x": 2,
+        "fccd_roi1_min_xyz_min_y": 3,
+        "fccd_roi1_size_y": 4,
+        "fccd_roi1_name_": "roi",
+    }
+    header = FakeHeader("a", config)
+
+    assert tuple(get_fastccd_exp(header)) == (1.0, 1.5, 10)
+    assert tuple(get_fastccd_roi(header, 1)) == (1, 2, 3, 4, "roi")
+    assert tuple(get_fastccd_pixel_readout(header)) == (2, 480, 6)
+    assert header.fetches == 1
+
+    # Another header object of the same run shares the configuration
+    other = FakeHeader("a", {})
+    assert get_fastccd_config(other) is get_fastccd_config(header)
+    assert other.fetches == 0
+
+
+def test_config_table():
+    header = FakeHeader("b", {})
+    assert tuple(get_fastccd_exp(header)) == (0.1, 0.2, 5)
+    assert tuple(get_fastccd_exp(header)) == (0.1, 0.2, 5)
+    # The descriptors and the table are each fetched once
+    assert header.fetches == 2
+
+
+def test_config_stop_not_cached_while_running():
+    header = FakeHeader("c", {})
+    header.stop = None
+    config = get_fastccd_config(header)
+    assert config.stop == {}
+
+    # The run finishes after it was first looked up
+    header.stop = {"time": 2.0, "exit_status": "success"}
+    assert get_fastccd_config(header).stop["time"] == 2.0
+
+
+def test_convert_photons():
+    images = np.array([[[np.nan, 29.0], [31.0, 95.0]]], dtype=np.float32)
+
+    photons, energy, adu, adupph = convert_photons(images, 930)
+    assert adupph == 30
+    assert photons.dtype == np.int16
+    assert_array_equal(photons, [[[-1, 1], [1, 3]]])
+
+    photons, *_ = convert_photons(images, 930, make_int_strip_nan=False)
+    assert_array_equal(photons, [[[np.nan, 1], [1, 3]]])
+
+    photons, *_ = convert_photons(images, [920, 940], quantize_photons=False)
+    assert_array_almost_equal(photons, images / 30)
+
+
+def test_convert_photons_energy_scan():
+    images = np.full((3, 1, 2, 2), 120.0, dtype=np.float32)
+    gain = np.array([[1.0, 2.0], [0.5, np.nan]], dtype=np.float32)
+
+    photons, energy, adu, adupph = convert_photons(
+        images, [930, 1860, np.nan], per_frame_energy=True, gain_map=gain
+    )
+    assert_array_equal(adupph, [30, 60, np.nan])
+    assert_array_equal(photons[0, 0], [[4, 2], [8, -1]])
+    assert_array_equal(photons[1, 0], [[2, 1], [4, -1]])
+    assert_array_equal(photons[2], -1)
+
+
+def test_convert_photons_energy_scan_not_rounded_to_tens():
+    # Across 775 eV the ADU per photon rounded to tens jumps from 20 to 30
+    energy = np.array([760.0, 790.0])
+    images = np.full((2, 2, 2), 250.0, dtype=np.float32)
+
+    photons, _, _, adupph = convert_photons(
+        images, energy, per_frame_energy=True, make_int_strip_nan=False
+    )
+    assert_array_almost_equal(adupph, np.round(30 * energy / 930, 2))
+    assert_array_equal(photons[0], np.round(250 / adupph[0]))
+    assert_array_equal(photons[1], np.round(250 / adupph[1]))
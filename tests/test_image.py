@@ -1,14 +1,19 @@
 from csxtools.image import (
     rotate90,
+    bin_stack,
     stackmean,
     stacksum,
     stackstd,
     stackvar,
     stackstderr,
+    stackmedian,
+    stackclipmean,
     images_mean,
     images_sum,
+    StackAccumulator,
 )
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 
@@ -87,6 +92,76 @@ def test_stackstderr():
     assert_array_equal(n, np.ones((20, 20), dtype=np.float32) * 1000.0)
 
 
+def test_stack_axis():
+    x = np.random.RandomState(0).rand(3, 4, 5, 20, 30).astype(np.float32)
+    x[x < 0.05] = np.nan
+
+    m = stackmean(x, axis=2)
+    assert m.shape == (3, 4, 20, 30)
+    assert_array_almost_equal(m, np.nanmean(x, axis=2), 6)
+
+    m = stackmean(x, axis=(0, -3))
+    assert_array_almost_equal(m, np.nanmean(x, axis=(0, 2)), 6)
+
+    m, n = stackvar(x, axis=1)
+    assert_array_almost_equal(m, np.nanvar(x, axis=1), 5)
+    assert_array_equal(n, np.sum(~np.isnan(x), axis=1))
+
+    m, n = stacksum(x, norm=False, axis=(1, 2))
+    assert_array_almost_equal(m, np.nansum(x, axis=(1, 2)), 5)
+
+    m, n = stackstd(x, axis=None)
+    assert m.shape == (20, 30)
+
+    for axis in (3, (), []):
+        with pytest.raises(ValueError):
+            stackmean(x, axis=axis)
+
+
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_stack_empty(nthreads):
+    # Frames without pixels
+    m = stackmean(np.zeros((3, 0, 5), dtype=np.float32), nthreads=nthreads)
+    assert m.shape == (0, 5)
+    m, n = stackvar(np.zeros((2, 3, 4, 0), dtype=np.float32), nthreads=nthreads)
+    assert m.shape == n.shape == (4, 0)
+
+    # No images
+    m, n = stacksum(np.zeros((0, 4, 5), dtype=np.float32), norm=False)
+    assert_array_equal(m, np.zeros((4, 5)))
+    assert_array_equal(n, np.zeros((4, 5)))
+    assert n.dtype == np.dtype(np.int_)
+
+
+def test_stackmedian():
+    x = np.random.RandomState(0).rand(101, 20, 30).astype(np.float32)
+    m = stackmedian(x)
+    assert_array_equal(m, np.median(x, axis=0))
+
+    # Even number of values and nans
+    x[3] = np.nan
+    x[7, 5] = np.nan
+    m = stackmedian(x)
+    assert_array_almost_equal(m, np.nanmedian(x, axis=0), 6)
+
+    x = np.ones((5, 10, 10), dtype=np.float32) * np.nan
+    m = stackmedian(x)
+    assert_array_equal(m, np.zeros((10, 10), dtype=np.float32))
+
+
+def test_stackclipmean():
+    x = np.ones((100, 20, 20), dtype=np.float32) * 52.0
+    x[::2] = 48.0
+    x[10:12] = 1.0e4
+    x[20:22, 4, 4] = np.nan
+    m = stackclipmean(x, sigma=3.0)
+    assert_array_almost_equal(m, np.ones((20, 20), dtype=np.float32) * 50.0, 4)
+
+    x = np.ones((1, 20, 20), dtype=np.float32) * np.nan
+    m = stackclipmean(x)
+    assert_array_equal(m, np.zeros((20, 20), dtype=np.float32))
+
+
 def test_images_mean():
     x = [
         np.repeat(ii * np.ones(ii * 100, dtype=np.float32), 400).reshape(
@@ -106,6 +181,10 @@ def test_images_mean():
     m = images_mean(x)
     assert_array_equal(m, np.array([np.mean(x1) for x1 in x]), 3)
 
+    x = np.random.RandomState(0).rand(4, 10, 20, 20).astype(np.float32)
+    m = images_mean(x)
+    assert_array_almost_equal(m, np.array([np.mean(x1) for x1 in x]), 6)
+
 
 def test_images_sum():
     x = [
@@ -125,3 +204,123 @@ def test_images_sum():
     # )
     m = images_sum(x)
     assert_array_equal(m, np.array([np.sum(np.mean(x1, axis=0)) for x1 in x]), 3)
+
+    x = np.random.RandomState(0).rand(4, 10, 20, 20).astype(np.float32)
+    m = images_sum(x)
+    assert_array_almost_equal(m, np.array([np.sum(np.mean(x1, axis=0)) for x1 in x]), 3)
+
+
+def _bin_reference(x, fb, yb, xb):
+    n, y, w = (
+        (x.shape[-3] // fb) * fb,
+        (x.shape[-2] // yb) * yb,
+        (x.shape[-1] // xb) * xb,
+    )
+    x = x[..., :n, :y, :w]
+    shape = x.shape[:-3] + (n // fb, fb, y // yb, yb, w // xb, xb)
+    return x.reshape(shape).mean(axis=(-5, -3, -1))
+
+
+def test_bin_stack():
+    np.random.seed(0)
+    x = np.random.rand(2, 7, 10, 9).astype(np.float32)
+
+    y = bin_stack(x, 2, 3)
+    assert y.shape == (2, 2, 5, 4)
+    assert_array_almost_equal(y, _bin_reference(x, 3, 2, 2))
+
+    y = bin_stack(x[0], (5, 3))
+    assert_array_almost_equal(y, _bin_reference(x[0], 1, 5, 3))
+
+    y = bin_stack(x[0, 0], 2)
+    assert y.shape == (5, 4)
+    assert_array_almost_equal(y, _bin_reference(x[0, 0][np.newaxis], 1, 2, 2)[0])
+
+    with pytest.raises(ValueError):
+        bin_stack(x[0, 0], 2, 2)
+    with pytest.raises(ValueError):
+        bin_stack(x, 2, nan_policy="raise")
+
+
+def test_bin_stack_nan():
+    x = np.ones((4, 4, 4), dtype=np.float32)
+    x[0, 0, 0] = np.nan
+    x[:2, 2:, 2:] = np.nan
+    x[2, 0, 0] = 5.0
+
+    y = bin_stack(x, 2, 2)
+    assert_array_almost_equal(
+        y[:, :, 0], np.array([[1.0, 1.0], [1.5, 1.0]], dtype=np.float32)
+    )
+    assert y[0, 1, 1] == 0.0
+
+    y = bin_stack(x, 2, 2, nan_policy="propagate")
+    assert np.isnan(y[0, 0, 0])
+    assert np.isnan(y[0, 1, 1])
+    assert y[0, 0, 1] == 1.0
+
+
+def test_bin_stack_dask():
+    da = pytest.importorskip("dask.array")
+    np.random.seed(1)
+    x = np.random.rand(2, 11, 9, 10).astype(np.float32)
+    d = da.from_array(x, chunks=(1, 3, 4, 5))
+
+    y = bin_stack(d, (2, 3), 3)
+    assert isinstance(y, da.Array)
+    assert y.shape == (2, 3, 4, 3)
+    assert_array_almost_equal(y.compute(), bin_stack(x, (2, 3), 3))
+
+
+def test_stack_accumulator():
+    np.random.seed(2)
+    x = np.random.normal(10, 2, size=(23, 6, 7)).astype(np.float32)
+    x[:5, 0, 0] = np.nan
+    x[:, 1, 1] = np.nan
+
+    acc = StackAccumulator(variance=True)
+    for i in range(0, 23, 4):
+        acc.update(x[i : i + 4])
+
+    assert_array_almost_equal(acc.mean, stackmean(x), decimal=5)
+    assert_array_almost_equal(acc.var, stackvar(x)[0], decimal=4)
+    assert acc.count[0, 0] == 18
+    assert acc.mean[1, 1] == 0.0
+    assert np.isnan(acc.var[1, 1])
+
+    # Merging two accumulators is the same as one
+    a = StackAccumulator(variance=True)
+    b = StackAccumulator(variance=True)
+    a.update(x[:10])
+    b.update(x[10:])
+    a.merge(b)
+    assert_array_almost_equal(a.mean, acc.mean, decimal=5)
+    assert_array_almost_equal(a.var, acc.var, decimal=4)
+
+    c = StackAccumulator()
+    c.update(x[0])
+    assert_array_almost_equal(c.mean, np.nan_to_num(x[0]))
+    assert c.var is None
+    with pytest.raises(ValueError):
+        a.merge(c)
+
+
+def test_stack_accumulator_weighted_merge():
+    np.random.seed(3)
+    x = np.random.normal(10, 2, size=(8, 4, 5)).astype(np.float32)
+    y = np.random.normal(12, 3, size=(6, 4, 5)).astype(np.float32)
+
+    a = StackAccumulator(variance=True)
+    a.update(x)
+    b = StackAccumulator(variance=True)
+    b.update(y)
+    a.merge(b, weight=2.0)
+
+    # A weight of 2 is the same as adding the frames twice
+    ref = np.concatenate([x, y, y])
+    assert_array_almost_equal(a.mean, ref.mean(axis=0), decimal=5)
+    assert_array_almost_equal(a.var, ref.var(axis=0), decimal=4)
+    assert_array_almost_equal(a.count, np.full((4, 5), 20.0))
+
+    with pytest.raises(ValueError):
+        a.merge(b, weight=0)
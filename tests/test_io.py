@@ -0,0 +1,276 @@
+from csxtools.io import (
+    read_images,
+    resolve_datums,
+    read_segment,
+    write_corrected,
+    read_corrected,
+    read_provenance,
+    read_timestamps,
+)
+from csxtools.utils import _get_images, get_fastccd_timestamps
+from event_model import compose_run
+import h5py
+import json
+import os
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+
+class FakeHeader(object):
+    """Header which only provides the run documents"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def documents(self, fill=False):
+        return iter(self.docs)
+
+
+def _make_run(tmpdir, files, fpp=1, page=False):
+    """Make the documents of a run with images in AreaDetector files
+
+    ``files`` is a list of tuples of (filename, number of events).
+    """
+    run = compose_run()
+    docs = [("start", run.start_doc)]
+    desc = run.compose_descriptor(
+        data_keys={
+            "fccd_image": {
+                "source": "test",
+                "dtype": "array",
+                "shape": [fpp, 6, 5],
+                "external": "FILESTORE:",
+            }
+        },
+        name="primary",
+    )
+    docs.append(("descriptor", desc.descriptor_doc))
+
+    seq_num = 1
+    for filename, nevents in files:
+        res = run.compose_resource(
+            spec="AD_HDF5",
+            root=str(tmpdir),
+            resource_path=filename,
+            resource_kwargs={"frame_per_point": fpp},
+        )
+        docs.append(("resource", res.resource_doc))
+        datum_ids = []
+        for i in range(nevents):
+            datum = res.compose_datum(datum_kwargs={"point_number": i})
+            docs.append(("datum", datum))
+            datum_ids.append(datum["datum_id"])
+
+        if page:
+            docs.append(
+                (
+                    "event_page",
+                    desc.compose_event_page(
+                        data={"fccd_image": datum_ids},
+                        timestamps={"fccd_image": [0.0] * nevents},
+                        seq_num=list(range(seq_num, seq_num + nevents)),
+                        filled={"fccd_image": [False] * nevents},
+                    ),
+                )
+            )
+            seq_num += nevents
+        else:
+            for datum_id in datum_ids:
+                docs.append(
+                    (
+                        "event",
+                        desc.compose_event(
+                            data={"fccd_image": datum_id},
+                            timestamps={"fccd_image": 0.0},
+                            seq_num=seq_num,
+                            filled={"fccd_image": False},
+                        ),
+                    )
+                )
+                seq_num += 1
+
+    docs.append(("stop", run.compose_stop()))
+    return FakeHeader(docs)
+
+
+def _write(tmpdir, filename, data, **kwargs):
+    with h5py.File(str(tmpdir.join(filename)), "w") as f:
+        f.create_dataset("entry/data/data", data=data, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"chunks": (1, 6, 5)}, {"chunks": (3, 4, 2)}, {"compression": "gzip"}],
+)
+def test_read_images(tmpdir, kwargs):
+    np.random.seed(0)
+    a = np.random.randint(0, 0xFFFF, size=(8, 6, 5)).astype(np.uint16)
+    b = np.random.randint(0, 0xFFFF, size=(4, 6, 5)).astype(np.uint16)
+    _write(tmpdir, "a.h5", a, **kwargs)
+    _write(tmpdir, "b.h5", b, **kwargs)
+
+    header = _make_run(tmpdir, [("a.h5", 4), ("b.h5", 2)], fpp=2, page=True)
+    plan = resolve_datums(header, "fccd_image")
+    assert plan.frame_per_point == 2
+    assert plan.nevents == 6
+    assert [s[1:] for s in plan.segments] == [(0, 8), (0, 4)]
+
+    images = read_images(header, "fccd_image", nthreads=3)
+    assert images.shape == (6, 2, 6, 5)
+    assert_array_equal(images.reshape(-1, 6, 5), np.concatenate([a, b]))
+
+
+def test_read_segment_fillvalue(tmpdir):
+    filename = str(tmpdir.join("c.h5"))
+    with h5py.File(filename, "w") as f:
+        d = f.create_dataset(
+            "entry/data/data",
+            shape=(6, 4, 4),
+            chunks=(2, 4, 2),
+            dtype=np.uint16,
+            fillvalue=7,
+        )
+        d[2:4, :, :2] = 1
+
+    out = np.empty((4, 4, 4), dtype=np.uint16)
+    read_segment(filename, 1, 5, out)
+    expected = np.full((6, 4, 4), 7, dtype=np.uint16)
+    expected[2:4, :, :2] = 1
+    assert_array_equal(out, expected[1:5])
+
+    with pytest.raises(ValueError):
+        read_segment(filename, 4, 8, np.empty((4, 4, 4), dtype=np.uint16))
+
+
+def test_get_images_direct(tmpdir):
+    a = np.arange(3 * 6 * 5, dtype=np.uint16).reshape(3, 6, 5)
+    _write(tmpdir, "a.h5", a)
+    header = _make_run(tmpdir, [("a.h5", 3)])
+
+    images = _get_images(header, "fccd_image", direct=True)
+    assert_array_equal(images, a[:, np.newaxis])
+
+    # The ROI is read from the file
+    roi = [1, 1, 4, 3]
+    images = _get_images(header, "fccd_image", roi, direct=True)
+    assert images.flags.c_contiguous
+    assert_array_equal(images, a[:, np.newaxis, 3:4, 1:4])
+
+    with pytest.raises(ValueError):
+        resolve_datums(header, "other_image")
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "lz4", "blosc"])
+@pytest.mark.parametrize("frames_per_chunk", [1, 3])
+def test_write_corrected(tmpdir, compression, frames_per_chunk):
+    if compression in ("lz4", "blosc"):
+        pytest.importorskip("hdf5plugin")
+    np.random.seed(1)
+    stack = np.random.rand(10, 2, 6, 5).astype(np.float32)
+    stack[0, 0, 0, 0] = np.nan
+    dark = np.random.rand(3, 6, 5).astype(np.float32)
+    path = str(tmpdir.join("out.h5"))
+
+    # Blocks which do not line up with the chunks
+    blocks = (stack[i : i + 4] for i in range(0, 10, 4))
+    write_corrected(
+        path,
+        blocks,
+        dark=dark,
+        gain=(1, 4, 8),
+        compression=compression,
+        frames_per_chunk=frames_per_chunk,
+        metadata={"scan_id": 12, "darks": [10, 11, 12]},
+        nthreads=2,
+    )
+
+    assert_array_equal(read_corrected(path, lazy=False), stack)
+    assert_array_equal(read_corrected(path).compute(), stack)
+
+    prov = read_provenance(path)
+    assert_array_equal(prov["dark"], dark)
+    assert prov["flat"] is None
+    assert_array_equal(prov["gain"], [1, 4, 8])
+    assert prov["scan_id"] == 12
+    assert json.loads(prov["darks"]) == [10, 11, 12]
+
+
+def test_write_corrected_dask(tmpdir):
+    da = pytest.importorskip("dask.array")
+    stack = np.arange(7 * 4 * 3, dtype=np.float32).reshape(7, 4, 3)
+    path = str(tmpdir.join("out.h5"))
+    write_corrected(path, da.from_array(stack, chunks=(2, 4, 3)))
+    assert_array_equal(read_corrected(path, lazy=False), stack)
+
+    with pytest.raises(ValueError):
+        write_corrected(path, stack, compression="zip")
+
+
+def test_read_timestamps(tmpdir):
+    sec = np.arange(100, 112, dtype=np.float64)
+    nsec = np.arange(12, dtype=np.float64) * 1e6
+    for name, s in (("a.h5", slice(0, 8)), ("b.h5", slice(8, 12))):
+        with h5py.File(str(tmpdir.join(name)), "w") as f:
+            n = s.stop - s.start
+            f.create_dataset("entry/data/data", shape=(n, 6, 5), dtype=np.uint16)
+            f.create_dataset(
+                "entry/instrument/NDAttributes/NDArrayEpicsTSSec", data=sec[s]
+            )
+            f.create_dataset(
+                "entry/instrument/NDAttributes/NDArrayEpicsTSnSec", data=nsec[s]
+            )
+    expected = sec + nsec * 1e-9
+
+    header = _make_run(tmpdir, [("a.h5", 4), ("b.h5", 2)], fpp=2)
+    ts = get_fastccd_timestamps(header, direct=True)
+    assert ts.shape == (6, 2)
+    assert_array_equal(ts.ravel(), expected)
+    assert_array_equal(read_timestamps(header, "fccd_image", lazy=True).compute(), ts)
+
+    header = _make_run(tmpdir, [("a.h5", 8)])
+    assert_array_equal(read_timestamps(header, "fccd_image"), expected[:8])
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"chunks": (1, 6, 5)}, {"chunks": (3, 4, 2)}, {"compression": "gzip"}],
+)
+@pytest.mark.parametrize("region", [np.s_[1:4, 2:5], np.s_[2:3, :], np.s_[:, 1:2]])
+def test_read_images_region(tmpdir, kwargs, region):
+    np.random.seed(1)
+    a = np.random.randint(0, 0xFFFF, size=(8, 6, 5)).astype(np.uint16)
+    _write(tmpdir, "a.h5", a, **kwargs)
+    header = _make_run(tmpdir, [("a.h5", 3)], fpp=2, page=True)
+
+    images = read_images(header, "fccd_image", region=region, nthreads=2)
+    expected = a[:6].reshape(3, 2, 6, 5)[(Ellipsis,) + region]
+    assert images.flags.c_contiguous
+    assert_array_equal(images, expected)
+
+    images = read_images(header, "fccd_image", region=lambda shape: region)
+    assert_array_equal(images, expected)
+
+
+def test_write_corrected_profiling(tmpdir):
+    from csxtools import profiling
+
+    # Record the size when the stage is published
+    sizes = []
+
+    def callback(record):
+        if record.name == "write_corrected":
+            sizes.append(record.nbytes_out)
+
+    enabled = profiling.is_enabled()
+    profiling.enable()
+    profiling.add_callback(callback)
+    try:
+        path = str(tmpdir.join("out.h5"))
+        write_corrected(path, np.ones((4, 6, 5), dtype=np.float32))
+    finally:
+        profiling.remove_callback(callback)
+        if not enabled:
+            profiling.disable()
+
+    assert sizes == [os.path.getsize(path)]
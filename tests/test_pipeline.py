@@ -0,0 +1,124 @@
+import dask.array as da
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from csxtools import pipeline, settings
+from csxtools.fastccd import correct_images
+from csxtools.axis1 import correct_images_axis
+from csxtools.image import rotate90, stackmean, StackAccumulator
+from csxtools.pipeline import (
+    Pipeline,
+    DetectorDescriptor,
+    register_detector,
+    get_detector,
+)
+
+
+class FakeHeader(object):
+    def __init__(self, uid, images):
+        self.start = {"uid": uid}
+        self.images = images
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Read the images of the fake headers and count the reads"""
+    reads = []
+
+    def _get_images(header, tag, roi=None, direct=False):
+        reads.append(header.start["uid"])
+        images = header.images
+        if roi is not None:
+            images = pipeline._crop(images, roi)
+        return images
+
+    monkeypatch.setattr(pipeline, "_get_images", _get_images)
+    pipeline.clear_dark_cache()
+    yield reads
+    pipeline.clear_dark_cache()
+
+
+def _raw(seed, shape=(4, 2, 10, 12)):
+    np.random.seed(seed)
+    return np.random.randint(0, 0x1FFF, size=shape).astype(np.uint16)
+
+
+def test_registry():
+    for name in ("fccd", "axis1", "axis", "axis_standard", "axis_cont"):
+        assert get_detector(name).tag == settings.detectors[name]
+    with pytest.raises(ValueError):
+        get_detector("nodetector")
+
+    register_detector(DetectorDescriptor("test", "test_image", None))
+    try:
+        assert settings.detectors["test"] == "test_image"
+    finally:
+        del pipeline._registry["test"]
+        del settings.detectors["test"]
+
+
+def test_fastccd(reads):
+    light = FakeHeader("light", _raw(0))
+    darks = tuple(
+        FakeHeader("dark%d" % i, _raw(i + 1, (3, 1, 10, 12))) for i in range(3)
+    )
+    flat = np.random.uniform(0.5, 1.5, size=(10, 12)).astype(np.float32)
+
+    bgnd = np.array(
+        [stackmean(correct_images(d.images, gain=(1, 1, 1))) for d in darks]
+    )
+    expected = rotate90(correct_images(light.images, bgnd, flat), "cw")
+
+    pipe = Pipeline("fccd")
+    assert_array_almost_equal(pipe.images(light, darks, flat), expected)
+    assert reads == ["dark0", "dark1", "dark2", "light"]
+
+    # The dark images are cached
+    assert_array_almost_equal(pipe.images(light, darks, flat, chunk_size=3), expected)
+    assert reads[4:] == ["light"]
+
+    # The dark images, light images and flatfield are cropped alike
+    roi = [2, 1, 7, 9]
+    images = pipe.images(light, darks, flat, roi=roi)
+    crop = pipeline._crop
+    assert_array_almost_equal(
+        images,
+        rotate90(
+            correct_images(crop(light.images, roi), crop(bgnd, roi), crop(flat, roi)),
+            "cw",
+        ),
+    )
+
+    lazy = Pipeline("fccd").images(
+        FakeHeader("light", da.from_array(light.images, chunks=(1, 1, 5, 12))),
+        darks,
+        flat,
+        lazy=True,
+    )
+    assert isinstance(lazy, da.Array)
+    assert_array_almost_equal(lazy.compute(), expected)
+
+    acc = Pipeline("fccd").accumulate(
+        StackAccumulator(), light, darks, flat, chunk_size=3
+    )
+    assert_array_almost_equal(acc.mean, stackmean(expected), decimal=3)
+
+
+def test_axis(reads):
+    light = FakeHeader("light", _raw(0, (5, 10, 12)))
+    dark = FakeHeader("dark", _raw(1, (3, 10, 12)))
+
+    expected = correct_images_axis(light.images, stackmean(dark.images))
+    images = Pipeline("axis_cont").images(light, dark)
+    assert_array_equal(images, expected)
+
+
+@pytest.mark.parametrize("shape", [(4, 10, 12), (2, 12, 10)])
+@pytest.mark.parametrize("roi", [[2, 1, 7, 9], [0, 0, 10, 10], [3, 5, 4, 6]])
+def test_crop(shape, roi):
+    image = np.arange(np.prod(shape)).reshape(shape)
+    ny, nx = shape[-2:]
+    cropped = pipeline._crop(image, roi)
+    assert cropped.flags.c_contiguous
+    assert_array_equal(cropped, image[..., ny - roi[3] : nx - roi[1], roi[0] : roi[2]])
@@ -0,0 +1,80 @@
+from csxtools import profiling
+from csxtools.profiling import stage, get_records
+from csxtools.fastccd import correct_images
+from csxtools.axis1 import correct_images_axis
+import numpy as np
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clean_profiling():
+    profiling.clear()
+    yield
+    profiling.enable()
+    profiling.clear()
+
+
+def test_stage():
+    x = np.zeros((2, 5, 4, 3), dtype=np.float32)
+    with stage("outer", x) as s:
+        with stage("inner") as si:
+            si.set_output(np.zeros((3, 3)))
+        s.set_output(x[0])
+
+    inner, outer = get_records()
+    assert inner.name == "inner"
+    assert inner.parent == "outer"
+    assert inner.nframes == 1
+    assert inner.nbytes_out == 72
+    assert outer.parent is None
+    assert outer.nframes == 10
+    assert outer.nbytes_in == x.nbytes
+    assert outer.nbytes_out == x.nbytes // 2
+    assert outer.wall_time >= inner.wall_time
+    assert outer.peak_memory is None
+    assert outer.as_dict()["frames_per_second"] == outer.frames_per_second
+
+    assert get_records("inner") == [inner]
+    summary = profiling.summary()
+    assert summary["outer"]["calls"] == 1
+    assert summary["outer"]["nframes"] == 10
+
+
+def test_callbacks_and_disable():
+    seen = []
+    profiling.add_callback(seen.append)
+    try:
+        with stage("a"):
+            pass
+        profiling.disable()
+        with stage("b"):
+            pass
+    finally:
+        profiling.remove_callback(seen.append)
+
+    assert [r.name for r in seen] == ["a"]
+    assert [r.name for r in get_records()] == ["a"]
+
+
+def test_trace_memory():
+    profiling.enable(trace_memory=True)
+    with stage("outer") as s:
+        with stage("inner"):
+            x = np.ones(1000000)
+            del x
+    profiling.disable()
+
+    assert s.peak_memory >= 8000000
+    assert get_records("inner")[0].peak_memory >= 8000000
+
+
+def test_correct_images_records():
+    images = np.ones((3, 10, 12), dtype=np.uint16)
+    correct_images(images)
+    correct_images_axis(images)
+
+    r = get_records("correct_images")[0]
+    assert r.nframes == 3
+    assert r.nbytes_in == images.nbytes
+    assert r.nbytes_out == images.size * 4
+    assert len(get_records("correct_images_axis")) == 1
@@ -0,0 +1,161 @@
+from csxtools.streaming import CorrectionRouter
+from csxtools.image_corr import correct_events, correct_event_pages
+from csxtools.fastccd import correct_images
+from csxtools.axis1 import correct_images_axis
+from event_model import compose_run
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+
+def _run(images, page=True):
+    run = compose_run()
+    data_keys = {
+        "fccd_image": {"source": "test", "dtype": "array", "shape": [4, 5]},
+        "temp": {"source": "test", "dtype": "number", "shape": []},
+    }
+    desc = run.compose_descriptor(data_keys=data_keys, name="primary")
+    docs = [("start", run.start_doc), ("descriptor", desc.descriptor_doc)]
+    if page:
+        n = len(images)
+        docs.append(
+            (
+                "event_page",
+                desc.compose_event_page(
+                    data={"fccd_image": list(images), "temp": [1.0] * n},
+                    timestamps={"fccd_image": [0.0] * n, "temp": [0.0] * n},
+                    seq_num=list(range(1, n + 1)),
+                ),
+            )
+        )
+    else:
+        for i, image in enumerate(images):
+            docs.append(
+                (
+                    "event",
+                    desc.compose_event(
+                        data={"fccd_image": image, "temp": 1.0},
+                        timestamps={"fccd_image": 0.0, "temp": 0.0},
+                        seq_num=i + 1,
+                    ),
+                )
+            )
+    docs.append(("stop", run.compose_stop()))
+    return docs
+
+
+def _raw(n=3):
+    np.random.seed(0)
+    images = np.random.randint(0, 0x1FFF, size=(n, 4, 5)).astype(np.uint16)
+    images[:, 0, 0] |= 0x8000
+    images[:, 1, 1] |= 0xC000
+    return images
+
+
+def test_correction_router_event_page():
+    images = _raw()
+    dark = np.random.rand(3, 4, 5).astype(np.float32)
+    calls = []
+
+    def get_dark(start):
+        calls.append(start["uid"])
+        return dark
+
+    out = []
+    router = CorrectionRouter(
+        "fccd_image", get_dark, callback=lambda n, d: out.append((n, d))
+    )
+    for name, doc in _run(images):
+        router(name, doc)
+
+    names = [n for n, d in out]
+    assert names == ["start", "descriptor", "event_page", "stop"]
+    assert len(calls) == 1
+
+    desc = out[1][1]
+    assert "fccd_image_corrected" in desc["data_keys"]
+    assert "fccd_image" in desc["data_keys"]
+
+    page = out[2][1]
+    assert_array_equal(
+        page["data"]["fccd_image_corrected"], correct_images(images, dark)
+    )
+    assert page["data"]["temp"] == [1.0] * 3
+    assert len(page["timestamps"]["fccd_image_corrected"]) == 3
+
+
+def test_correction_router_event_drop_raw():
+    images = _raw()
+    dark = np.random.rand(4, 5).astype(np.float32)
+    router = CorrectionRouter("fccd_image", dark, detector="axis", drop_raw=True)
+
+    out = [router(name, doc) for name, doc in _run(images, page=False)]
+    assert [n for n, d in out] == [
+        "start",
+        "descriptor",
+        "event",
+        "event",
+        "event",
+        "stop",
+    ]
+    assert "fccd_image" not in out[1][1]["data_keys"]
+
+    for i, (name, event) in enumerate(out[2:5]):
+        assert "fccd_image" not in event["data"]
+        assert_array_equal(
+            event["data"]["fccd_image_corrected"],
+            correct_images_axis(images[i : i + 1], dark)[0],
+        )
+
+
+def test_correction_router_unfilled():
+    docs = _run(_raw())
+    docs[2][1]["filled"] = {"fccd_image": [False] * 3}
+    router = CorrectionRouter("fccd_image")
+    router(*docs[0])
+    router(*docs[1])
+    with pytest.raises(ValueError):
+        router(*docs[2])
+
+
+def test_correct_events():
+    images = _raw()
+    dark = np.random.rand(3, 4, 5).astype(np.float32)
+    desc = {"uid": "abc", "data_keys": {"fccd_image": {"source": "test"}}}
+    evs = (
+        {
+            "descriptor": desc,
+            "seq_no": i,
+            "data": {"fccd_image": image},
+            "timestamps": {"fccd_image": 0.0},
+        }
+        for i, image in enumerate(images)
+    )
+    out = list(correct_events(evs, "fccd_image", dark, page_size=2))
+    assert len(out) == 3
+    assert [ev["seq_no"] for ev in out] == [0, 1, 2]
+    assert out[0]["descriptor"] is out[2]["descriptor"]
+    assert "fccd_image_corrected" not in desc["data_keys"]
+    assert_array_equal(
+        np.array([ev["data"]["fccd_image_corrected"] for ev in out]),
+        correct_images(images, dark),
+    )
+
+
+def test_correct_event_pages():
+    images = _raw(5)
+    dark = np.random.rand(3, 4, 5).astype(np.float32)
+    docs = _run(images)
+    page = docs[2][1]
+    page["filled"] = {"fccd_image": [True] * 5}
+
+    (out,) = correct_event_pages([page], "fccd_image", dark, drop_raw=True)
+    assert_array_equal(
+        out["data"]["fccd_image_corrected"], correct_images(images, dark)
+    )
+    assert "fccd_image" not in out["data"]
+    assert "fccd_image" not in out["filled"]
+    assert out["filled"]["fccd_image_corrected"] == [True] * 5
+    assert len(set(out["uid"])) == 5
+    assert out["seq_num"] == page["seq_num"]
+    assert "fccd_image" in page["data"]
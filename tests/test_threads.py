@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from csxtools import set_num_threads, get_num_threads, num_threads
+from csxtools.image import stackmean, rotate90
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+
+def test_num_threads():
+    default = get_num_threads()
+    assert default > 0
+
+    set_num_threads(3)
+    assert get_num_threads() == 3
+    with num_threads(2):
+        assert get_num_threads() == 2
+    assert get_num_threads() == 3
+    set_num_threads(None)
+    assert get_num_threads() == default
+
+    with pytest.raises(ValueError):
+        set_num_threads(-1)
+
+
+def test_nthreads_results():
+    x = np.random.RandomState(0).rand(50, 30, 40).astype(np.float32)
+    m = stackmean(x)
+    for n in (1, 2, 5):
+        assert_array_almost_equal(stackmean(x, nthreads=n), m, 6)
+        assert_array_equal(rotate90(x, "cw", nthreads=n), rotate90(x, "cw"))
@@ -0,0 +1,78 @@
+from csxtools import pipeline
+from csxtools.fastccd import correct_common_mode
+from csxtools.utils import calculate_flatfield, get_fastccd_images
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+
+def _flatfield_reference(image, limits):
+    flat = image.copy()
+    limits = np.nanmedian(image) * np.array(limits)
+    flat[flat < limits[0]] = np.nan
+    flat[flat > limits[1]] = np.nan
+    flat = np.nanmean(flat) / flat
+    return np.rot90(flat)
+
+
+def test_calculate_flatfield():
+    np.random.seed(0)
+    image = np.random.normal(100, 20, size=(30, 20)).astype(np.float32)
+    image[3, 4] = np.nan
+    image[5, :] = 1000
+    original = image.copy()
+
+    flat = calculate_flatfield(image, (0.6, 1.4))
+    assert flat.shape == (20, 30)
+    assert_array_almost_equal(flat, _flatfield_reference(image, (0.6, 1.4)))
+    assert (
+        np.isnan(flat).sum() == np.isnan(_flatfield_reference(image, (0.6, 1.4))).sum()
+    )
+
+    # The input is not modified
+    np.testing.assert_array_equal(image, original)
+
+
+def test_calculate_flatfield_even():
+    image = np.arange(1, 13, dtype=np.float32).reshape(3, 4)
+    assert_array_almost_equal(
+        calculate_flatfield(image, (0.5, 1.5)), _flatfield_reference(image, (0.5, 1.5))
+    )
+
+
+def test_get_fastccd_images_common_mode_roi(monkeypatch):
+    class FakeHeader(object):
+        def __init__(self, uid, images):
+            self.start = {"uid": uid, "time": 0.0}
+            self.images = images
+
+    def _get_images(header, tag, roi=None, direct=False):
+        images = header.images
+        if roi is not None:
+            images = pipeline._crop(images, roi)
+        return images
+
+    monkeypatch.setattr(pipeline, "_get_images", _get_images)
+    pipeline.clear_dark_cache()
+
+    np.random.seed(0)
+    raw = np.random.randint(0, 0x1FFF, size=(3, 2, 12, 12)).astype(np.uint16)
+    darks = tuple(
+        FakeHeader("dark%d" % i, np.full((2, 1, 12, 12), 10 * i, dtype=np.uint16))
+        for i in range(3)
+    )
+    light = FakeHeader("light", raw)
+    # The mask is in the orientation of the corrected images
+    mask = np.random.uniform(size=(12, 12)) > 0.3
+
+    # The ROI is wider than high so a transposed crop of the mask fails
+    x, y, w, h = 1, 2, 4, 3
+    images = get_fastccd_images(
+        light, darks, roi=(x, y, w, h), common_mode={"mask": mask}
+    )
+    full = get_fastccd_images(light, darks)
+    expected = correct_common_mode(
+        full[..., x : x + w, y : y + h], mask=mask[x : x + w, y : y + h]
+    )
+    assert images.shape == (3, 2, w, h)
+    assert_array_almost_equal(images, expected)
+    pipeline.clear_dark_cache()
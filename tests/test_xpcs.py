@@ -0,0 +1,212 @@
+from csxtools.xpcs import (
+    MultiTauCorrelator,
+    multi_tau_auto_corr,
+    multi_tau_lags,
+    two_time_corr,
+    photon_statistics,
+    speckle_contrast,
+)
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+
+def test_multi_tau_lags():
+    assert_array_equal(multi_tau_lags(3, 4), np.array([0, 1, 2, 3, 4, 6, 8, 12]))
+    with pytest.raises(ValueError):
+        multi_tau_lags(3, 5)
+
+
+def test_multi_tau_constant():
+    images = np.full((50, 10, 12), 5.0, dtype=np.float32)
+    labels = np.zeros((10, 12), dtype=np.int64)
+    labels[:5] = 1
+    labels[5:, :4] = 2
+
+    lags, g2 = multi_tau_auto_corr(images, labels, num_levels=3, num_bufs=4)
+    assert_array_equal(lags, multi_tau_lags(3, 4))
+    assert g2.shape == (len(lags), 2)
+    assert_array_almost_equal(g2, np.ones_like(g2))
+
+
+def test_multi_tau_level0():
+    np.random.seed(0)
+    images = np.random.poisson(4, size=(40, 8, 9)).astype(np.float32)
+    labels = np.zeros((8, 9), dtype=np.int64)
+    labels[:4] = 2
+    labels[4:, 3:] = 1
+
+    corr = MultiTauCorrelator(labels, num_levels=1, num_bufs=8)
+    # Feed the frames in uneven blocks to exercise the streaming state
+    corr.update([images[:7], images[7:30], images[30:]])
+    lags, g2 = corr.result()
+    assert corr.nframes == 40
+
+    for r, roi in enumerate([1, 2]):
+        data = images[:, labels == roi]
+        for lag in lags:
+            past = data[: len(data) - lag]
+            future = data[lag:]
+            G = (past * future).mean(axis=1).mean()
+            IP = past.mean(axis=1).mean()
+            IF = future.mean(axis=1).mean()
+            assert_array_almost_equal(g2[lag, r], G / (IP * IF), decimal=5)
+
+
+def test_multi_tau_levels():
+    # Higher levels should see frames averaged in pairs
+    np.random.seed(1)
+    images = np.random.poisson(4, size=(64, 4, 4)).astype(np.float32)
+    labels = np.ones((4, 4), dtype=np.int64)
+
+    lags, g2 = multi_tau_auto_corr(
+        images, labels, num_levels=2, num_bufs=4, chunk_size=10
+    )
+    assert_array_equal(lags, [0, 1, 2, 3, 4, 6])
+
+    binned = 0.5 * (images[0::2] + images[1::2])
+    data = binned.reshape(len(binned), -1)
+    for i, lag in enumerate([2, 3]):
+        past = data[: len(data) - lag]
+        future = data[lag:]
+        G = (past * future).mean(axis=1).mean()
+        IP = past.mean(axis=1).mean()
+        IF = future.mean(axis=1).mean()
+        assert_array_almost_equal(g2[4 + i, 0], G / (IP * IF), decimal=5)
+
+
+def test_multi_tau_shape_mismatch():
+    corr = MultiTauCorrelator(np.ones((4, 4), dtype=np.int64))
+    with pytest.raises(ValueError):
+        corr.update(np.ones((3, 5, 5), dtype=np.float32))
+
+
+def _two_time(images, labels, roi):
+    data = images[:, labels == roi].astype(np.float64)
+    mean = data.mean(axis=1)
+    return np.dot(data, data.T) / data.shape[1] / np.outer(mean, mean)
+
+
+def test_two_time_corr(tmpdir):
+    np.random.seed(2)
+    images = np.random.poisson(4, size=(23, 6, 7)).astype(np.float32)
+    labels = np.zeros((6, 7), dtype=np.int64)
+    labels[:3] = 1
+    labels[3:, 2:] = 2
+
+    expected = np.array([_two_time(images, labels, r) for r in (1, 2)])
+
+    result = two_time_corr(images, labels, chunk_size=5, block_size=4)
+    assert result.shape == (2, 23, 23)
+    assert_array_almost_equal(result, expected, decimal=5)
+
+    filename = str(tmpdir.join("twotime.npy"))
+    result = two_time_corr(images, labels, block_size=7, filename=filename)
+    assert_array_almost_equal(np.load(filename), expected, decimal=5)
+
+
+def test_two_time_corr_frame_bin():
+    np.random.seed(3)
+    images = np.random.poisson(4, size=(21, 5, 5)).astype(np.float32)
+    labels = np.ones((5, 5), dtype=np.int64)
+
+    binned = images[:20].reshape(10, 2, 5, 5).mean(axis=1)
+    expected = _two_time(binned, labels, 1)
+
+    result = two_time_corr(images, labels, frame_bin=2, chunk_size=3, block_size=3)
+    assert result.shape == (1, 10, 10)
+    assert_array_almost_equal(result[0], expected, decimal=5)
+
+
+def test_photon_statistics():
+    np.random.seed(4)
+    counts = np.random.poisson(0.5, size=(2, 6, 8, 9)).astype(np.float32)
+    counts[0, 0, 0, 0] = 20
+    data = counts * 2.0
+    data[1, 2, 1, :3] = np.nan
+    labels = np.zeros((8, 9), dtype=np.int64)
+    labels[:4] = 3
+    labels[4:, 1:] = 1
+
+    hist, mean = photon_statistics(data, labels, photon_energy=2.0, max_photons=4)
+    assert hist.shape == (2, 6, 2, 5)
+    assert mean.shape == (2, 6, 2)
+
+    for i in range(2):
+        for j in range(6):
+            for r, roi in enumerate([1, 3]):
+                values = data[i, j][labels == roi] / 2.0
+                values = values[~np.isnan(values)]
+                expected = np.bincount(np.clip(values.astype(int), 0, 4), minlength=5)
+                assert_array_equal(hist[i, j, r], expected)
+                assert_array_almost_equal(mean[i, j, r], values.mean())
+
+
+def test_speckle_contrast():
+    # Poisson statistics have zero contrast
+    np.random.seed(5)
+    data = np.random.poisson(2.0, size=(200, 50, 50)).astype(np.float32)
+    labels = np.ones((50, 50), dtype=np.int64)
+
+    hist, mean = photon_statistics(data, labels, max_photons=30)
+    prob, kmean, beta = speckle_contrast(hist, axis=0)
+    assert prob.shape == (1, 31)
+    assert_array_almost_equal(prob.sum(axis=-1), [1.0])
+    assert_array_almost_equal(kmean, [mean.mean()])
+    assert abs(beta[0]) < 0.01
+
+
+def test_multi_tau_nan():
+    np.random.seed(5)
+    images = np.random.poisson(4, size=(40, 8, 9)).astype(np.float32)
+    labels = np.zeros((8, 9), dtype=np.int64)
+    labels[:4] = 1
+    labels[4:, 3:] = 2
+    # A bad pixel in ROI 1 and a pixel of ROI 2 which drops out for a while
+    images[:, 1, 2] = np.nan
+    images[10:15, 6, 5] = np.nan
+
+    lags, g2 = multi_tau_auto_corr(images, labels, num_levels=1, num_bufs=8)
+    assert np.isfinite(g2).all()
+
+    for r, roi in enumerate([1, 2]):
+        data = images[:, labels == roi]
+        for lag in lags:
+            past = data[: len(data) - lag]
+            future = data[lag:]
+            valid = np.isfinite(past) & np.isfinite(future)
+            n = valid.sum(axis=1)
+            G = (np.where(valid, past * future, 0).sum(axis=1) / n).mean()
+            IP = (np.where(valid, past, 0).sum(axis=1) / n).mean()
+            IF = (np.where(valid, future, 0).sum(axis=1) / n).mean()
+            assert_array_almost_equal(g2[lag, r], G / (IP * IF), decimal=5)
+
+    # A ROI without valid pixels has no correlation
+    images[:, labels == 2] = np.nan
+    lags, g2 = multi_tau_auto_corr(images, labels, num_levels=1, num_bufs=8)
+    assert np.isfinite(g2[:, 0]).all()
+    assert np.isnan(g2[:, 1]).all()
+
+
+def test_two_time_corr_nan():
+    np.random.seed(6)
+    images = np.random.poisson(4, size=(17, 6, 7)).astype(np.float32)
+    labels = np.zeros((6, 7), dtype=np.int64)
+    labels[:3] = 1
+    labels[3:, 2:] = 2
+    # A bad pixel in ROI 1, ROI 2 is untouched
+    images[:, 0, 3] = np.nan
+    images[4:6, 1, 1] = np.nan
+
+    data = images[:, labels == 1].astype(np.float64)
+    expected = np.empty((17, 17))
+    for i in range(17):
+        for j in range(17):
+            valid = np.isfinite(data[i]) & np.isfinite(data[j])
+            a, b = data[i, valid], data[j, valid]
+            expected[i, j] = (a * b).mean() / (a.mean() * b.mean())
+
+    result = two_time_corr(images, labels, chunk_size=5, block_size=4)
+    assert np.isfinite(result).all()
+    assert_array_almost_equal(result[0], expected, decimal=5)
+    assert_array_almost_equal(result[1], _two_time(images, labels, 2), decimal=5)